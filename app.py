@@ -1,4 +1,3 @@
-import time
 from pathlib import Path
 from advanced_chatbot.config import DATA_PATH
 
@@ -7,16 +6,10 @@ from streamlit_extras.bottom_container import bottom
 
 from llama_index.core.llms import ChatMessage, MessageRole
 from advanced_chatbot.services.rag_service import RagService
+from advanced_chatbot.services.ingestion import IngestionQueue, staging_upload_path
 
 
 # Functions
-# Display chatbot response in streaming mode
-def stream_echo(response):
-    for word in response.split():
-        yield word + " "
-        time.sleep(0.05)
-
-
 # Summarize the content of a document
 def summarize_document(RagService, index_id):
     # Get document name
@@ -37,19 +30,21 @@ def summarize_document(RagService, index_id):
     # Initialize chat history if it doesn't exist
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "memory" not in st.session_state:
+        st.session_state.memory = RagService.new_conversation_memory()
 
     # Define user message and add it to chat history
-    st.session_state.messages.append(
+    messages = [
         ChatMessage(
             role=MessageRole.USER,
             content=f"Peux-tu résumer en quelques mots le document {document_name} ?",
-        )
-    )
-
-    # Add assistant response (summarized content) to chat history
-    st.session_state.messages.append(
-        ChatMessage(role=MessageRole.ASSISTANT, content=summarized_document)
-    )
+        ),
+        # Assistant response (summarized content)
+        ChatMessage(role=MessageRole.ASSISTANT, content=summarized_document),
+    ]
+    for message in messages:
+        st.session_state.messages.append(message)
+        st.session_state.memory.put(message)
 
     return
 
@@ -61,29 +56,80 @@ def save_uploaded_file(DATA_PATH, uploaded_file, RagService):
         data_dir = Path(DATA_PATH)
         data_dir.mkdir(parents=True, exist_ok=True)
 
+        # The uploader keeps its files across reruns, submit each one only once.
+        # A file uploaded again, edited or not, gets a new id.
+        if "ingestion_jobs" not in st.session_state:
+            st.session_state.ingestion_jobs = {}
+        if uploaded_file.file_id in st.session_state.ingestion_jobs:
+            return
+
         # Construct full file path within DATA_PATH
         file_path = data_dir / uploaded_file.name
-        index_configs = RagService.list_vector_store_index()
-        for i, index_config in enumerate(index_configs):
-            # Get document name
-            document_path = Path(index_config["document_path"])
-            document_name = document_path.name
-            if uploaded_file.name == document_name:
-                st.toast("Un fichier de même nom existe déjà dans la base de données !")
-                return 
-        # Write the uploaded file's content to the specified file
-        with open(file_path, "wb") as f:
+        # A file with the same name is a new version of an indexed document
+        existing_index_id = None
+        index_configs = RagService.list_vector_store_index(
+            document_name=uploaded_file.name, limit=1
+        )
+        for index_config in index_configs:
+            existing_index_id = index_config["index_id"]
+        # Write the uploaded file's content to a staging file, moved to file_path
+        # unless its content is already indexed
+        staging_path = staging_upload_path(uploaded_file.name)
+        with open(staging_path, "wb") as f:
             f.write(uploaded_file.getbuffer())
-        # Call RagService to create an index or perform other operations
-        RagService.create_vector_store_index(file_path)
+        # Index the document in the background, identical content is not indexed twice
+        st.session_state.ingestion_jobs[uploaded_file.file_id] = IngestionQueue.submit(
+            staging_path, index_id=existing_index_id, destination=file_path
+        )
         # Notify user of successful file save
-        st.toast("Fichier sauvegardé !")
+        if existing_index_id is not None:
+            st.toast("Un fichier de même nom existe déjà, mise à jour de son index !")
+        else:
+            st.toast("Fichier sauvegardé, indexation en cours !")
 
     except Exception as e:
         # Handle any errors and show error message to user
         st.error(f"Error saving file: {e}")
 
 
+# Display the progress of the documents being indexed
+def display_ingestion_jobs():
+    any_active = False
+    for job_id in st.session_state.get("ingestion_jobs", {}).values():
+        try:
+            job = IngestionQueue.status(job_id)
+        except ValueError:
+            # Finished long ago, the queue forgot it
+            continue
+        document_name = Path(job["document_path"]).name
+        if job["status"] == "done":
+            if job["action"] == "duplicate":
+                st.caption(f"{document_name} : contenu déjà indexé")
+            continue
+
+        if job["status"] == "failed":
+            st.error(f"{document_name} : échec de l'indexation ({job['error']})")
+            st.button(
+                label="Réessayer",
+                key=f"retry_{job_id}",
+                on_click=IngestionQueue.retry,
+                args=(job_id,),
+            )
+        else:
+            any_active = True
+            progress = job["progress"]
+            st.progress(
+                job["fraction_done"],
+                text=f"{document_name} : {job['stage'] or 'en attente'} "
+                f"({progress['pages_parsed']} pages, "
+                f"{progress['chunks_embedded']}/{progress['chunks_total']} extraits, "
+                f"{progress['chunks_per_second']:.0f} extraits/s)",
+            )
+
+    if any_active:
+        st.button(label="Actualiser", key="refresh_ingestion")
+
+
 # Delete a document from the knowledge base
 def delete_document(RagService, index_id):
     RagService.delete_vector_store_index(index_id)
@@ -220,7 +266,9 @@ with st.sidebar:
             else:
                 save_uploaded_file(DATA_PATH, file, RagService)
 
-            # View the saved docs
+        display_ingestion_jobs()
+
+        # View the saved docs
     with st.expander("Consulter la base de connaissances"):
         # Retrieve the list of saved docs
         index_configs = RagService.list_vector_store_index()
@@ -257,7 +305,7 @@ with st.sidebar:
                 args=(RagService, index_id),
                 use_container_width=True,
             )
-    
+
             # Column 3: Delete document
             delete.button(
                 label=":x:",
@@ -275,6 +323,9 @@ with st.sidebar:
 # Initialize chat history if it doesn't exist
 if "messages" not in st.session_state:
     st.session_state.messages = []
+# Memory of the conversation sent to the LLM, its oldest turns summarized
+if "memory" not in st.session_state:
+    st.session_state.memory = RagService.new_conversation_memory()
 
 # Ids of documents in search area
 search_area = [
@@ -304,18 +355,19 @@ if prompt:
     # Add user message to chat history
     st.session_state.messages.append(ChatMessage(role=MessageRole.USER, content=prompt))
 
-    # Get response (return user prompt for the moment)
-    response, _ = RagService.complete_chat(
+    # Get response, streamed token by token as the LLM produces it.
+    # The memory gets the prompt and the response.
+    stream = RagService.stream_chat(
         query=prompt,
-        conversation_history=st.session_state.messages,
+        conversation_history=[],
         index_ids=search_area,
+        memory=st.session_state.memory,
     )
 
-    # Append all token together to have a unified text
-    response = "".join(response)
-
     # Display assistant response
-    st.chat_message("assistant").write_stream(stream_echo(response))
+    with st.chat_message("assistant"):
+        response = st.write_stream(iter(stream))
+        st.caption(f"Premier token en {stream.time_to_first_token or 0:.2f} s")
 
     # Add assistant response to chat history
     st.session_state.messages.append(
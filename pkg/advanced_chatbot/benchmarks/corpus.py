@@ -0,0 +1,140 @@
+"""
+Synthetic corpus for the benchmarks: pdf documents made of generated sentences.
+
+Every document mixes a few topics, each one with its own vocabulary, so that a
+sentence is closer to its own document than to the others and retrieval has
+something to find. The same seed always gives the same corpus.
+"""
+
+import random
+import textwrap
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+_FILLER = (
+    "the a of in for with on by and this that from as is are was be which its "
+    "their an at also more than most each other between into over under"
+).split()
+
+_SYLLABLES = "ba be bi bo da de di do ka ke ki ko la le li lo ma me mi mo na ne ni no ra re ri ro sa se si so ta te ti to va ve vi vo".split()
+
+
+def _make_vocabulary(rng: random.Random, size: int) -> List[str]:
+    return [
+        "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4)))
+        for _ in range(size)
+    ]
+
+
+def make_sentence(rng: random.Random, vocabulary: Sequence[str]) -> str:
+    """
+    :param rng: The random generator.
+    :param vocabulary: The words of the topic of the sentence.
+    :return: A sentence of 8 to 20 words, about half of them from the vocabulary.
+    """
+    words = [
+        rng.choice(vocabulary) if rng.random() < 0.5 else rng.choice(_FILLER)
+        for _ in range(rng.randint(8, 20))
+    ]
+    return " ".join(words).capitalize() + "."
+
+
+def _escape_pdf_text(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: Path, pages: Sequence[str], line_width: int = 90) -> None:
+    """
+    Write a minimal pdf with one text page per string, readable by pypdf.
+    :param path: Path of the pdf file.
+    :param pages: The text of every page. Lines are wrapped at :line_width characters.
+    :param line_width: The maximum number of characters per line.
+    """
+    # Objects 1 to 3 are the catalog, the page tree and the font, then each page
+    # is a page object followed by its content stream.
+    num_pages = len(pages)
+    page_ids = [4 + 2 * i for i in range(num_pages)]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        (
+            f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] "
+            f"/Count {num_pages} >>"
+        ).encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page_id, text in zip(page_ids, pages):
+        lines = textwrap.wrap(text, line_width) or [""]
+        content = "BT /F1 10 Tf 12 TL 40 800 Td\n" + "".join(
+            f"({_escape_pdf_text(line)}) Tj T*\n" for line in lines
+        )
+        stream = (content + "ET").encode("latin-1", errors="replace")
+        objects.append(
+            (
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>"
+            ).encode()
+        )
+        objects.append(
+            f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream"
+        )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref_offset = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode()
+    Path(path).write_bytes(bytes(out))
+
+
+def generate_corpus(
+    out_dir: Path,
+    num_documents: int,
+    pages_per_document: int,
+    sentences_per_page: int = 25,
+    num_queries: int = 100,
+    seed: int = 0,
+) -> Dict:
+    """
+    Write a synthetic corpus of pdf documents.
+    :param out_dir: The directory of the documents, created if needed.
+    :param num_documents: The number of documents.
+    :param pages_per_document: The number of pages of every document.
+    :param sentences_per_page: The number of sentences of every page.
+    :param num_queries: The number of queries to draw from the documents.
+    :param seed: The seed of the random generator.
+    :return: {"documents": [paths], "queries": [{"query", "document_name"}]}, each
+    query being a sentence of the document it comes from.
+    """
+    rng = random.Random(seed)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    topics = [_make_vocabulary(rng, 40) for _ in range(max(4, num_documents))]
+
+    documents, sentences = [], []
+    for d in range(num_documents):
+        path = out_dir / f"doc_{seed}_{d:03d}_{pages_per_document}p.pdf"
+        # A main topic shared by no other document, plus some common ones
+        vocabulary = topics[d % len(topics)] * 3 + rng.choice(topics)
+        pages = []
+        for _ in range(pages_per_document):
+            page = [make_sentence(rng, vocabulary) for _ in range(sentences_per_page)]
+            sentences.extend((sentence, path.name) for sentence in page)
+            pages.append(" ".join(page))
+        write_pdf(path, pages)
+        documents.append(path)
+
+    queries = [
+        {"query": sentence, "document_name": document_name}
+        for sentence, document_name in rng.sample(
+            sentences, min(num_queries, len(sentences))
+        )
+    ]
+    return {"documents": documents, "queries": queries}
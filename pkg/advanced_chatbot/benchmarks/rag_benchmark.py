@@ -0,0 +1,298 @@
+"""
+Benchmarks of the hot paths of the RagService, reproducible and offline.
+
+Documents come from the synthetic corpus of advanced_chatbot.benchmarks.corpus,
+chunks are embedded by a deterministic hashed embedding and answers come from the
+mock LLM, so no API key is needed and two runs measure the same work:
+
+    python -m advanced_chatbot.benchmarks.rag_benchmark --documents 8 --pages 5,20
+    python -m advanced_chatbot.benchmarks.rag_benchmark --output bench.json
+
+For every document size it measures the parse, split, embed and persist stages of
+create_vector_store_index, the cold and warm load_vector_store_index times, and the
+retrieval and complete_chat latencies (p50/p95/p99) for growing numbers of indexes.
+The report is JSON, compare reports of two commits to spot regressions.
+Everything is written in a temporary DATA_PATH unless --data-path is given.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.schema import QueryBundle
+
+from advanced_chatbot.benchmarks.corpus import generate_corpus
+from advanced_chatbot.testing.embedding_server import hashed_embedding
+
+
+class HashEmbedding(BaseEmbedding):
+    """
+    Deterministic in-process embedding, see hashed_embedding.
+    """
+
+    dim: int = Field(default=1536, description="The dimension of the embeddings.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return hashed_embedding(query, self.dim).tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return hashed_embedding(text, self.dim).tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [self._get_text_embedding(text) for text in texts]
+
+
+def latency_stats(seconds: Sequence[float]) -> Dict[str, float]:
+    """
+    :param seconds: The measured durations, in seconds.
+    :return: Count, mean and p50/p95/p99 of the durations, in milliseconds.
+    """
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(ms):
+        return {"n": 0}
+    return {
+        "n": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    started_at = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started_at
+
+
+def bench_ingestion(rag_service, documents: List[Path]) -> Dict:
+    """
+    Ingest the documents stage by stage, as create_vector_store_index does.
+    :return: Per stage, total seconds and throughput, and the ids of the indexes.
+    """
+    totals = {"parse": 0.0, "split": 0.0, "embed": 0.0, "persist": 0.0}
+    pages = chunks = 0
+    index_ids = []
+    for path in documents:
+        parsed, seconds = _timed(rag_service.parse_document, path)
+        totals["parse"] += seconds
+        nodes, seconds = _timed(rag_service.split_documents, parsed)
+        totals["split"] += seconds
+        _, seconds = _timed(rag_service.embed_nodes, nodes)
+        totals["embed"] += seconds
+        (index_id, _), seconds = _timed(
+            rag_service.build_vector_store_index, nodes, path, documents=parsed
+        )
+        totals["persist"] += seconds
+        pages += len(parsed)
+        chunks += len(nodes)
+        index_ids.append(index_id)
+
+    return {
+        "documents": len(documents),
+        "pages": pages,
+        "chunks": chunks,
+        "seconds": totals,
+        "pages_per_second": {"parse": pages / totals["parse"]},
+        "chunks_per_second": {
+            stage: chunks / totals[stage] for stage in ("split", "embed", "persist")
+        },
+        "index_ids": index_ids,
+    }
+
+
+def bench_load(rag_service, index_ids: List[str]) -> Dict:
+    """
+    :return: Latency of load_vector_store_index from disk (cold) and from the
+    index cache (warm).
+    """
+    from advanced_chatbot.services.index_cache import IndexCache
+
+    cold, warm = [], []
+    for index_id in index_ids:
+        IndexCache.invalidate(index_id)
+        cold.append(_timed(rag_service.load_vector_store_index, index_id)[1])
+        warm.append(_timed(rag_service.load_vector_store_index, index_id)[1])
+    return {"cold": latency_stats(cold), "warm": latency_stats(warm)}
+
+
+def bench_retrieval(
+    rag_service, index_ids: List[str], queries: List[Dict], retrieval_mode: str
+) -> Dict:
+    """
+    :return: Latency of the retrieval alone (query embedding, search and window
+    postprocessing) and of a whole complete_chat turn with the mock LLM, plus the
+    fraction of queries whose best source is the document they come from.
+    """
+    # The first query loads the indexes and fills the embedding matrix
+    _, first_query = _timed(
+        rag_service.build_retrieval, index_ids, retrieval_mode=retrieval_mode
+    )
+
+    retrieval, chat, hits = [], [], 0
+    for query in queries:
+        started_at = time.perf_counter()
+        retriever, node_postprocessors = rag_service.build_retrieval(
+            index_ids, retrieval_mode=retrieval_mode
+        )
+        nodes = retriever.retrieve(query["query"])
+        for postprocessor in node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(
+                nodes, query_bundle=QueryBundle(query["query"])
+            )
+        retrieval.append(time.perf_counter() - started_at)
+        if nodes and nodes[0].node.metadata.get("file_name") == query["document_name"]:
+            hits += 1
+
+        started_at = time.perf_counter()
+        tokens, _ = rag_service.complete_chat(
+            query["query"], [], index_ids, retrieval_mode=retrieval_mode
+        )
+        for _ in tokens:
+            pass
+        chat.append(time.perf_counter() - started_at)
+
+    return {
+        "indexes": len(index_ids),
+        "retrieval_mode": retrieval_mode,
+        "first_query_ms": first_query * 1000,
+        "retrieval": latency_stats(retrieval),
+        "complete_chat": latency_stats(chat),
+        "source_hit_rate": hits / len(queries) if queries else None,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args: argparse.Namespace) -> Dict:
+    """
+    Run every benchmark for every document size.
+    :return: The JSON report.
+    """
+    # The configuration is read from the environment when the services are imported
+    from advanced_chatbot.services.rag_service import RagService
+
+    RagService.use_models(embed_model=HashEmbedding(dim=args.dim))
+
+    report = {
+        "meta": {
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "started_at": time.time(),
+            "args": vars(args),
+        },
+        "runs": [],
+    }
+    corpus_dir = Path(os.environ["DATA_PATH"]) / "benchmark_corpus"
+    for pages in args.pages:
+        corpus = generate_corpus(
+            corpus_dir,
+            num_documents=args.documents,
+            pages_per_document=pages,
+            sentences_per_page=args.sentences_per_page,
+            num_queries=args.queries,
+            seed=args.seed,
+        )
+        ingestion = bench_ingestion(RagService, corpus["documents"])
+        index_ids = ingestion.pop("index_ids")
+        run_report = {
+            "pages_per_document": pages,
+            "chunks_per_index": ingestion["chunks"] / len(index_ids),
+            "ingestion": ingestion,
+            "load": bench_load(RagService, index_ids),
+            "retrieval": [
+                bench_retrieval(RagService, index_ids[:count], corpus["queries"], mode)
+                for count in args.index_counts
+                if count <= len(index_ids)
+                for mode in args.retrieval_modes
+            ],
+        }
+        report["runs"].append(run_report)
+        print(
+            f"{pages} pages/doc: {ingestion['chunks']} chunks ingested in "
+            f"{sum(ingestion['seconds'].values()):.1f} s",
+            file=sys.stderr,
+        )
+        for index_id in index_ids:
+            RagService.delete_vector_store_index(index_id)
+    return report
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--documents", type=int, default=8)
+    parser.add_argument(
+        "--pages", type=_int_list, default=[5, 20], help="Pages per document, e.g. 5,20"
+    )
+    parser.add_argument("--sentences-per-page", type=int, default=25)
+    parser.add_argument(
+        "--index-counts", type=_int_list, default=[1, 4, 8], help="e.g. 1,4,8"
+    )
+    parser.add_argument(
+        "--retrieval-modes",
+        type=lambda value: value.split(","),
+        default=["matrix", "fusion"],
+    )
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-path", help="DATA_PATH of the run, temporary if not given"
+    )
+    parser.add_argument("--output", help="Write the report there instead of stdout")
+    args = parser.parse_args(argv)
+
+    os.environ["DATA_PATH"] = args.data_path or tempfile.mkdtemp(prefix="rag_bench_")
+    os.environ["USE_MOCK_MODELS"] = "true"
+    try:
+        report = run(args)
+    finally:
+        if not args.data_path:
+            shutil.rmtree(os.environ["DATA_PATH"], ignore_errors=True)
+
+    content = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(content)
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main()
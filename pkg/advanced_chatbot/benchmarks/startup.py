@@ -0,0 +1,149 @@
+"""
+Cold start of the RagService: where the import time goes, and what first use costs.
+
+Every run is a fresh interpreter started with -X importtime. The import time of
+every module is summed by top-level package, so that the packages worth deferring
+stand out:
+
+    python -m advanced_chatbot.benchmarks.startup
+    python -m advanced_chatbot.benchmarks.startup --module advanced_chatbot.server --top 20
+    python -m advanced_chatbot.benchmarks.startup --first-use --json
+
+Run it on two commits to compare their cold starts.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+_MARKER = "startup-timings:"
+
+_FIRST_USE_CODE = """
+import json, time
+started_at = time.perf_counter()
+from advanced_chatbot.services.rag_service import RagService
+imported_at = time.perf_counter()
+RagService.embed_model
+embedding_at = time.perf_counter()
+RagService.llm
+llm_at = time.perf_counter()
+print({marker!r} + json.dumps({{
+    "import_s": imported_at - started_at,
+    "embed_model_s": embedding_at - imported_at,
+    "llm_s": llm_at - embedding_at,
+}}))
+"""
+
+_IMPORT_CODE = """
+import json, time
+started_at = time.perf_counter()
+import {module}
+print({marker!r} + json.dumps({{"import_s": time.perf_counter() - started_at}}))
+"""
+
+
+def parse_importtime(stderr: str) -> Dict[str, float]:
+    """
+    :param stderr: The output of python -X importtime.
+    :return: The self import time in seconds of every module.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = int(self_us) / 1e6
+    return modules
+
+
+def measure_once(code: str) -> Dict:
+    """
+    Run :code in a fresh interpreter.
+    :return: The timings it printed and the self import time of every module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env=os.environ.copy(),
+    )
+    timings = None
+    for line in result.stdout.splitlines():
+        if line.startswith(_MARKER):
+            timings = json.loads(line[len(_MARKER) :])
+    if result.returncode != 0 or timings is None:
+        raise RuntimeError(f"The measured import failed:\n{result.stderr[-2000:]}")
+    return {"timings": timings, "modules": parse_importtime(result.stderr)}
+
+
+def measure(module: str, first_use: bool, runs: int, top: int) -> Dict:
+    """
+    :param module: The module to import.
+    :param first_use: Also time the creation of the models of the RagService.
+    :param runs: The number of fresh interpreters, the fastest one is reported.
+    :param top: The number of packages and modules to report.
+    :return: The timings of the fastest run, its import time by top-level package
+    and its slowest modules, in seconds.
+    """
+    if first_use:
+        code = _FIRST_USE_CODE.format(marker=_MARKER)
+    else:
+        code = _IMPORT_CODE.format(module=module, marker=_MARKER)
+    fastest = min(
+        (measure_once(code) for _ in range(runs)),
+        key=lambda run: run["timings"]["import_s"],
+    )
+
+    packages: Dict[str, float] = defaultdict(float)
+    for name, seconds in fastest["modules"].items():
+        packages[name.split(".")[0]] += seconds
+    return {
+        "module": "advanced_chatbot.services.rag_service" if first_use else module,
+        "timings": fastest["timings"],
+        "packages": dict(sorted(packages.items(), key=lambda kv: -kv[1])[:top]),
+        "modules": dict(
+            sorted(fastest["modules"].items(), key=lambda kv: -kv[1])[:top]
+        ),
+    }
+
+
+def _print_report(report: Dict) -> None:
+    print(f"Cold start of {report['module']}")
+    for name, seconds in report["timings"].items():
+        print(f"  {name:<16}{seconds * 1000:10.1f} ms")
+    print("Import time by package (self time of its modules)")
+    for name, seconds in report["packages"].items():
+        print(f"  {name:<40}{seconds * 1000:10.1f} ms")
+    print("Slowest modules (self time)")
+    for name, seconds in report["modules"].items():
+        print(f"  {name:<60}{seconds * 1000:10.1f} ms")
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--module", default="advanced_chatbot.services.rag_service")
+    parser.add_argument(
+        "--first-use",
+        action="store_true",
+        help="Also time the first access to RagService.embed_model and RagService.llm",
+    )
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = measure(args.module, args.first_use, args.runs, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+
+
+if __name__ == "__main__":
+    main()
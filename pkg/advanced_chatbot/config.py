@@ -4,6 +4,9 @@ from pathlib import Path
 
 DATA_PATH = Path(os.environ["DATA_PATH"])
 DATA_PATH.mkdir(exist_ok=True)
+RAG_STORAGE_PATH = DATA_PATH / "rag_storage"
+INGESTION_CHECKPOINT_PATH = DATA_PATH / "ingestion_checkpoints"
+UPLOAD_STAGING_PATH = DATA_PATH / "uploads"
 
 ############## DEFAULT RAG CONFIG ################
 DEFAULT_RAG_CHUNK_SIZE = 128
@@ -11,8 +14,158 @@ DEFAULT_RAG_CHUNK_OVERLAP = 10
 DEFAULT_RAG_SIMILARITY_TOP_K = 4
 DEFAULT_RAG_WINDOW_SIZE = 1
 DEFAULT_RAG_TOKEN_LIMIT = 2000
+# "matrix": one vectorized top-k over all selected documents.
+# "fusion": one retriever per document fused by a QueryFusionRetriever.
+DEFAULT_RAG_RETRIEVAL_MODE = "matrix"
+# "npy": embeddings persisted as a memory-mapped float32 matrix.
+# "json": embeddings persisted as JSON float lists by SimpleVectorStore.
+DEFAULT_RAG_VECTOR_FORMAT = "npy"
+# Embeddings held in memory by the matrix retrieval mode: "float32", "float16"
+# (2x smaller) or "int8" (4x smaller). With compact codes, the
+# DEFAULT_RESCORE_FACTOR * top_k best candidates are rescored against the float32
+# embeddings memory-mapped from disk. Measure the accuracy of each mode with
+# python -m advanced_chatbot.services.quantization
+DEFAULT_EMBEDDING_MATRIX_DTYPE = "float32"
+DEFAULT_RESCORE_FACTOR = 4
+
+############## CONVERSATION MEMORY CONFIG ################
+# A conversation kept across turns (services/conversation_memory.py) keeps its latest
+# messages verbatim while they fit in DEFAULT_MEMORY_RECENT_TOKEN_LIMIT tokens. The
+# oldest turns are then folded by the LLM, in the background, into a running summary
+# of at most DEFAULT_MEMORY_SUMMARY_MAX_WORDS words sent before the latest messages.
+# Summary and messages share DEFAULT_RAG_TOKEN_LIMIT with the system prompt and the
+# context.
+DEFAULT_MEMORY_RECENT_TOKEN_LIMIT = 800
+DEFAULT_MEMORY_SUMMARY_MAX_WORDS = 150
+
+############## CONTEXT ASSEMBLY CONFIG ################
+# Before the LLM call, overlapping or adjacent windows of the same page are merged,
+# windows whose word 3-grams are at least DEFAULT_CONTEXT_DUPLICATE_THRESHOLD
+# contained in a better scored window are dropped, then the best windows are packed
+# in DEFAULT_CONTEXT_TOKEN_BUDGET tokens. The context is part of the
+# DEFAULT_RAG_TOKEN_LIMIT tokens of the prompt, the history gets the rest.
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1200
+DEFAULT_CONTEXT_DUPLICATE_THRESHOLD = 0.8
+
+############## ANN CONFIG ################
+# When enabled, indexes of at least DEFAULT_ANN_MIN_ROWS chunks get an IVF index
+# (ivf_index.npz): a query only scores the chunks of its closest clusters. The number
+# of clusters searched is calibrated when the index is built, the smallest reaching
+# a recall@DEFAULT_RAG_SIMILARITY_TOP_K of DEFAULT_ANN_TARGET_RECALL on held-out
+# chunks, unless DEFAULT_ANN_NPROBE is set. Real queries are further from the chunks
+# than held-out chunks, measure recall on your data before enabling it with
+# python -m advanced_chatbot.services.ivf_index --index-id <index_id>
+DEFAULT_ANN_ENABLED = False
+DEFAULT_ANN_MIN_ROWS = 20_000
+DEFAULT_ANN_LISTS = None  # 4 * sqrt(chunks) when None
+DEFAULT_ANN_TARGET_RECALL = 0.95
+DEFAULT_ANN_NPROBE = None  # Calibrated per index when None
+
+############## INDEX CACHE CONFIG ################
+# Loaded indexes are kept in memory between chat turns.
+DEFAULT_INDEX_CACHE_MAX_ENTRIES = 64
+DEFAULT_INDEX_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # Size on disk of cached indexes
+
+############## EMBEDDING CACHE CONFIG ################
+# Chunk embeddings are cached on disk, keyed by model name and chunk text.
+DEFAULT_EMBEDDING_CACHE_ENABLED = True
+DEFAULT_EMBEDDING_CACHE_MAX_ENTRIES = 1_000_000
+
+############## INGESTION CONFIG ################
+# Number of documents ingested concurrently in the background
+DEFAULT_INGESTION_WORKERS = 2
+# Finished ingestion jobs are forgotten DEFAULT_INGESTION_JOB_TTL seconds after they
+# finished, or sooner when more than DEFAULT_INGESTION_MAX_FINISHED_JOBS are kept.
+DEFAULT_INGESTION_JOB_TTL = 24 * 3600
+DEFAULT_INGESTION_MAX_FINISHED_JOBS = 1000
+# Pdf files of at least DEFAULT_PARSE_PARALLEL_MIN_PAGES pages are parsed by page
+# ranges in a pool of DEFAULT_PARSE_WORKERS processes (1 disables parallel parsing).
+DEFAULT_PARSE_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_PARSE_PARALLEL_MIN_PAGES = 50
+# Embedding batches are sized by tokens, several of them being in flight at once.
+DEFAULT_EMBEDDING_BATCH_TOKENS = 8000
+DEFAULT_EMBEDDING_MAX_BATCH_SIZE = 256
+DEFAULT_EMBEDDING_CONCURRENCY = 4
+DEFAULT_EMBEDDING_MAX_RETRIES = 8
+# Files of at least DEFAULT_STREAMING_MIN_FILE_SIZE bytes are ingested as a stream:
+# DEFAULT_STREAMING_BATCH_PAGES pages at a time are parsed, split, embedded and
+# appended to a checkpoint on disk, so memory stays bounded and an interrupted
+# ingestion resumes from its last committed batch.
+DEFAULT_STREAMING_MIN_FILE_SIZE = 20 * 1024 * 1024
+DEFAULT_STREAMING_BATCH_PAGES = 16
+
+############## ASYNC CONFIG ################
+# Concurrency limits of the AsyncRagService, shared by every conversation served on
+# its event loop. Calls over the limits wait for a free slot.
+DEFAULT_ASYNC_MAX_RETRIEVALS = 16
+DEFAULT_ASYNC_MAX_LLM_CALLS = 32
+# Summarizing a document or detecting its language is one blocking call in a worker
+# thread, which makes several LLM calls itself (up to DEFAULT_SUMMARY_MAP_CONCURRENCY
+# at once). At most DEFAULT_ASYNC_MAX_DOCUMENT_CALLS of them run at once, outside of
+# the DEFAULT_ASYNC_MAX_LLM_CALLS slots.
+DEFAULT_ASYNC_MAX_DOCUMENT_CALLS = 4
+
+############## SERVER CONFIG ################
+# python -m advanced_chatbot.server: at most DEFAULT_SERVER_WORKERS requests are
+# processed at once, a streamed chat until its last token. A request gets
+# DEFAULT_SERVER_REQUEST_TIMEOUT seconds (until the first token for a chat), then a
+# streamed chat DEFAULT_SERVER_TOKEN_TIMEOUT seconds per token. The
+# DEFAULT_SERVER_WARM_INDEXES most recent indexes are loaded at startup.
+DEFAULT_SERVER_HOST = "127.0.0.1"
+DEFAULT_SERVER_PORT = 8000
+DEFAULT_SERVER_WORKERS = 8
+DEFAULT_SERVER_REQUEST_TIMEOUT = 120.0
+DEFAULT_SERVER_TOKEN_TIMEOUT = 30.0
+DEFAULT_SERVER_WARM_INDEXES = 16
+# Uploaded documents above this size are rejected, like in the Streamlit app
+DEFAULT_SERVER_MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+# A document given by path in POST /indexes must resolve under this directory, the
+# server does not read any other file of the host
+DEFAULT_SERVER_DOCUMENTS_ROOT = DATA_PATH
+
+############## INSTRUMENTATION CONFIG ################
+# Spans of the RagService calls and of their stages (index loading, query embedding,
+# search, postprocessing, prompt assembly, LLM), see services/instrumentation.py.
+# They are aggregated in memory (GET /metrics of the server, Prometheus format) and
+# written as JSON lines to DEFAULT_INSTRUMENTATION_JSONL_PATH when it is set.
+DEFAULT_INSTRUMENTATION_ENABLED = False
+DEFAULT_INSTRUMENTATION_JSONL_PATH = None
+
+############## DOCUMENT INSIGHTS CONFIG ################
+# Language and summaries of a document are computed in the background once it is
+# indexed, and stored next to its index (document_insights.json).
+DEFAULT_PRECOMPUTE_DOCUMENT_INSIGHTS = True
+# Pages spread over the document, cut to DEFAULT_INSIGHTS_PAGE_CHARS characters,
+# are what the summary and the language detection read.
+DEFAULT_SUMMARY_SAMPLE_PAGES = 20
+# "clusters" summarizes the document from its stored embeddings: they are grouped in
+# DEFAULT_SUMMARY_CLUSTERS clusters, the DEFAULT_SUMMARY_CHUNKS_PER_CLUSTER chunks
+# closest to each centroid are summarized per cluster (at most
+# DEFAULT_SUMMARY_MAP_CONCURRENCY LLM calls at once), then the partial summaries are
+# merged. "pages" summarizes the sampled pages in a single call.
+DEFAULT_SUMMARY_MODE = "clusters"
+DEFAULT_SUMMARY_CLUSTERS = 8
+DEFAULT_SUMMARY_CHUNKS_PER_CLUSTER = 4
+DEFAULT_SUMMARY_MAP_CONCURRENCY = 4
+# Tokens of document text sent to the per-cluster summaries, shared by the clusters
+DEFAULT_SUMMARY_TOKEN_BUDGET = 6000
+DEFAULT_LANGUAGE_SAMPLE_PAGES = 5
+DEFAULT_INSIGHTS_PAGE_CHARS = 500
+# The language is identified offline from character n-grams (services/language_id.py),
+# the LLM is only asked for texts of less than DEFAULT_LANGUAGE_MIN_LETTERS letters or
+# when the confidence is below DEFAULT_LANGUAGE_MIN_CONFIDENCE. Calibrated with
+# python -m advanced_chatbot.services.language_id --calibrate: no held-out detection
+# above 0.0275 is wrong, and at least 87% of every language is detected above 0.03.
+DEFAULT_LANGUAGE_MIN_LETTERS = 60
+DEFAULT_LANGUAGE_MIN_CONFIDENCE = 0.03
 
 
 # USE FAKE LLMS
-USE_MOCK_MODELS = False
+USE_MOCK_MODELS = os.environ.get("USE_MOCK_MODELS", "false").lower() in ("1", "true")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+# Alternative endpoint for the embeddings, e.g. advanced_chatbot.testing.embedding_server
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE")
+OPENAI_LLM_MODEL = "gpt-3.5-turbo"
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+# Name of the configured LLM, part of the fingerprint of the document insights
+LLM_MODEL_NAME = "mock" if USE_MOCK_MODELS else OPENAI_LLM_MODEL
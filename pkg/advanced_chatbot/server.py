@@ -0,0 +1,527 @@
+"""
+Headless HTTP server of the RagService.
+
+Indexes stay loaded in the process between requests, so several Streamlit
+instances (or any other client) can share one warm backend:
+
+    python -m advanced_chatbot.server --port 8000
+
+    GET    /health
+    GET    /metrics                  Prometheus text, with --instrument
+    GET    /indexes?name_contains=&document_name=&limit=&offset=
+    POST   /indexes                  {"document_path": "report.pdf"}, see --documents-root
+    POST   /indexes?filename=x.pdf   raw bytes of the document, see --max-upload-size
+    DELETE /indexes/<index_id>
+    GET    /jobs
+    GET    /jobs/<job_id>
+    POST   /jobs/<job_id>/retry
+    POST   /chat                     {"query": "...", "index_ids": [...], "history": [...]}
+    POST   /indexes/<index_id>/summary
+    POST   /summarize                {"text": "..."}
+
+/chat streams newline-delimited JSON: the sources first, then one line per token,
+then a last line with the timings.
+"""
+
+import argparse
+import json
+import logging
+import queue
+import re
+import shutil
+import threading
+import traceback
+from contextlib import closing
+from concurrent.futures import Executor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.schema import NodeWithScore
+
+from advanced_chatbot.config import (
+    DATA_PATH,
+    DEFAULT_RAG_RETRIEVAL_MODE,
+    DEFAULT_SERVER_DOCUMENTS_ROOT,
+    DEFAULT_SERVER_HOST,
+    DEFAULT_SERVER_MAX_UPLOAD_SIZE,
+    DEFAULT_SERVER_PORT,
+    DEFAULT_SERVER_REQUEST_TIMEOUT,
+    DEFAULT_SERVER_TOKEN_TIMEOUT,
+    DEFAULT_SERVER_WARM_INDEXES,
+    DEFAULT_SERVER_WORKERS,
+)
+from advanced_chatbot.services.ingestion import IngestionQueue, staging_upload_path
+from advanced_chatbot.services.instrumentation import (
+    Instrumentation,
+    Metrics,
+    enable_default_sinks,
+)
+from advanced_chatbot.services.rag_service import DEFAULT_SYSTEM_PROMPT, RagService
+
+logger = logging.getLogger(__name__)
+
+_END_OF_STREAM = object()
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _source_to_dict(source: NodeWithScore) -> Dict[str, Any]:
+    metadata = source.node.metadata
+    return {
+        "node_id": source.node.node_id,
+        "score": source.score,
+        "text": source.node.get_content(),
+        "file_name": metadata.get("file_name"),
+        "page_label": metadata.get("page_label"),
+    }
+
+
+def _iter_with_timeout(
+    iterable: Iterable[str],
+    first_timeout: float,
+    next_timeout: float,
+    executor: Executor,
+) -> Iterator[str]:
+    """
+    Iterate in a worker of :executor, giving up if an item takes too long.
+    When the iteration stops early (timeout, or the consumer closing it), the worker
+    stops after the item it waits for and closes :iterable, if it has a close().
+    :param iterable: The items, produced by a blocking iterator.
+    :param first_timeout: Seconds to wait for the first item, a free worker
+    included.
+    :param next_timeout: Seconds to wait for each following item.
+    :param executor: The pool bounding the number of iterations at once.
+    :return: The items. TimeoutError is raised when a timeout expires.
+    """
+    items: queue.Queue = queue.Queue()
+    stop = threading.Event()
+
+    def pump() -> None:
+        try:
+            if stop.is_set():
+                return
+            for item in iterable:
+                if stop.is_set():
+                    break
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            items.put(_END_OF_STREAM)
+
+    executor.submit(pump)
+    timeout = first_timeout
+    try:
+        while True:
+            try:
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No token for {timeout:.0f} s")
+            if item is _END_OF_STREAM:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            timeout = next_timeout
+    finally:
+        stop.set()
+
+
+class _RagRequestHandler(BaseHTTPRequestHandler):
+    """
+    Route the requests to the RagService and the IngestionQueue.
+    The work of a request runs in the worker pool of the server, which bounds the
+    number of requests processed at once and enforces the request timeout. The
+    tokens of a chat are pulled from the LLM by a worker too, held until the last
+    token or the token timeout.
+    """
+
+    server: "RagHTTPServer"
+    # Seconds a client may take to send its request
+    timeout = 30
+
+    ROUTES = [
+        ("GET", r"/health", "_health"),
+        ("GET", r"/metrics", "_metrics"),
+        ("GET", r"/indexes", "_list_indexes"),
+        ("POST", r"/indexes", "_create_index"),
+        ("DELETE", r"/indexes/(?P<index_id>[\w-]+)", "_delete_index"),
+        ("POST", r"/indexes/(?P<index_id>[\w-]+)/summary", "_summarize_index"),
+        ("GET", r"/jobs", "_list_jobs"),
+        ("GET", r"/jobs/(?P<job_id>[\w-]+)", "_job_status"),
+        ("POST", r"/jobs/(?P<job_id>[\w-]+)/retry", "_retry_job"),
+        ("POST", r"/chat", "_chat"),
+        ("POST", r"/summarize", "_summarize"),
+    ]
+
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:
+        self._dispatch("POST")
+
+    def do_DELETE(self) -> None:
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method: str) -> None:
+        url = urlparse(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            for route_method, pattern, handler_name in self.ROUTES:
+                match = re.fullmatch(pattern, url.path.rstrip("/"))
+                if match and route_method == method:
+                    getattr(self, handler_name)(**match.groupdict())
+                    return
+            raise HTTPError(404, f"No route for {method} {url.path}")
+        except HTTPError as e:
+            self._reply(e.status, {"error": str(e)})
+        except (FutureTimeoutError, TimeoutError):
+            self._reply(504, {"error": "The request timed out."})
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            logger.error("%s %s failed\n%s", method, self.path, traceback.format_exc())
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def _run(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Run a call in the worker pool and wait for it, at most the request timeout.
+        A call that times out is not interrupted, its result is dropped.
+        """
+        future = self.server.workers.submit(fn, *args, **kwargs)
+        return future.result(timeout=self.server.request_timeout)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            raise HTTPError(400, f"Invalid JSON body: {e}")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "The JSON body must be an object.")
+        return body
+
+    def _reply(self, status: int, payload: Any) -> None:
+        content = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _health(self) -> None:
+        self._reply(
+            200,
+            {
+                "status": "ok",
+                "indexes": RagService.count_vector_store_index(),
+                "index_cache": RagService.index_cache_stats(),
+            },
+        )
+
+    def _metrics(self) -> None:
+        if not Instrumentation.enabled:
+            raise HTTPError(404, "The instrumentation is disabled, see --instrument.")
+        content = Metrics.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _list_indexes(self) -> None:
+        filters = {
+            "document_name": self.query.get("document_name"),
+            "name_contains": self.query.get("name_contains"),
+        }
+        limit = self.query.get("limit")
+        entries = RagService.list_vector_store_index(
+            limit=int(limit) if limit is not None else None,
+            offset=int(self.query.get("offset", 0)),
+            **filters,
+        )
+        total = RagService.count_vector_store_index(**filters)
+        self._reply(200, {"indexes": entries, "total": total})
+
+    def _create_index(self) -> None:
+        destination = None
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            document_path = self._document_path(self._read_json().get("document_path"))
+        else:
+            # Uploaded documents are stored like the uploads of the Streamlit app
+            filename = Path(self.query.get("filename", "")).name
+            if not filename:
+                raise HTTPError(400, "The filename query parameter is missing.")
+            destination = Path(DATA_PATH) / filename
+            document_path = self._read_upload(filename)
+
+        # A document with the same name is a new version of an indexed document
+        entries = RagService.list_vector_store_index(
+            document_name=document_path.name, limit=1
+        )
+        index_id = entries[0]["index_id"] if entries else None
+        job_id = IngestionQueue.submit(
+            document_path, index_id=index_id, destination=destination
+        )
+        self._reply(202, IngestionQueue.status(job_id))
+
+    def _document_path(self, document_path: Optional[str]) -> Path:
+        """
+        Resolve a document path sent by the client, relative paths being relative to
+        the documents root of the server.
+        :param document_path: The path from the request body.
+        :return: The resolved path, an existing file under the documents root.
+        """
+        if not document_path:
+            raise HTTPError(400, "The document_path is missing.")
+        root = self.server.documents_root
+        # resolve() follows symlinks and "..", so the check is on the real location
+        resolved = (root / document_path).resolve()
+        if not resolved.is_relative_to(root):
+            raise HTTPError(403, f"{document_path!r} is outside the documents root.")
+        if not resolved.is_file():
+            raise HTTPError(400, f"No document at {document_path!r}.")
+        return resolved
+
+    def _read_upload(self, filename: str) -> Path:
+        """
+        Write the body of the request to a staging file, see staging_upload_path.
+        The ingestion job moves it to DATA_PATH once hashed, so a partial or
+        duplicate upload never replaces a document.
+        :return: The path of the staging file.
+        """
+        if "Content-Length" not in self.headers:
+            raise HTTPError(411, "The Content-Length header is missing.")
+        length = int(self.headers["Content-Length"])
+        if length > self.server.max_upload_size:
+            # The body is not read, the connection cannot be reused
+            self.close_connection = True
+            raise HTTPError(
+                413,
+                f"The document is larger than {self.server.max_upload_size} bytes.",
+            )
+
+        staging_path = staging_upload_path(filename)
+        try:
+            with open(staging_path, "wb") as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        raise HTTPError(400, "The body ended before Content-Length.")
+                    f.write(chunk)
+                    remaining -= len(chunk)
+        except BaseException:
+            shutil.rmtree(staging_path.parent, ignore_errors=True)
+            raise
+        return staging_path
+
+    def _delete_index(self, index_id: str) -> None:
+        self._run(RagService.delete_vector_store_index, index_id)
+        self._reply(200, {"index_id": index_id, "deleted": True})
+
+    def _list_jobs(self) -> None:
+        self._reply(200, {"jobs": IngestionQueue.list_jobs()})
+
+    def _job_status(self, job_id: str) -> None:
+        self._reply(200, IngestionQueue.status(job_id))
+
+    def _retry_job(self, job_id: str) -> None:
+        IngestionQueue.retry(job_id)
+        self._reply(202, IngestionQueue.status(job_id))
+
+    def _summarize_index(self, index_id: str) -> None:
+        def summarize() -> Dict[str, str]:
+            language = RagService.detect_document_language(index_id)
+            if language != "fr":
+                # Only the first page of a document which is not in french
+                summary = RagService.translate_and_summarize_first_page_fr(index_id)
+            else:
+                summary = RagService.summarize_document_index(index_id)
+            return {"index_id": index_id, "language": language, "summary": summary}
+
+        self._reply(200, self._run(summarize))
+
+    def _summarize(self) -> None:
+        text = self._read_json().get("text")
+        if not text:
+            raise HTTPError(400, "The text to summarize is missing.")
+        self._reply(200, {"summary": self._run(RagService.summarize_content, text)})
+
+    def _chat(self) -> None:
+        body = self._read_json()
+        query, index_ids = body.get("query"), body.get("index_ids")
+        if not query or not index_ids:
+            raise HTTPError(400, "query and index_ids are required.")
+        history = [
+            ChatMessage(role=MessageRole(message["role"]), content=message["content"])
+            for message in body.get("history", [])
+        ]
+
+        # Retrieval runs in the worker pool, the tokens then stream from the LLM
+        stream = self._run(
+            RagService.stream_chat,
+            query,
+            history,
+            index_ids,
+            system_prompt=body.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
+            retrieval_mode=body.get("retrieval_mode", DEFAULT_RAG_RETRIEVAL_MODE),
+        )
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        self._write_line({"sources": [_source_to_dict(n) for n in stream.source_nodes]})
+        try:
+            # The tokens are pulled by a worker of the pool until the last one
+            tokens = _iter_with_timeout(
+                stream,
+                self.server.request_timeout,
+                self.server.token_timeout,
+                self.server.workers,
+            )
+            with closing(tokens):
+                for token in tokens:
+                    self._write_line({"token": token})
+        except TimeoutError as e:
+            # The status line is already sent, the error ends the stream
+            self._write_line({"error": str(e)})
+            return
+        self._write_line(
+            {
+                "done": True,
+                "time_to_first_token": stream.time_to_first_token,
+                "total_time": stream.total_time,
+            }
+        )
+
+    def _write_line(self, payload: Dict[str, Any]) -> None:
+        self.wfile.write(
+            json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n"
+        )
+        self.wfile.flush()
+
+    def log_message(self, format: str, *args) -> None:
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+class RagHTTPServer(ThreadingHTTPServer):
+    """
+    One thread per connection, the work being done by a bounded worker pool.
+    The RagService singleton, and the indexes it keeps loaded, live as long as the
+    server.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        workers: int = DEFAULT_SERVER_WORKERS,
+        request_timeout: float = DEFAULT_SERVER_REQUEST_TIMEOUT,
+        token_timeout: float = DEFAULT_SERVER_TOKEN_TIMEOUT,
+        max_upload_size: int = DEFAULT_SERVER_MAX_UPLOAD_SIZE,
+        documents_root: Path = DEFAULT_SERVER_DOCUMENTS_ROOT,
+    ):
+        super().__init__(address, _RagRequestHandler)
+        self.workers = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="rag-server"
+        )
+        self.request_timeout = request_timeout
+        self.token_timeout = token_timeout
+        self.max_upload_size = max_upload_size
+        self.documents_root = Path(documents_root).resolve()
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.workers.shutdown(wait=False)
+
+
+def warm_up(num_indexes: int) -> List[str]:
+    """
+    Load the most recent indexes, so that the first chats do not read them from disk.
+    :param num_indexes: The number of indexes to load.
+    :return: The ids of the loaded indexes.
+    """
+    total = RagService.count_vector_store_index()
+    entries = RagService.list_vector_store_index(
+        limit=num_indexes, offset=max(0, total - num_indexes)
+    )
+    index_ids = [entry["index_id"] for entry in entries]
+    for index_id in index_ids:
+        try:
+            RagService.build_retrieval([index_id])
+        except Exception:
+            logger.warning(
+                "Could not load index %s\n%s", index_id, traceback.format_exc()
+            )
+    return index_ids
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default=DEFAULT_SERVER_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_SERVER_WORKERS)
+    parser.add_argument(
+        "--request-timeout", type=float, default=DEFAULT_SERVER_REQUEST_TIMEOUT
+    )
+    parser.add_argument(
+        "--token-timeout", type=float, default=DEFAULT_SERVER_TOKEN_TIMEOUT
+    )
+    parser.add_argument("--warm", type=int, default=DEFAULT_SERVER_WARM_INDEXES)
+    parser.add_argument(
+        "--max-upload-size",
+        type=int,
+        default=DEFAULT_SERVER_MAX_UPLOAD_SIZE,
+        help="Largest uploaded document, in bytes",
+    )
+    parser.add_argument(
+        "--documents-root",
+        type=Path,
+        default=DEFAULT_SERVER_DOCUMENTS_ROOT,
+        help="Directory of the documents that can be indexed by path",
+    )
+    parser.add_argument(
+        "--instrument",
+        action="store_true",
+        help="Record the spans of the RagService, served at /metrics",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.instrument:
+        enable_default_sinks()
+
+    server = RagHTTPServer(
+        (args.host, args.port),
+        workers=args.workers,
+        request_timeout=args.request_timeout,
+        token_timeout=args.token_timeout,
+        max_upload_size=args.max_upload_size,
+        documents_root=args.documents_root,
+    )
+    if args.warm:
+        # Requests are served meanwhile, they load what they need themselves
+        threading.Thread(target=warm_up, args=(args.warm,), daemon=True).start()
+    print(f"RagService listening on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import asyncio
+import threading
+import time
+import weakref
+from typing import AsyncGenerator, List, Optional, Tuple
+
+from llama_index.core.base.llms.types import ChatResponse
+from llama_index.core.chat_engine.context import DEFAULT_CONTEXT_TEMPLATE
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from advanced_chatbot.config import (
+    DEFAULT_ASYNC_MAX_DOCUMENT_CALLS,
+    DEFAULT_ASYNC_MAX_LLM_CALLS,
+    DEFAULT_ASYNC_MAX_RETRIEVALS,
+    DEFAULT_RAG_RETRIEVAL_MODE,
+    DEFAULT_RAG_TOKEN_LIMIT,
+)
+from advanced_chatbot.services.chat_stream import AsyncChatStream
+from advanced_chatbot.services.conversation_memory import ConversationMemory
+from advanced_chatbot.services.rag_service import (
+    DEFAULT_SYSTEM_PROMPT,
+    SUMMARIZATION_PROMPT,
+    RagService,
+    _RagService,
+)
+
+
+class _AsyncRagService:
+    """
+    Asyncio API of the RagService, for many conversations sharing one event loop.
+
+    It shares the loaded indexes, the caches and the models of the wrapped
+    RagService. Embedding and LLM calls are awaited. Loading indexes from disk, the
+    top-k, the postprocessing of the retrieved nodes and computing the cached
+    document insights are blocking, they run in worker threads. At most
+    max_retrievals retrievals and max_llm_calls LLM calls run at once, the other
+    ones wait for a free slot.
+    Summarizing a document and detecting its language are coarse-grained: each one
+    is a blocking call making several LLM calls of its own. They take one of the
+    max_document_calls slots for their whole duration instead of an LLM slot.
+    The slots are created per event loop, on first use: a semaphore can only be
+    awaited from the loop it was first awaited in.
+    """
+
+    def __init__(
+        self,
+        rag_service: _RagService,
+        max_retrievals: int,
+        max_llm_calls: int,
+        max_document_calls: int,
+    ):
+        self._rag_service = rag_service
+        self._max_slots = {
+            "retrieval": max_retrievals,
+            "llm": max_llm_calls,
+            "document": max_document_calls,
+        }
+        # Event loop -> its semaphores, forgotten with the loop
+        self._loop_slots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def __semaphore(self, kind: str) -> asyncio.Semaphore:
+        """
+        :param kind: "retrieval", "llm" or "document".
+        :return: The semaphore of :kind of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            slots = self._loop_slots.get(loop)
+            if slots is None:
+                slots = {
+                    name: asyncio.Semaphore(value)
+                    for name, value in self._max_slots.items()
+                }
+                self._loop_slots[loop] = slots
+            return slots[kind]
+
+    async def aretrieve(
+        self,
+        query: str,
+        index_ids: List[str],
+        retrieval_mode: str = DEFAULT_RAG_RETRIEVAL_MODE,
+    ) -> List[NodeWithScore]:
+        """
+        Retrieve the context of a query, every sentence replaced by its window.
+        :param query: The user query.
+        :param index_ids: The ids of the indexes to search.
+        :param retrieval_mode: "matrix" or "fusion", see DEFAULT_RAG_RETRIEVAL_MODE.
+        :return: The retrieved nodes, best first.
+        """
+        async with self.__semaphore("retrieval"):
+            retriever, node_postprocessors = await asyncio.to_thread(
+                self._rag_service.build_retrieval, index_ids, retrieval_mode
+            )
+            nodes = await retriever.aretrieve(query)
+            # Rebuilding the windows and assembling the context read the docstores
+            # and tokenize, in a worker thread too
+            return await asyncio.to_thread(
+                self.__postprocess, nodes, node_postprocessors, query
+            )
+
+    @staticmethod
+    def __postprocess(
+        nodes: List[NodeWithScore],
+        node_postprocessors: List[BaseNodePostprocessor],
+        query: str,
+    ) -> List[NodeWithScore]:
+        for postprocessor in node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(
+                nodes, query_bundle=QueryBundle(query)
+            )
+        return nodes
+
+    async def astream_chat(
+        self,
+        query: str,
+        conversation_history: List[ChatMessage],
+        index_ids: List[str],
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+        retrieval_mode: str = DEFAULT_RAG_RETRIEVAL_MODE,
+        memory: Optional[ConversationMemory] = None,
+    ) -> AsyncChatStream:
+        """
+        Generate a response to a given question, streamed as the LLM produces it.
+        The prompt is the one of RagService.stream_chat.
+        Parameters are the same as RagService.complete_chat.
+        :return: AsyncChatStream : An async iterable of tokens. It holds an LLM slot
+        until it is exhausted or closed. The query and the answer are added to the
+        memory together once the stream is exhausted, a failed or closed stream
+        leaves the memory as it was.
+        """
+        started_at = time.perf_counter()
+        source_nodes = await self.aretrieve(query, index_ids, retrieval_mode)
+        if memory is None:
+            # Without a memory kept across turns, the history is only truncated
+            memory = ConversationMemory(
+                chat_history=conversation_history, token_limit=DEFAULT_RAG_TOKEN_LIMIT
+            )
+        question = ChatMessage(role=MessageRole.USER, content=query)
+        messages = self.__chat_messages(question, memory, source_nodes, system_prompt)
+
+        llm_slots = self.__semaphore("llm")
+        await llm_slots.acquire()
+        try:
+            response_gen = await self._rag_service.llm.astream_chat(messages)
+        except BaseException:
+            llm_slots.release()
+            raise
+
+        return AsyncChatStream(
+            token_gen=self.__tokens(response_gen, memory, question),
+            source_nodes=source_nodes,
+            started_at=started_at,
+            on_close=llm_slots.release,
+        )
+
+    async def acomplete_chat(
+        self,
+        query: str,
+        conversation_history: List[ChatMessage],
+        index_ids: List[str],
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+        retrieval_mode: str = DEFAULT_RAG_RETRIEVAL_MODE,
+        memory: Optional[ConversationMemory] = None,
+    ) -> Tuple[AsyncGenerator[str, None], List[NodeWithScore]]:
+        """
+        Asynchronous RagService.complete_chat.
+        :return: A tuple (async generator of the tokens, source nodes).
+        """
+        stream = await self.astream_chat(
+            query,
+            conversation_history,
+            index_ids,
+            system_prompt=system_prompt,
+            retrieval_mode=retrieval_mode,
+            memory=memory,
+        )
+        return stream.__aiter__(), stream.source_nodes
+
+    async def asummarize_content(self, input_content: str) -> str:
+        """
+        Asynchronous RagService.summarize_content.
+        """
+        async with self.__semaphore("llm"):
+            return await self._rag_service.llm.apredict(
+                SUMMARIZATION_PROMPT, source_text=input_content
+            )
+
+    async def asummarize_document_index(self, index_id: str) -> str:
+        """
+        Asynchronous RagService.summarize_document_index, holding a document slot.
+        """
+        async with self.__semaphore("document"):
+            return await asyncio.to_thread(
+                self._rag_service.summarize_document_index, index_id
+            )
+
+    async def atranslate_and_summarize_first_page_fr(self, index_id: str) -> str:
+        """
+        Asynchronous RagService.translate_and_summarize_first_page_fr, holding a
+        document slot.
+        """
+        async with self.__semaphore("document"):
+            return await asyncio.to_thread(
+                self._rag_service.translate_and_summarize_first_page_fr, index_id
+            )
+
+    async def adetect_document_language(self, index_id: str) -> str:
+        """
+        Asynchronous RagService.detect_document_language, holding a document slot.
+        """
+        async with self.__semaphore("document"):
+            return await asyncio.to_thread(
+                self._rag_service.detect_document_language, index_id
+            )
+
+    def __chat_messages(
+        self,
+        question: ChatMessage,
+        memory: ConversationMemory,
+        source_nodes: List[NodeWithScore],
+        system_prompt: str,
+    ) -> List[ChatMessage]:
+        """
+        Build the messages sent to the LLM the way ContextChatEngine does: the system
+        prompt followed by the context, then the history of the memory, the query
+        being the last message.
+        """
+        context_str = "\n\n".join(
+            n.node.get_content(metadata_mode=MetadataMode.LLM).strip()
+            for n in source_nodes
+        )
+        system_message = ChatMessage(
+            role=self._rag_service.llm.metadata.system_role,
+            content=system_prompt.strip()
+            + "\n"
+            + DEFAULT_CONTEXT_TEMPLATE.format(context_str=context_str),
+        )
+        # The question is only put in the memory with its answer, see __tokens
+        initial_token_count = len(
+            memory.tokenizer_fn(system_message.content)
+        ) + memory.count_tokens(question)
+        history = memory.get(initial_token_count=initial_token_count)
+        return [system_message] + history + [question]
+
+    @staticmethod
+    async def __tokens(
+        response_gen: AsyncGenerator[ChatResponse, None],
+        memory: ConversationMemory,
+        question: ChatMessage,
+    ) -> AsyncGenerator[str, None]:
+        tokens = []
+        async for response in response_gen:
+            if response.delta:
+                tokens.append(response.delta)
+                yield response.delta
+        # Not reached when the LLM fails or the stream is closed before its end
+        memory.put(question)
+        memory.put(ChatMessage(role=MessageRole.ASSISTANT, content="".join(tokens)))
+
+
+AsyncRagService = _AsyncRagService(
+    RagService,
+    max_retrievals=DEFAULT_ASYNC_MAX_RETRIEVALS,
+    max_llm_calls=DEFAULT_ASYNC_MAX_LLM_CALLS,
+    max_document_calls=DEFAULT_ASYNC_MAX_DOCUMENT_CALLS,
+)  # Singleton instance sharing the indexes of RagService
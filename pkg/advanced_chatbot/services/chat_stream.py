@@ -0,0 +1,116 @@
+import logging
+import time
+from typing import (
+    AsyncGenerator,
+    AsyncIterable,
+    Callable,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+)
+
+from llama_index.core.schema import NodeWithScore
+
+logger = logging.getLogger(__name__)
+
+
+class ChatStream:
+    """
+    Answer of a chat turn streamed token by token as the LLM produces them.
+
+    The retrieved source nodes are available as soon as the stream is created,
+    before the first token. Time-to-first-token and total time are measured from
+    :started_at, the beginning of the turn (retrieval included). :on_complete is
+    called with the stream once its last token is out.
+    """
+
+    def __init__(
+        self,
+        token_gen: Iterable[str],
+        source_nodes: List[NodeWithScore],
+        started_at: float,
+        on_complete: Optional[Callable[["ChatStream"], None]] = None,
+    ):
+        self._token_gen = token_gen
+        self._on_complete = on_complete
+        self.source_nodes = source_nodes
+        self.started_at = started_at
+        self.time_to_first_token: Optional[float] = None
+        self.total_time: Optional[float] = None
+        self.response = ""
+
+    def __iter__(self) -> Generator[str, None, None]:
+        tokens = []
+        for token in self._token_gen:
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.perf_counter() - self.started_at
+                logger.info("Time to first token: %.3f s", self.time_to_first_token)
+            tokens.append(token)
+            yield token
+
+        self.total_time = time.perf_counter() - self.started_at
+        self.response = "".join(tokens)
+        logger.info("Chat turn completed in %.3f s", self.total_time)
+        if self._on_complete is not None:
+            self._on_complete(self)
+
+    def close(self) -> None:
+        """
+        Stop the stream before its last token.
+        """
+        if hasattr(self._token_gen, "close"):
+            self._token_gen.close()
+
+
+class AsyncChatStream:
+    """
+    Asynchronous counterpart of ChatStream, iterated with async for.
+
+    :on_close is called once, when the tokens are exhausted or when the stream is
+    closed with aclose(). A stream that is not consumed must be closed.
+    """
+
+    def __init__(
+        self,
+        token_gen: AsyncIterable[str],
+        source_nodes: List[NodeWithScore],
+        started_at: float,
+        on_close: Optional[Callable[[], None]] = None,
+    ):
+        self._token_gen = token_gen
+        self._on_close = on_close
+        self.source_nodes = source_nodes
+        self.started_at = started_at
+        self.time_to_first_token: Optional[float] = None
+        self.total_time: Optional[float] = None
+        self.response = ""
+
+    async def __aiter__(self) -> AsyncGenerator[str, None]:
+        tokens = []
+        try:
+            async for token in self._token_gen:
+                if self.time_to_first_token is None:
+                    self.time_to_first_token = time.perf_counter() - self.started_at
+                    logger.info("Time to first token: %.3f s", self.time_to_first_token)
+                tokens.append(token)
+                yield token
+        finally:
+            self._close()
+
+        self.total_time = time.perf_counter() - self.started_at
+        self.response = "".join(tokens)
+        logger.info("Chat turn completed in %.3f s", self.total_time)
+
+    async def aclose(self) -> None:
+        """
+        Stop the stream before its last token.
+        """
+        if hasattr(self._token_gen, "aclose"):
+            await self._token_gen.aclose()
+        self._close()
+
+    def _close(self) -> None:
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
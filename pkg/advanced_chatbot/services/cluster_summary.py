@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Sequence
+
+import numpy as np
+
+from advanced_chatbot.services.ivf_index import spherical_kmeans
+from advanced_chatbot.services.quantization import normalize
+
+# Rows scored at once, bounds the size of the temporary score matrices
+_BLOCK_ROWS = 16384
+
+
+def representative_rows(
+    embeddings: np.ndarray, num_clusters: int, rows_per_cluster: int, seed: int = 0
+) -> List[List[int]]:
+    """
+    Cluster the embeddings of a document and pick the rows closest to every
+    centroid, the chunks which best represent a topic of the document.
+    The same embeddings and seed always give the same rows.
+    :param embeddings: The embeddings of the chunks, in document order.
+    :param num_clusters: The number of clusters, at most one per row.
+    :param rows_per_cluster: The number of rows picked per cluster.
+    :param seed: The seed of the k-means sampling.
+    :return: For every non-empty cluster, its picked rows closest first. Clusters
+    come in document order, the one with the earliest row first.
+    """
+    if not len(embeddings):
+        return []
+    centroids = spherical_kmeans(embeddings, num_clusters, seed=seed)
+
+    assignments = np.empty(len(embeddings), dtype=np.int64)
+    similarities = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), _BLOCK_ROWS):
+        scores = normalize(embeddings[start : start + _BLOCK_ROWS]) @ centroids.T
+        closest = np.argmax(scores, axis=1)
+        assignments[start : start + len(scores)] = closest
+        similarities[start : start + len(scores)] = scores[
+            np.arange(len(scores)), closest
+        ]
+
+    clusters = []
+    for cluster in np.unique(assignments):
+        members = np.flatnonzero(assignments == cluster)
+        # Stable sort: ties go to the earliest row
+        closest = members[np.argsort(-similarities[members], kind="stable")]
+        clusters.append([int(row) for row in closest[:rows_per_cluster]])
+    return sorted(clusters, key=min)
+
+
+def fit_token_budget(
+    texts: Sequence[str], max_tokens: int, tokenizer: Callable[[str], List]
+) -> List[str]:
+    """
+    :param texts: Texts, most important first.
+    :param max_tokens: The token budget.
+    :param tokenizer: Tokenizes a text.
+    :return: The first texts whose tokens fit in the budget, at least the first one.
+    """
+    kept, used = [], 0
+    for text in texts:
+        tokens = len(tokenizer(text))
+        if kept and used + tokens > max_tokens:
+            break
+        kept.append(text)
+        used += tokens
+    return kept
+
+
+def map_reduce_summary(
+    parts: Sequence[str],
+    summarize_part: Callable[[str], str],
+    merge: Callable[[str], str],
+    max_workers: int,
+) -> str:
+    """
+    Summarize every part concurrently, then merge the partial summaries.
+    :param parts: The texts to summarize separately.
+    :param summarize_part: Summarizes one part (the map step).
+    :param merge: Summarizes the partial summaries joined in the order of the parts
+    (the reduce step).
+    :param max_workers: The maximum number of parts summarized at once.
+    :return: The merged summary.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        partial_summaries = list(executor.map(summarize_part, parts))
+    return merge("\n".join(summary.strip() for summary in partial_summaries))
@@ -0,0 +1,218 @@
+import re
+from typing import Callable, Dict, FrozenSet, List, Optional, Sequence
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+from llama_index.core.utils import get_tokenizer
+
+from advanced_chatbot.config import (
+    DEFAULT_CONTEXT_DUPLICATE_THRESHOLD,
+    DEFAULT_CONTEXT_TOKEN_BUDGET,
+)
+from advanced_chatbot.services.instrumentation import Instrumentation
+from advanced_chatbot.services.sentence_window import (
+    WINDOW_RANGE_METADATA_KEY,
+    SentenceWindowPostProcessor,
+)
+
+# Ids of the retrieved nodes whose text a node also carries, merged or duplicates
+MERGED_NODE_IDS_METADATA_KEY = "merged_node_ids"
+
+_WORD_PATTERN = re.compile(r"\w+")
+_SHINGLE_SIZE = 3
+
+
+def _score(n: NodeWithScore) -> float:
+    return n.score if n.score is not None else 0.0
+
+
+def _add_merged_node_ids(n: NodeWithScore, node_ids: Sequence[str]) -> None:
+    node = n.node
+    merged = node.metadata.setdefault(MERGED_NODE_IDS_METADATA_KEY, [])
+    merged.extend(node_ids)
+    for excluded_keys in (
+        node.excluded_llm_metadata_keys,
+        node.excluded_embed_metadata_keys,
+    ):
+        if MERGED_NODE_IDS_METADATA_KEY not in excluded_keys:
+            excluded_keys.append(MERGED_NODE_IDS_METADATA_KEY)
+
+
+def merge_window_ranges(nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+    """
+    Merge the overlapping or adjacent windows of every page into one window, before
+    their text is read. The merged window is the union of their ranges, carried by
+    the best scored node of the run, the ids of the other nodes being kept in its
+    metadata. Nodes without a window range are left as they are, the nodes of
+    indexes built before window ranges need their range derived first, see
+    SentenceWindowPostProcessor._derive_window_ranges.
+    :param nodes: The retrieved sentence nodes, best first.
+    :return: The remaining nodes, in the same order.
+    """
+    pages: Dict[str, List[NodeWithScore]] = {}
+    for n in nodes:
+        if WINDOW_RANGE_METADATA_KEY in n.node.metadata and n.node.ref_doc_id:
+            pages.setdefault(n.node.ref_doc_id, []).append(n)
+
+    merged_away = set()
+    for page_nodes in pages.values():
+        page_nodes.sort(key=lambda n: n.node.metadata[WINDOW_RANGE_METADATA_KEY][0])
+        runs, end = [], None
+        for n in page_nodes:
+            start, stop = n.node.metadata[WINDOW_RANGE_METADATA_KEY]
+            # Windows sharing a sentence or touching each other
+            if end is not None and start <= end:
+                runs[-1].append(n)
+                end = max(end, stop)
+            else:
+                runs.append([n])
+                end = stop
+
+        for run in runs:
+            if len(run) == 1:
+                continue
+            best = max(run, key=_score)
+            ranges = [n.node.metadata[WINDOW_RANGE_METADATA_KEY] for n in run]
+            best.node.metadata[WINDOW_RANGE_METADATA_KEY] = [
+                min(r[0] for r in ranges),
+                max(r[1] for r in ranges),
+            ]
+            others = [n for n in run if n is not best]
+            _add_merged_node_ids(best, [n.node.node_id for n in others])
+            merged_away.update(id(n) for n in others)
+
+    return [n for n in nodes if id(n) not in merged_away]
+
+
+def shingles(text: str) -> FrozenSet:
+    """
+    :return: The sequences of 3 consecutive words of the text, lowercased. The words
+    themselves for texts of less than 3 words.
+    """
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < _SHINGLE_SIZE:
+        return frozenset(words)
+    return frozenset(
+        tuple(words[i : i + _SHINGLE_SIZE])
+        for i in range(len(words) - _SHINGLE_SIZE + 1)
+    )
+
+
+def containment(inner: FrozenSet, outer: FrozenSet) -> float:
+    """
+    :return: The fraction of the shingles of :inner found in :outer, 1 for an exact
+    duplicate or a passage of :outer.
+    """
+    if not inner:
+        return 1.0
+    return len(inner & outer) / len(inner)
+
+
+class ContextAssemblyPostProcessor(SentenceWindowPostProcessor):
+    """
+    Assemble the context of a chat turn from the retrieved sentence nodes.
+
+    Neighbouring sentences retrieved together have overlapping windows, which would
+    send the same text to the LLM several times. Here:
+    - overlapping or adjacent windows of the same page are merged into one, the
+      window ranges of nodes of indexes built before them being derived from the
+      order of the page sentences in the docstore,
+    - every sentence is replaced by its window, see SentenceWindowPostProcessor,
+    - windows mostly contained in a better scored one are dropped (exact and near
+      duplicates, e.g. the same passage in two documents),
+    - the best windows are packed in token_budget tokens.
+    Every node kept is a retrieved node with its own metadata and score, the ids of
+    the nodes it stands for are listed in its "merged_node_ids" metadata.
+    """
+
+    token_budget: int = Field(
+        default=DEFAULT_CONTEXT_TOKEN_BUDGET,
+        description="Tokens of the context, metadata included.",
+    )
+    duplicate_threshold: float = Field(
+        default=DEFAULT_CONTEXT_DUPLICATE_THRESHOLD,
+        description="Containment above which a window is a duplicate.",
+    )
+
+    _tokenizer_fn: Callable[[str], List] = PrivateAttr()
+
+    def __init__(
+        self,
+        docstores: Sequence[BaseDocumentStore],
+        tokenizer_fn: Optional[Callable[[str], List]] = None,
+        **kwargs,
+    ):
+        """
+        :param docstores: The docstores of the searched indexes.
+        :param tokenizer_fn: Tokenizes the context, the one of the LLM by default.
+        """
+        super().__init__(docstores, **kwargs)
+        self._tokenizer_fn = tokenizer_fn or get_tokenizer()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextAssemblyPostProcessor"
+
+    def _drop_duplicates(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        kept, kept_shingles = [], []
+        for n in nodes:
+            node_shingles = shingles(
+                n.node.get_content(metadata_mode=MetadataMode.NONE)
+            )
+            for better, better_shingles in zip(kept, kept_shingles):
+                if (
+                    containment(node_shingles, better_shingles)
+                    >= self.duplicate_threshold
+                ):
+                    _add_merged_node_ids(
+                        better,
+                        [n.node.node_id]
+                        + n.node.metadata.get(MERGED_NODE_IDS_METADATA_KEY, []),
+                    )
+                    break
+            else:
+                kept.append(n)
+                kept_shingles.append(node_shingles)
+        return kept
+
+    def _pack(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """
+        :return: The best nodes whose text fits in the token budget, at least the
+        best one. A node too long for the remaining budget is skipped, a shorter
+        one after it may still fit.
+        """
+        packed, used = [], 0
+        for n in nodes:
+            tokens = len(
+                self._tokenizer_fn(n.node.get_content(metadata_mode=MetadataMode.LLM))
+            )
+            if packed and used + tokens > self.token_budget:
+                continue
+            packed.append(n)
+            used += tokens
+        Instrumentation.annotate(context_tokens=used)
+        return packed
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        with Instrumentation.span("assemble_context", retrieved=len(nodes)) as span:
+            nodes = sorted(nodes, key=_score, reverse=True)
+            # Sentences and pages read from the docstores, each one read once
+            texts, pages = {}, {}
+            self._derive_window_ranges(nodes, texts, pages)
+            merged = merge_window_ranges(nodes)
+            with Instrumentation.span("postprocess", nodes=len(merged)):
+                windows = self._replace_by_windows(merged, texts, pages)
+            unique = self._drop_duplicates(windows)
+            packed = self._pack(unique)
+            span.set(
+                merged=len(nodes) - len(merged),
+                duplicates=len(windows) - len(unique),
+                over_budget=len(unique) - len(packed),
+                nodes=len(packed),
+            )
+        return packed
@@ -0,0 +1,313 @@
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+from llama_index.core import ChatPromptTemplate
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms import LLM, ChatMessage, MessageRole
+from llama_index.core.memory.types import BaseMemory
+from llama_index.core.utils import get_tokenizer
+
+from advanced_chatbot.config import (
+    DEFAULT_MEMORY_RECENT_TOKEN_LIMIT,
+    DEFAULT_MEMORY_SUMMARY_MAX_WORDS,
+    DEFAULT_RAG_TOKEN_LIMIT,
+)
+from advanced_chatbot.services.instrumentation import Instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+CONVERSATION_SUMMARY_SYSTEM_PROMPT = """
+You maintain the summary of a conversation between a user and an assistant about
+some documents. You will be given the current summary, possibly empty, and the
+messages that followed it.
+Write the updated summary in french, in at most {max_words} words. Keep the questions
+of the user, the facts, names and figures of the answers and what was left open.
+Directly provide the summary and nothing else.
+"""
+
+CONVERSATION_SUMMARY_USER_PROMPT = """
+#Current summary:
+{summary}
+
+#Messages:
+{messages}
+"""
+
+# Prompt folding the oldest messages of a conversation into its summary
+CONVERSATION_SUMMARY_PROMPT = ChatPromptTemplate(
+    message_templates=[
+        ChatMessage(
+            role=MessageRole.SYSTEM, content=CONVERSATION_SUMMARY_SYSTEM_PROMPT
+        ),
+        ChatMessage(role=MessageRole.USER, content=CONVERSATION_SUMMARY_USER_PROMPT),
+    ]
+)
+
+# Header of the summary message sent before the latest messages
+SUMMARY_MESSAGE_HEADER = "Summary of the earlier conversation:\n"
+
+
+class ConversationMemory(BaseMemory):
+    """
+    Memory of one conversation, kept across its turns.
+
+    The latest messages are kept verbatim while they fit in recent_token_limit
+    tokens. Once they overflow, the oldest turns are folded by the LLM into a running
+    summary, in a background thread so that no turn waits for it. get() returns the
+    summary followed by the latest messages that fit in token_limit.
+    Every message is tokenized once, when it is added: the cost of a turn does not
+    grow with the length of the conversation.
+    Without an LLM nothing is summarized, the oldest messages are dropped.
+    """
+
+    token_limit: int = Field(
+        default=DEFAULT_RAG_TOKEN_LIMIT,
+        description="Tokens of the prompt available to the history.",
+    )
+    recent_token_limit: int = Field(
+        default=DEFAULT_MEMORY_RECENT_TOKEN_LIMIT,
+        description="Tokens of the messages kept verbatim.",
+    )
+    summary_max_words: int = Field(
+        default=DEFAULT_MEMORY_SUMMARY_MAX_WORDS,
+        description="Words of the running summary.",
+    )
+
+    _llm: Optional[LLM] = PrivateAttr()
+    _tokenizer_fn: Callable[[str], List] = PrivateAttr()
+    _messages: List[ChatMessage] = PrivateAttr()
+    _token_counts: List[int] = PrivateAttr()
+    _total_tokens: int = PrivateAttr()
+    _summary: str = PrivateAttr()
+    _summary_tokens: int = PrivateAttr()
+    # Incremented by set() and reset(), a summary of the previous messages is dropped
+    _generation: int = PrivateAttr()
+    _compressing: bool = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+
+    def __init__(
+        self,
+        llm: Optional[LLM] = None,
+        chat_history: Optional[List[ChatMessage]] = None,
+        tokenizer_fn: Optional[Callable[[str], List]] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._llm = llm
+        self._tokenizer_fn = tokenizer_fn or get_tokenizer()
+        self._messages = []
+        self._token_counts = []
+        self._total_tokens = 0
+        self._summary = ""
+        self._summary_tokens = 0
+        self._generation = 0
+        self._compressing = False
+        self._lock = threading.Lock()
+        if chat_history:
+            self.set(chat_history)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ConversationMemory"
+
+    @classmethod
+    def from_defaults(
+        cls,
+        chat_history: Optional[List[ChatMessage]] = None,
+        llm: Optional[LLM] = None,
+    ) -> "ConversationMemory":
+        return cls(llm=llm, chat_history=chat_history)
+
+    @property
+    def tokenizer_fn(self) -> Callable[[str], List]:
+        return self._tokenizer_fn
+
+    @property
+    def summary(self) -> str:
+        """
+        The summary of the messages no longer kept verbatim, empty if none.
+        """
+        return self._summary
+
+    def count_tokens(self, message: ChatMessage) -> int:
+        """
+        :return: The tokens a message takes in the history.
+        """
+        return len(self._tokenizer_fn(f"{message.role.value}: {message.content or ''}"))
+
+    def _summary_message(self) -> ChatMessage:
+        return ChatMessage(
+            role=MessageRole.SYSTEM, content=SUMMARY_MESSAGE_HEADER + self._summary
+        )
+
+    def get(self, initial_token_count: int = 0, **kwargs) -> List[ChatMessage]:
+        """
+        :param initial_token_count: The tokens of the prompt already taken, by the
+        system prompt and the context.
+        :return: The summary, if it fits, then the latest messages that fit in the
+        remaining tokens of token_limit. The first message is never an answer.
+        """
+        if initial_token_count > self.token_limit:
+            raise ValueError("Initial token count exceeds token limit")
+
+        with self._lock:
+            available = self.token_limit - initial_token_count
+            with_summary = bool(self._summary) and self._summary_tokens <= available
+            if with_summary:
+                available -= self._summary_tokens
+
+            start = len(self._messages)
+            while start > 0 and self._token_counts[start - 1] <= available:
+                available -= self._token_counts[start - 1]
+                start -= 1
+            # The history starts with a question, like the one of ChatMemoryBuffer
+            while start < len(self._messages) and self._messages[start].role in (
+                MessageRole.ASSISTANT,
+                MessageRole.TOOL,
+            ):
+                start += 1
+
+            messages = self._messages[start:]
+            Instrumentation.annotate(
+                history_messages=len(messages),
+                history_tokens=sum(self._token_counts[start:]),
+                history_summary_tokens=self._summary_tokens if with_summary else 0,
+            )
+            if with_summary:
+                return [self._summary_message()] + messages
+            return messages
+
+    def get_all(self) -> List[ChatMessage]:
+        """
+        :return: The summary, if any, then every message kept verbatim.
+        """
+        with self._lock:
+            if self._summary:
+                return [self._summary_message()] + self._messages
+            return list(self._messages)
+
+    def put(self, message: ChatMessage) -> None:
+        """
+        Add a message. Folds the oldest messages into the summary, in the
+        background, when the messages kept verbatim overflow recent_token_limit.
+        """
+        token_count = self.count_tokens(message)
+        with self._lock:
+            self._messages.append(message)
+            self._token_counts.append(token_count)
+            self._total_tokens += token_count
+            if not self._compressing:
+                self._drop_unreachable()
+            start_compression = (
+                self._total_tokens > self.recent_token_limit
+                and self._llm is not None
+                and not self._compressing
+            )
+            if start_compression:
+                self._compressing = True
+        if start_compression:
+            threading.Thread(
+                target=self.compress, name="conversation-summary", daemon=True
+            ).start()
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        """
+        Replace the conversation, its summary included. Does not summarize.
+        """
+        token_counts = [self.count_tokens(message) for message in messages]
+        with self._lock:
+            self._messages = list(messages)
+            self._token_counts = token_counts
+            self._total_tokens = sum(token_counts)
+            self._drop_unreachable()
+            self._summary = ""
+            self._summary_tokens = 0
+            self._generation += 1
+
+    def reset(self) -> None:
+        self.set([])
+
+    def _drop_unreachable(self) -> None:
+        """
+        Drop the oldest messages that can no longer fit in token_limit, the ones a
+        failing or missing LLM did not summarize.
+        """
+        count = 0
+        while self._total_tokens > self.token_limit:
+            self._total_tokens -= self._token_counts[count]
+            count += 1
+        if count:
+            del self._messages[:count]
+            del self._token_counts[:count]
+
+    def _messages_to_fold(self) -> int:
+        """
+        :return: The number of oldest messages to fold so that the ones kept take at
+        most half of recent_token_limit, whole turns only. The last message is kept.
+        """
+        remaining = self._total_tokens
+        count = 0
+        while count < len(self._messages) - 1 and (
+            remaining > self.recent_token_limit // 2
+            or self._messages[count].role != MessageRole.USER
+        ):
+            remaining -= self._token_counts[count]
+            count += 1
+        return count
+
+    def compress(self) -> None:
+        """
+        Fold the oldest messages into the summary, with one LLM call. The memory is
+        not locked during the call, turns go on with the previous summary.
+        On failure the messages stay, get() drops them once they no longer fit.
+        """
+        try:
+            with self._lock:
+                count = self._messages_to_fold()
+                if self._llm is None or count == 0:
+                    return
+                folded = self._messages[:count]
+                summary, generation = self._summary, self._generation
+
+            with Instrumentation.span("conversation_summary", messages=count):
+                new_summary = self._summarize(summary, folded).strip()
+            new_summary_tokens = len(self._tokenizer_fn(new_summary))
+
+            with self._lock:
+                # set() or reset() replaced the conversation during the call
+                if generation != self._generation:
+                    return
+                self._total_tokens -= sum(self._token_counts[:count])
+                del self._messages[:count]
+                del self._token_counts[:count]
+                self._summary = new_summary
+                self._summary_tokens = new_summary_tokens
+        except Exception:
+            logger.warning("Could not summarize the conversation", exc_info=True)
+        finally:
+            with self._lock:
+                self._compressing = False
+
+    def _summarize(self, summary: str, messages: List[ChatMessage]) -> str:
+        return self._llm.predict(
+            CONVERSATION_SUMMARY_PROMPT,
+            max_words=self.summary_max_words,
+            summary=summary,
+            messages="\n".join(
+                f"{message.role.value}: {message.content or ''}" for message in messages
+            ),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The number of messages kept verbatim, their tokens and the tokens of
+        the summary.
+        """
+        with self._lock:
+            return {
+                "messages": len(self._messages),
+                "message_tokens": self._total_tokens,
+                "summary_tokens": self._summary_tokens,
+            }
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+INSIGHTS_FNAME = "document_insights.json"
+
+
+def insights_fingerprint(
+    model_name: str, prompts: Iterable[str], content_hash: Optional[str]
+) -> str:
+    """
+    Fingerprint of everything the insights of a document are derived from.
+    Stored insights with another fingerprint are stale and computed again.
+    :param model_name: The name of the LLM producing the insights.
+    :param prompts: The prompts used to produce the insights.
+    :param content_hash: The content hash of the document (see index_config).
+    :return: A sha256 hex digest.
+    """
+    digest = hashlib.sha256()
+    for part in [model_name, *prompts, content_hash or ""]:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_insights(persist_dir: Path, fingerprint: str) -> Dict[str, str]:
+    """
+    :param persist_dir: The persist directory of the index.
+    :param fingerprint: The current fingerprint, see insights_fingerprint.
+    :return: The stored insights, empty if there are none or if they are stale.
+    """
+    path = Path(persist_dir) / INSIGHTS_FNAME
+    try:
+        with open(path, "r") as f:
+            stored = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if stored.get("fingerprint") != fingerprint:
+        return {}
+    return stored.get("insights", {})
+
+
+def save_insights(
+    persist_dir: Path, fingerprint: str, model_name: str, insights: Dict[str, str]
+) -> None:
+    """
+    Write the insights of a document next to its index config.
+    :param persist_dir: The persist directory of the index.
+    :param fingerprint: The fingerprint the insights were computed with.
+    :param model_name: The name of the LLM which produced them.
+    :param insights: The insights, by name.
+    """
+    persist_dir = Path(persist_dir)
+    content = {
+        "fingerprint": fingerprint,
+        "model_name": model_name,
+        "insights": insights,
+    }
+    # Written through a temporary file, a reader never sees a partial file
+    path = persist_dir / INSIGHTS_FNAME
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(content, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
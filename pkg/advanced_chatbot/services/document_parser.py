@@ -0,0 +1,178 @@
+import hashlib
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+# Metadata SimpleDirectoryReader keeps out of the embedded and LLM texts
+EXCLUDED_FILE_METADATA_KEYS = [
+    "file_name",
+    "file_type",
+    "file_size",
+    "creation_date",
+    "last_modified_date",
+    "last_accessed_date",
+]
+
+
+def file_content_hash(document_path: Path, chunk_size: int = 1 << 20) -> str:
+    """
+    :param document_path: Path to a file.
+    :param chunk_size: Number of bytes read at a time.
+    :return: The sha256 hex digest of the bytes of the file.
+    """
+    digest = hashlib.sha256()
+    with open(document_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def page_content_hash(text: str) -> str:
+    """
+    :param text: The text of a page.
+    :return: The sha256 hex digest of the text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def count_pdf_pages(document_path: Path) -> int:
+    """
+    :param document_path: Path to a pdf file.
+    :return: The number of pages of the pdf.
+    """
+    import pypdf
+
+    with open(document_path, "rb") as fp:
+        return len(pypdf.PdfReader(fp).pages)
+
+
+def _extract_pdf_pages(
+    document_path: str, start: int, end: int
+) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Extract the text of a range of pages, run in a worker process.
+    :param document_path: Path to the pdf file.
+    :param start: Index of the first page.
+    :param end: Index after the last page.
+    :return: A tuple (start, [(page_label, page_text), ...]).
+    """
+    import pypdf
+
+    with open(document_path, "rb") as fp:
+        pdf = pypdf.PdfReader(fp)
+        page_labels = pdf.page_labels
+        return start, [
+            (page_labels[page], pdf.pages[page].extract_text())
+            for page in range(start, end)
+        ]
+
+
+def parse_pdf_in_parallel(
+    document_path: Path,
+    num_workers: int,
+    num_pages: Optional[int] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+) -> List:
+    """
+    Parse a pdf by extracting page ranges in a process pool.
+    Pages come back in page order with the same metadata as SimpleDirectoryReader.
+    :param document_path: Path to the pdf file.
+    :param num_workers: The number of worker processes.
+    :param num_pages: The number of pages of the pdf, counted if not given.
+    :param progress_callback: Called with (pages parsed, total pages) as ranges complete.
+    :return: List[Document] : One Document per page.
+    """
+    document_path = Path(document_path)
+    num_pages = num_pages or count_pdf_pages(document_path)
+
+    # A few ranges per worker so that slow pages do not leave workers idle
+    pages_per_task = max(1, math.ceil(num_pages / (num_workers * 4)))
+    ranges = [
+        (start, min(start + pages_per_task, num_pages))
+        for start in range(0, num_pages, pages_per_task)
+    ]
+
+    pages: List[Tuple[str, str]] = [None] * num_pages
+    parsed = 0
+    # Workers are spawned rather than forked, the caller may run in a thread
+    with ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = [
+            pool.submit(_extract_pdf_pages, str(document_path), start, end)
+            for start, end in ranges
+        ]
+        for future in as_completed(futures):
+            start, extracted = future.result()
+            pages[start : start + len(extracted)] = extracted
+            parsed += len(extracted)
+            if progress_callback is not None:
+                progress_callback(parsed, num_pages)
+
+    return _page_documents(document_path, pages)
+
+
+def _page_documents(
+    document_path: Path,
+    pages: List[Tuple[str, str]],
+    doc_ids: Optional[List[str]] = None,
+) -> List:
+    """
+    Build the Document of every extracted page, with the metadata of SimpleDirectoryReader.
+    :param document_path: Path to the pdf file.
+    :param pages: The (page_label, page_text) of every page.
+    :param doc_ids: The doc_id of every page, random if not given.
+    :return: List[Document] : One Document per page.
+    """
+    from llama_index.core import Document
+    from llama_index.core.readers.file.base import default_file_metadata_func
+
+    file_metadata = default_file_metadata_func(str(document_path))
+    documents = []
+    for position, (page_label, page_text) in enumerate(pages):
+        metadata = {"page_label": page_label, "file_name": document_path.name}
+        metadata.update(file_metadata)
+        document = Document(text=page_text, metadata=metadata)
+        if doc_ids is not None:
+            document.id_ = doc_ids[position]
+        document.excluded_embed_metadata_keys.extend(EXCLUDED_FILE_METADATA_KEYS)
+        document.excluded_llm_metadata_keys.extend(EXCLUDED_FILE_METADATA_KEYS)
+        documents.append(document)
+    return documents
+
+
+def iter_pdf_page_batches(
+    document_path: Path,
+    batch_pages: int,
+    start_page: int = 0,
+    doc_id_prefix: Optional[str] = None,
+) -> Iterator[Tuple[int, int, List]]:
+    """
+    Parse a pdf lazily, a few pages at a time.
+    Only the pages of the current batch are held in memory.
+    :param document_path: Path to the pdf file.
+    :param batch_pages: The number of pages per batch.
+    :param start_page: Index of the first page to parse, to resume a previous run.
+    :param doc_id_prefix: Pages get the doc_id "<doc_id_prefix>-<page index>", so
+    that parsing the same pages again gives the same ids. Random if not given.
+    :return: An iterator of (index of the first page, total pages, List[Document]).
+    """
+    import pypdf
+
+    document_path = Path(document_path)
+    with open(document_path, "rb") as fp:
+        pdf = pypdf.PdfReader(fp)
+        num_pages = len(pdf.pages)
+        page_labels = pdf.page_labels
+        for start in range(start_page, num_pages, batch_pages):
+            end = min(start + batch_pages, num_pages)
+            pages = [
+                (page_labels[page], pdf.pages[page].extract_text())
+                for page in range(start, end)
+            ]
+            doc_ids = None
+            if doc_id_prefix is not None:
+                doc_ids = [f"{doc_id_prefix}-{page}" for page in range(start, end)]
+            yield start, num_pages, _page_documents(document_path, pages, doc_ids)
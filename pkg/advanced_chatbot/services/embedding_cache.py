@@ -0,0 +1,276 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from advanced_chatbot.config import (
+    DATA_PATH,
+    DEFAULT_EMBEDDING_CACHE_MAX_ENTRIES,
+)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a chunk text so that insignificant differences share a cache entry.
+    :param text: The text sent to the embedding model.
+    :return: The NFC-normalized text with collapsed whitespace.
+    """
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def embedding_cache_key(model_name: str, text: str) -> str:
+    """
+    :param model_name: The name of the embedding model.
+    :param text: The text sent to the embedding model.
+    :return: The content address of the embedding of :text by :model_name.
+    """
+    payload = f"{model_name}\0{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+class _EmbeddingCache:
+    """
+    Persistent content-addressed embedding cache shared by every index.
+
+    Embeddings are stored as float32 blobs in a SQLite database, keyed by a hash of
+    the embedding model name and the normalized chunk text. When the cache grows
+    over :max_entries, the least recently used embeddings are evicted.
+    """
+
+    def __init__(self, db_path: Path, max_entries: int):
+        self._db_path = db_path
+        self._max_entries = max_entries
+        self._connection: Optional[sqlite3.Connection] = None
+        self._entries = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open the database on first use.
+        """
+        if self._connection is None:
+            self._db_path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self._db_path), check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model_name TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                "ON embeddings (last_used)"
+            )
+            self._entries = connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+            self._connection = connection
+        return self._connection
+
+    def get_many(
+        self, model_name: str, texts: Sequence[str]
+    ) -> List[Optional[Embedding]]:
+        """
+        Look up the embeddings of several texts.
+        :param model_name: The name of the embedding model.
+        :param texts: The texts to look up.
+        :return: One embedding per text, None for texts that are not cached.
+        """
+        keys = [embedding_cache_key(model_name, text) for text in texts]
+        found: Dict[str, Embedding] = {}
+
+        with self._lock:
+            connection = self._connect()
+            unique_keys = list(set(keys))
+            # Stay under SQLite's limit on the number of query parameters
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start : start + 500]
+                rows = connection.execute(
+                    f"SELECT key, embedding FROM embeddings "
+                    f"WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+            if found:
+                now = time.time()
+                connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                connection.commit()
+
+            results = [found.get(key) for key in keys]
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+            return results
+
+    def put_many(
+        self, model_name: str, texts: Sequence[str], embeddings: Sequence[Embedding]
+    ) -> None:
+        """
+        Store the embeddings of several texts, evicting old entries above the cap.
+        :param model_name: The name of the embedding model.
+        :param texts: The embedded texts.
+        :param embeddings: The embeddings, one per text.
+        """
+        now = time.time()
+        rows = {
+            embedding_cache_key(model_name, text): (
+                model_name,
+                np.asarray(embedding, dtype=np.float32).tobytes(),
+                now,
+            )
+            for text, embedding in zip(texts, embeddings)
+        }
+
+        with self._lock:
+            connection = self._connect()
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO embeddings "
+                "(key, model_name, embedding, last_used) VALUES (?, ?, ?, ?)",
+                [(key, *values) for key, values in rows.items()],
+            )
+            self._entries += connection.total_changes - before
+
+            if self._entries > self._max_entries:
+                # Evict down to 90% of the cap so eviction does not run on every put
+                excess = self._entries - int(self._max_entries * 0.9)
+                connection.execute(
+                    "DELETE FROM embeddings WHERE key IN ("
+                    "SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self._entries -= excess
+                self.evictions += excess
+            connection.commit()
+
+    def clear(self) -> None:
+        """
+        Remove every cached embedding.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM embeddings")
+            connection.commit()
+            self._entries = 0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: The cache counters and hit rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": self._entries,
+                "max_entries": self._max_entries,
+            }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model answering text embeddings from the EmbeddingCache and only
+    calling the wrapped model for chunks it has never embedded.
+    Query embeddings are not cached.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: _EmbeddingCache = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: _EmbeddingCache):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model
+
+    def _lookup(self, texts: List[str]) -> Tuple[List, Dict[str, List[int]]]:
+        """
+        :return: The cached embeddings (None when missing) and the positions of
+        each missing text, a text repeated in the batch being embedded once.
+        """
+        embeddings = self._cache.get_many(self.model_name, texts)
+        missing: Dict[str, List[int]] = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(texts[i], []).append(i)
+        return embeddings, missing
+
+    def _store(
+        self,
+        embeddings: List,
+        missing: Dict[str, List[int]],
+        computed: List[Embedding],
+    ) -> None:
+        self._cache.put_many(self.model_name, list(missing), computed)
+        for positions, embedding in zip(missing.values(), computed):
+            for i in positions:
+                embeddings[i] = embedding
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed_model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self._embed_model._aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        embeddings, missing = self._lookup(texts)
+        if missing:
+            missing_texts = list(missing)
+            computed = self._embed_model._get_text_embeddings(missing_texts)
+            self._store(embeddings, missing, computed)
+        return embeddings
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        embeddings, missing = self._lookup(texts)
+        if missing:
+            missing_texts = list(missing)
+            computed = await self._embed_model._aget_text_embeddings(missing_texts)
+            self._store(embeddings, missing, computed)
+        return embeddings
+
+
+EmbeddingCache = _EmbeddingCache(
+    db_path=DATA_PATH / "embedding_cache.sqlite3",
+    max_entries=DEFAULT_EMBEDDING_CACHE_MAX_ENTRIES,
+)  # Singleton instance shared by every index
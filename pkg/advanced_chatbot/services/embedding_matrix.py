@@ -0,0 +1,474 @@
+import asyncio
+import threading
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core import VectorStoreIndex
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from advanced_chatbot.config import (
+    DEFAULT_ANN_NPROBE,
+    DEFAULT_EMBEDDING_MATRIX_DTYPE,
+    DEFAULT_RESCORE_FACTOR,
+)
+from advanced_chatbot.services.ivf_index import IVFIndex
+from advanced_chatbot.services.numpy_vector_store import NumpyVectorStore
+from advanced_chatbot.services.quantization import (
+    QUANTIZATION_DTYPES,
+    normalize,
+    quantize,
+    quantized_scores,
+    top_k_positions,
+)
+
+# Rows encoded at once when an index is added
+_BLOCK_ROWS = 16384
+
+
+class EmbeddingMatrix:
+    """
+    Embeddings of several indexes held in one contiguous matrix.
+
+    Rows are L2-normalized so that a single matrix-vector product gives the cosine
+    similarity of a query against every chunk of every loaded index. Each row is
+    mapped back to its (index_id, node_id) pair.
+    Adding an index appends rows (the buffer grows geometrically), removing an
+    index moves the last rows into the freed slots, so neither needs a rebuild.
+    Indexes added with an IVF index only have the rows of their closest clusters
+    scored, the rows of the other indexes are all scored.
+    Rows can be held as float16 or int8 codes to save memory. The best candidates
+    found with the codes are then rescored against the float32 embeddings of
+    their index, so the returned scores are exact.
+    """
+
+    def __init__(
+        self,
+        initial_capacity: int = 1024,
+        dtype: str = DEFAULT_EMBEDDING_MATRIX_DTYPE,
+        rescore_factor: int = DEFAULT_RESCORE_FACTOR,
+    ):
+        if dtype not in QUANTIZATION_DTYPES:
+            raise ValueError(f"Unknown embedding matrix dtype: {dtype}")
+        self._initial_capacity = initial_capacity
+        self._dtype = dtype
+        self._rescore_factor = rescore_factor
+        self._matrix: Optional[np.ndarray] = None
+        # Per-row scales of the int8 codes
+        self._scales: Optional[np.ndarray] = None
+        self._size = 0
+        # Row -> position of its index in self._index_ids / its node id / its row
+        # in the embeddings of its index
+        self._row_index = np.empty(0, dtype=np.int32)
+        self._row_node_ids: List[str] = []
+        self._row_local = np.empty(0, dtype=np.int64)
+        # index id -> row positions, position in the row_index table, source index
+        self._index_rows: Dict[str, np.ndarray] = {}
+        self._index_ids: List[Optional[str]] = []
+        self._index_positions: Dict[str, int] = {}
+        # Positions of self._index_ids freed by removed indexes, reused first
+        self._free_positions: List[int] = []
+        self._sources: Dict[str, Any] = {}
+        self._ann_indexes: Dict[str, IVFIndex] = {}
+        # index id -> float32 embeddings used to rescore the candidates
+        self._full_precision: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self._matrix is None else self._matrix.shape[1]
+
+    @property
+    def lock(self) -> threading.RLock:
+        """
+        Held by every operation of the matrix. Hold it to add indexes and search
+        them with no removal in between.
+        """
+        return self._lock
+
+    @property
+    def quantized(self) -> bool:
+        return self._dtype != "float32"
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: The memory held by the embedding codes and scales.
+        """
+        if self._matrix is None:
+            return 0
+        scales = 0 if self._scales is None else self._scales.nbytes
+        return self._matrix.nbytes + scales
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, index_id: str) -> bool:
+        return index_id in self._index_rows
+
+    def index_ids(self) -> List[str]:
+        return list(self._index_rows.keys())
+
+    def is_current(self, index_id: str, source: Any) -> bool:
+        """
+        Check whether the rows of :index_id were built from the :source index object.
+        :param index_id: The id of the index.
+        :param source: The loaded index object the rows should come from.
+        """
+        ref = self._sources.get(index_id)
+        return ref is not None and ref() is source
+
+    def _reserve(self, dim: int, extra_rows: int) -> None:
+        """
+        Make room for :extra_rows more rows, doubling the buffer if needed.
+        """
+        if self._matrix is None:
+            capacity = max(self._initial_capacity, extra_rows)
+            self._matrix = np.empty(
+                (capacity, dim), dtype=QUANTIZATION_DTYPES[self._dtype]
+            )
+            self._row_index = np.empty(capacity, dtype=np.int32)
+            self._row_local = np.empty(capacity, dtype=np.int64)
+            if self._dtype == "int8":
+                self._scales = np.empty(capacity, dtype=np.float32)
+            return
+
+        if dim != self._matrix.shape[1]:
+            raise ValueError(
+                f"Embedding dimension {dim} does not match matrix dimension "
+                f"{self._matrix.shape[1]}."
+            )
+
+        required = self._size + extra_rows
+        capacity = self._matrix.shape[0]
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+
+        def grow(array: np.ndarray) -> np.ndarray:
+            grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[: self._size] = array[: self._size]
+            return grown
+
+        self._matrix = grow(self._matrix)
+        self._row_index = grow(self._row_index)
+        self._row_local = grow(self._row_local)
+        if self._scales is not None:
+            self._scales = grow(self._scales)
+
+    def add_index(
+        self,
+        index_id: str,
+        node_ids: Sequence[str],
+        embeddings: Any,
+        source: Any = None,
+        ann_index: Optional[IVFIndex] = None,
+        full_precision: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Append the embeddings of an index to the matrix, replacing previous rows.
+        :param index_id: The id of the index.
+        :param node_ids: The node ids, one per embedding row.
+        :param embeddings: Array-like of shape (len(node_ids), dim).
+        :param source: The loaded index object the embeddings come from.
+        :param ann_index: An IVF index built on these embedding rows, if any.
+        :param full_precision: The same embeddings, used to rescore the candidates
+        when the matrix holds compact codes: memory-mapped from disk, or
+        VectorStoreRows for indexes whose embeddings are not on disk as a matrix.
+        :embeddings if not given, which keeps a float32 copy in memory.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(node_ids):
+            raise ValueError("Expected one embedding row per node id.")
+
+        with self._lock:
+            if index_id in self._index_rows:
+                self.remove_index(index_id)
+
+            self._reserve(vectors.shape[1], vectors.shape[0])
+
+            if self._free_positions:
+                position = self._free_positions.pop()
+                self._index_ids[position] = index_id
+            else:
+                position = len(self._index_ids)
+                self._index_ids.append(index_id)
+            self._index_positions[index_id] = position
+
+            start, end = self._size, self._size + vectors.shape[0]
+            # Encoded by blocks, a float32 copy of a whole index is never made
+            for block_start in range(0, len(vectors), _BLOCK_ROWS):
+                block = normalize(vectors[block_start : block_start + _BLOCK_ROWS])
+                codes, scales = quantize(block, self._dtype)
+                rows = slice(start + block_start, start + block_start + len(block))
+                self._matrix[rows] = codes
+                if scales is not None:
+                    self._scales[rows] = scales
+            self._row_index[start:end] = position
+            self._row_local[start:end] = np.arange(len(vectors))
+            self._row_node_ids.extend(node_ids)
+            self._index_rows[index_id] = np.arange(start, end)
+            self._size = end
+            self._sources[index_id] = (
+                weakref.ref(source) if source is not None else lambda: None
+            )
+            if ann_index is not None:
+                self._ann_indexes[index_id] = ann_index
+            if self.quantized:
+                self._full_precision[index_id] = (
+                    full_precision if full_precision is not None else vectors
+                )
+
+    def remove_index(self, index_id: str) -> None:
+        """
+        Remove the rows of an index, filling the holes with rows from the end.
+        :param index_id: The id of the index.
+        """
+        with self._lock:
+            rows = self._index_rows.pop(index_id, None)
+            if rows is None:
+                return
+            self._sources.pop(index_id, None)
+            self._ann_indexes.pop(index_id, None)
+            self._full_precision.pop(index_id, None)
+            position = self._index_positions.pop(index_id)
+            self._index_ids[position] = None
+
+            new_size = self._size - len(rows)
+            # Holes below the new size are filled with the surviving tail rows.
+            holes = rows[rows < new_size]
+            tail = np.arange(new_size, self._size)
+            movers = tail[self._row_index[tail] != position]
+
+            if len(holes):
+                self._matrix[holes] = self._matrix[movers]
+                self._row_index[holes] = self._row_index[movers]
+                self._row_local[holes] = self._row_local[movers]
+                if self._scales is not None:
+                    self._scales[holes] = self._scales[movers]
+                for hole, mover in zip(holes.tolist(), movers.tolist()):
+                    self._row_node_ids[hole] = self._row_node_ids[mover]
+                # Moved rows keep their place in the row list of their index, so
+                # that row i of an index still is the i-th embedding it was added with
+                for moved_position in np.unique(self._row_index[holes]).tolist():
+                    index_rows = self._index_rows[self._index_ids[moved_position]]
+                    moved = index_rows >= new_size
+                    index_rows[moved] = holes[
+                        np.searchsorted(movers, index_rows[moved])
+                    ]
+
+            del self._row_node_ids[new_size:]
+            self._size = new_size
+            self._free_positions.append(position)
+
+    def retain(self, index_ids: Sequence[str]) -> None:
+        """
+        Remove the rows of every index but the given ones.
+        :param index_ids: The ids of the indexes to keep.
+        """
+        with self._lock:
+            for index_id in set(self._index_rows) - set(index_ids):
+                self.remove_index(index_id)
+
+    def top_k(
+        self,
+        query_embedding: Sequence[float],
+        similarity_top_k: int,
+        index_ids: Optional[Sequence[str]] = None,
+        nprobe: Optional[int] = DEFAULT_ANN_NPROBE,
+    ) -> List[Tuple[str, str, float]]:
+        """
+        Find the most similar chunks to a query in one vectorized pass.
+        :param query_embedding: The query embedding.
+        :param similarity_top_k: The number of results.
+        :param index_ids: Restrict the search to these indexes (all if None).
+        :param nprobe: The number of clusters searched in indexes with an IVF index,
+        the calibrated one of each index if None.
+        :return: A list of (index_id, node_id, cosine similarity), best first.
+        """
+        with self._lock:
+            if self._size == 0 or similarity_top_k <= 0:
+                return []
+
+            query = normalize(query_embedding)
+            rows = self._candidate_rows(query, index_ids, nprobe)
+            if rows is None:
+                codes = self._matrix[: self._size]
+                scales = None if self._scales is None else self._scales[: self._size]
+            else:
+                codes = self._matrix[rows]
+                scales = None if self._scales is None else self._scales[rows]
+            scores = quantized_scores(codes, scales, query)
+
+            num_candidates = similarity_top_k
+            if self.quantized:
+                num_candidates *= self._rescore_factor
+            best = top_k_positions(scores, num_candidates)
+            best_rows = best if rows is None else rows[best]
+            best_scores = scores[best]
+
+            if self.quantized:
+                best_scores = self._exact_scores(best_rows, query)
+                best = top_k_positions(best_scores, similarity_top_k)
+                best_rows, best_scores = best_rows[best], best_scores[best]
+
+            return [
+                (
+                    self._index_ids[self._row_index[row]],
+                    self._row_node_ids[row],
+                    score,
+                )
+                for row, score in zip(best_rows.tolist(), best_scores.tolist())
+            ]
+
+    def _candidate_rows(
+        self,
+        query: np.ndarray,
+        index_ids: Optional[Sequence[str]],
+        nprobe: Optional[int],
+    ) -> Optional[np.ndarray]:
+        """
+        :return: The rows to score: the rows of the closest clusters for indexes
+        with an IVF index, every row for the others. None stands for all the rows.
+        """
+        selected = self._index_rows.keys() if index_ids is None else index_ids
+        if not any(index_id in self._ann_indexes for index_id in selected):
+            if index_ids is None or set(index_ids) == self._index_rows.keys():
+                return None
+            positions = [
+                self._index_positions[index_id]
+                for index_id in index_ids
+                if index_id in self._index_positions
+            ]
+            return np.flatnonzero(np.isin(self._row_index[: self._size], positions))
+
+        candidates = [np.empty(0, dtype=np.int64)]
+        for index_id in selected:
+            rows = self._index_rows.get(index_id)
+            if rows is None:
+                continue
+            ann_index = self._ann_indexes.get(index_id)
+            if ann_index is not None:
+                rows = rows[ann_index.candidates(query, nprobe)]
+            candidates.append(rows)
+        return np.concatenate(candidates)
+
+    def _exact_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        :return: The cosine similarity of the query with the float32 embeddings
+        of the given rows.
+        """
+        scores = np.empty(len(rows), dtype=np.float32)
+        positions = self._row_index[rows]
+        for position in np.unique(positions).tolist():
+            mask = positions == position
+            embeddings = self._full_precision[self._index_ids[position]]
+            scores[mask] = normalize(embeddings[self._row_local[rows[mask]]]) @ query
+        return scores
+
+
+def index_embeddings(index: VectorStoreIndex) -> Tuple[List[str], np.ndarray]:
+    """
+    Read the node ids and stored embeddings of a loaded index.
+    :param index: The loaded vector store index.
+    :return: A tuple (node_ids, embeddings) with one embedding row per node id.
+    """
+    vector_store = index.vector_store
+    if isinstance(vector_store, NumpyVectorStore):
+        return vector_store.get_embeddings()
+
+    node_ids = list(index.index_struct.nodes_dict.values())
+    embeddings = np.array(
+        [vector_store.get(node_id) for node_id in node_ids], dtype=np.float32
+    ).reshape(len(node_ids), -1)
+    return node_ids, embeddings
+
+
+class VectorStoreRows:
+    """
+    The float32 embeddings of an index, read row by row from its loaded vector store
+    when indexed with an array of rows. Rescores the candidates of indexes in the
+    JSON layout, whose vector store already holds every embedding, without an
+    extra float32 copy of them.
+    """
+
+    def __init__(self, vector_store: Any, node_ids: Sequence[str]):
+        """
+        :param vector_store: The vector store of the index.
+        :param node_ids: The node ids, one per row.
+        """
+        self._vector_store = vector_store
+        self._node_ids = list(node_ids)
+
+    def __len__(self) -> int:
+        return len(self._node_ids)
+
+    def __getitem__(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.atleast_1d(rows).tolist()
+        return np.array(
+            [self._vector_store.get(self._node_ids[row]) for row in rows],
+            dtype=np.float32,
+        ).reshape(len(rows), -1)
+
+
+class MatrixRetriever(BaseRetriever):
+    """
+    Retrieve over several indexes with one top-k on a shared EmbeddingMatrix,
+    instead of one retriever per index fused afterwards.
+    The rows of an index removed from the matrix since the retriever was built
+    (e.g. evicted with its index from the IndexCache) are added back by
+    :sync_index before the search.
+    """
+
+    def __init__(
+        self,
+        matrix: EmbeddingMatrix,
+        indexes: Dict[str, VectorStoreIndex],
+        embed_model: BaseEmbedding,
+        similarity_top_k: int,
+        sync_index: Optional[Callable[[str, VectorStoreIndex], None]] = None,
+    ):
+        self._matrix = matrix
+        self._indexes = indexes
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+        self._sync_index = sync_index
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        return self._nodes_from_matches(query_bundle.embedding)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = (
+                await self._embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            )
+        # The top-k waits for the matrix lock and scores every row, off the loop
+        return await asyncio.to_thread(self._nodes_from_matches, query_bundle.embedding)
+
+    def _nodes_from_matches(self, query_embedding: List[float]) -> List[NodeWithScore]:
+        with self._matrix.lock:
+            if self._sync_index is not None:
+                for index_id, index in self._indexes.items():
+                    if not self._matrix.is_current(index_id, index):
+                        self._sync_index(index_id, index)
+            matches = self._matrix.top_k(
+                query_embedding,
+                similarity_top_k=self._similarity_top_k,
+                index_ids=list(self._indexes.keys()),
+            )
+        return [
+            NodeWithScore(
+                node=self._indexes[index_id].docstore.get_node(node_id), score=score
+            )
+            for index_id, node_id, score in matches
+        ]
@@ -0,0 +1,198 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+
+from advanced_chatbot.config import (
+    DEFAULT_EMBEDDING_BATCH_TOKENS,
+    DEFAULT_EMBEDDING_CONCURRENCY,
+    DEFAULT_EMBEDDING_MAX_BATCH_SIZE,
+    DEFAULT_EMBEDDING_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    :param error: An error raised by an embedding call.
+    :return: True if the error is a rate-limit (HTTP 429) response.
+    """
+    if getattr(error, "status_code", None) == 429:
+        return True
+    return type(error).__name__ == "RateLimitError"
+
+
+class EmbeddingPipeline:
+    """
+    Embed many chunks with several batches in flight concurrently.
+
+    Batches are sized by token count rather than by number of chunks. When the
+    provider answers with a rate limit, the failed batch is split and queued
+    again, new batches wait for an exponential backoff and the token budget of a
+    batch is halved. The budget grows back as batches succeed.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        max_tokens_per_batch: int = DEFAULT_EMBEDDING_BATCH_TOKENS,
+        max_batch_size: int = DEFAULT_EMBEDDING_MAX_BATCH_SIZE,
+        max_concurrency: int = DEFAULT_EMBEDDING_CONCURRENCY,
+        max_retries: int = DEFAULT_EMBEDDING_MAX_RETRIES,
+        initial_backoff: float = 1.0,
+        tokenizer: Optional[Callable[[str], List]] = None,
+    ):
+        self._embed_model = embed_model
+        self._max_tokens_per_batch = max_tokens_per_batch
+        self._max_batch_size = max_batch_size
+        self._max_concurrency = max_concurrency
+        self._max_retries = max_retries
+        self._initial_backoff = initial_backoff
+        self._tokenizer = tokenizer
+
+        self._token_budget = max_tokens_per_batch
+        self._stats = {
+            "chunks": 0,
+            "batches": 0,
+            "rate_limited": 0,
+            "seconds": 0.0,
+            "chunks_per_second": 0.0,
+        }
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: Chunks and batches embedded by the last call of embed, rate-limit
+        responses received, elapsed seconds and throughput in chunks per second.
+        """
+        return dict(self._stats)
+
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        if self._tokenizer is None:
+            from llama_index.core.utils import get_tokenizer
+
+            self._tokenizer = get_tokenizer()
+        return [len(self._tokenizer(text)) for text in texts]
+
+    def _next_batch(self, pending: Deque[int], token_counts: List[int]) -> List[int]:
+        """
+        Take the next batch of text positions fitting in the current token budget.
+        A single text bigger than the budget still makes a batch on its own.
+        """
+        batch = [pending.popleft()]
+        tokens = token_counts[batch[0]]
+        while (
+            pending
+            and len(batch) < self._max_batch_size
+            and tokens + token_counts[pending[0]] <= self._token_budget
+        ):
+            tokens += token_counts[pending[0]]
+            batch.append(pending.popleft())
+        return batch
+
+    def embed(
+        self,
+        texts: List[str],
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        batch_callback: Optional[Callable[[List[int], List[Embedding]], None]] = None,
+    ) -> List[Embedding]:
+        """
+        Embed texts, keeping up to max_concurrency batches in flight.
+        :param texts: The texts to embed.
+        :param progress_callback: Called with (embedded texts, total texts) after each batch.
+        :param batch_callback: Called with (positions in :texts, embeddings) after each
+        batch, so that callers can keep partial results if a later batch fails.
+        :return: One embedding per text, in the order of :texts.
+        """
+        started_at = time.perf_counter()
+        embeddings: List[Optional[Embedding]] = [None] * len(texts)
+        token_counts = self._count_tokens(texts)
+        pending: Deque[int] = deque(range(len(texts)))
+        in_flight: Dict[Future, List[int]] = {}
+        retries: Dict[int, int] = {}
+        not_before = 0.0
+        backoff = self._initial_backoff
+        done = 0
+        self._stats.update(chunks=0, batches=0, rate_limited=0)
+
+        with ThreadPoolExecutor(
+            max_workers=self._max_concurrency, thread_name_prefix="embedding"
+        ) as pool:
+            while pending or in_flight:
+                delay = not_before - time.monotonic()
+                if delay > 0 and not in_flight:
+                    time.sleep(delay)
+                    delay = 0
+
+                while pending and len(in_flight) < self._max_concurrency and delay <= 0:
+                    batch = self._next_batch(pending, token_counts)
+                    future = pool.submit(
+                        self._embed_model._get_text_embeddings,
+                        [texts[i] for i in batch],
+                    )
+                    in_flight[future] = batch
+
+                finished, _ = wait(
+                    list(in_flight),
+                    timeout=delay if delay > 0 else None,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in finished:
+                    batch = in_flight.pop(future)
+                    error = future.exception()
+
+                    if error is None:
+                        batch_embeddings = future.result()
+                        for i, embedding in zip(batch, batch_embeddings):
+                            embeddings[i] = embedding
+                        if batch_callback is not None:
+                            batch_callback(batch, batch_embeddings)
+                        done += len(batch)
+                        self._stats["batches"] += 1
+                        # Additive increase of the budget once the limit is gone
+                        backoff = self._initial_backoff
+                        self._token_budget = min(
+                            self._max_tokens_per_batch,
+                            self._token_budget + self._max_tokens_per_batch // 8,
+                        )
+                        if progress_callback is not None:
+                            progress_callback(done, len(texts))
+                        continue
+
+                    if not is_rate_limit_error(error):
+                        raise error
+                    retries[batch[0]] = retries.get(batch[0], 0) + 1
+                    if retries[batch[0]] > self._max_retries:
+                        raise error
+
+                    self._stats["rate_limited"] += 1
+                    logger.warning(
+                        "Embedding rate limited, retrying %d chunks in %.1f s",
+                        len(batch),
+                        backoff,
+                    )
+                    not_before = time.monotonic() + backoff
+                    backoff = min(backoff * 2, 60.0)
+                    self._token_budget = max(
+                        1,
+                        min(self._token_budget, sum(token_counts[i] for i in batch))
+                        // 2,
+                    )
+                    pending.extendleft(reversed(batch))
+
+        elapsed = time.perf_counter() - started_at
+        self._stats.update(
+            chunks=len(texts),
+            seconds=elapsed,
+            chunks_per_second=len(texts) / elapsed if elapsed > 0 else 0.0,
+        )
+        logger.info(
+            "Embedded %d chunks in %d batches, %.1f chunks/s",
+            len(texts),
+            self._stats["batches"],
+            self._stats["chunks_per_second"],
+        )
+        return embeddings
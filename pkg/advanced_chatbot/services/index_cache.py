@@ -0,0 +1,239 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from advanced_chatbot.config import (
+    DEFAULT_INDEX_CACHE_MAX_BYTES,
+    DEFAULT_INDEX_CACHE_MAX_ENTRIES,
+)
+
+
+class _CacheEntry:
+    """
+    A loaded index together with the persist directory state it was loaded from.
+    """
+
+    def __init__(self, value: Any, signature: Tuple, size: int):
+        self.value = value
+        self.signature = signature
+        self.size = size
+
+
+class _IndexCache:
+    """
+    Process-wide LRU cache of loaded vector store indexes.
+
+    Entries are bounded both in count and in size. The size of an entry is
+    approximated by the size on disk of its persist directory. An entry is
+    dropped as soon as the files of its persist directory change.
+    Concurrent misses on the same index share a single load.
+    Removal listeners are told about every index dropped from the cache, so that
+    what is derived from it can be dropped too.
+    """
+
+    # Files whose content does not affect the loaded index.
+    IGNORED_FILES = {
+        "index_config.json",
+        "document_insights.json",
+        "document_insights.json.tmp",
+        "pages.bin",
+        "pages.bin.tmp",
+        "pages_index.json",
+        "pages_index.json.tmp",
+    }
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        # key -> result of the load in progress, awaited by the concurrent misses
+        self._loading: Dict[str, Future] = {}
+        self._removal_listeners: List[Callable[[str], None]] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.shared_loads = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def _directory_signature(cls, persist_dir: Path) -> Tuple[Tuple, int]:
+        """
+        Compute a cheap signature of a persist directory.
+        :param persist_dir: The directory the index is persisted in.
+        :return: A tuple (signature, size) where the signature changes whenever
+        a file of the directory is added, removed or rewritten.
+        """
+        signature = []
+        size = 0
+        if persist_dir.exists():
+            for path in sorted(persist_dir.iterdir()):
+                if not path.is_file() or path.name in cls.IGNORED_FILES:
+                    continue
+                stat = path.stat()
+                signature.append((path.name, stat.st_mtime_ns, stat.st_size))
+                size += stat.st_size
+        return tuple(signature), size
+
+    def get_or_load(
+        self, key: str, persist_dir: Path, loader: Callable[[], Any]
+    ) -> Any:
+        """
+        Return the cached index for :key, loading it with :loader on a miss.
+        A miss while the same index is being loaded waits for that load.
+        :param key: The id of the index.
+        :param persist_dir: The directory the index is persisted in.
+        :param loader: Callable loading the index from disk.
+        :return: The loaded index.
+        """
+        signature, size = self._directory_signature(persist_dir)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.signature == signature:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.value
+                # The persist directory changed since the index was loaded.
+                self._remove(key)
+                self.invalidations += 1
+                removed = [key]
+            else:
+                removed = []
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = Future()
+                self.misses += 1
+                is_loader = True
+            else:
+                self.shared_loads += 1
+                is_loader = False
+
+        self._notify_removed(removed)
+        if not is_loader:
+            return loading.result()
+
+        try:
+            value = loader()
+            self.put(key, persist_dir, value, signature=signature, size=size)
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        loading.set_result(value)
+        return value
+
+    def put(
+        self,
+        key: str,
+        persist_dir: Path,
+        value: Any,
+        signature: Optional[Tuple] = None,
+        size: Optional[int] = None,
+    ) -> None:
+        """
+        Insert an index in the cache, evicting least recently used entries if needed.
+        :param key: The id of the index.
+        :param persist_dir: The directory the index is persisted in.
+        :param value: The loaded index.
+        """
+        if signature is None or size is None:
+            signature, size = self._directory_signature(persist_dir)
+
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            # An index bigger than the whole budget is served but never cached.
+            if size > self._max_bytes:
+                return
+
+            self._entries[key] = _CacheEntry(value, signature, size)
+            self._total_bytes += size
+
+            while (
+                len(self._entries) > self._max_entries
+                or self._total_bytes > self._max_bytes
+            ):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+                evicted.append(oldest_key)
+        self._notify_removed(evicted)
+
+    def invalidate(self, key: str) -> None:
+        """
+        Drop an index from the cache.
+        :param key: The id of the index.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._remove(key)
+            self.invalidations += 1
+        self._notify_removed([key])
+
+    def clear(self) -> None:
+        """
+        Drop every cached index.
+        """
+        with self._lock:
+            removed = list(self._entries)
+            self._entries.clear()
+            self._total_bytes = 0
+        self._notify_removed(removed)
+
+    def keys(self) -> List[str]:
+        """
+        :return: The ids of the cached indexes, least recently used first.
+        """
+        with self._lock:
+            return list(self._entries)
+
+    def add_removal_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        :param listener: Called with the id of every index evicted or invalidated,
+        after the cache lock is released.
+        """
+        with self._lock:
+            self._removal_listeners.append(listener)
+
+    def _notify_removed(self, keys: List[str]) -> None:
+        for key in keys:
+            for listener in list(self._removal_listeners):
+                listener(key)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The cache counters and current occupancy.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared_loads": self.shared_loads,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_entries": self._max_entries,
+                "max_bytes": self._max_bytes,
+            }
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.size
+
+
+IndexCache = _IndexCache(
+    max_entries=DEFAULT_INDEX_CACHE_MAX_ENTRIES,
+    max_bytes=DEFAULT_INDEX_CACHE_MAX_BYTES,
+)  # Singleton instance shared by the whole process
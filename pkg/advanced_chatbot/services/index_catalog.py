@@ -0,0 +1,296 @@
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from advanced_chatbot.config import DATA_PATH, RAG_STORAGE_PATH
+from advanced_chatbot.services.numpy_vector_store import (
+    EMBEDDINGS_FNAME,
+    JSON_VECTOR_STORE_FNAME,
+    VECTOR_IDS_FNAME,
+)
+from advanced_chatbot.services.page_store import PAGES_INDEX_FNAME
+
+logger = logging.getLogger(__name__)
+
+INDEX_CONFIG_FNAME = "index_config.json"
+
+_COLUMNS = (
+    "index_id",
+    "document_name",
+    "document_path",
+    "content_hash",
+    "node_count",
+    "embedding_dim",
+    "page_count",
+    "size_bytes",
+    "created_at",
+    "updated_at",
+)
+
+
+def describe_index_dir(persist_dir: Path) -> Optional[Dict]:
+    """
+    Read the catalog entry of an index from its persist directory.
+    :param persist_dir: The persist directory of the index.
+    :return: The catalog entry, None if the directory holds no index config.
+    """
+    persist_dir = Path(persist_dir)
+    config_path = persist_dir / INDEX_CONFIG_FNAME
+    if not config_path.is_file():
+        return None
+    with open(config_path, "r") as f:
+        index_config = json.load(f)
+
+    node_count, embedding_dim = 0, None
+    if (persist_dir / EMBEDDINGS_FNAME).exists():
+        embeddings = np.load(persist_dir / EMBEDDINGS_FNAME, mmap_mode="r")
+        node_count = embeddings.shape[0]
+        embedding_dim = embeddings.shape[1] if embeddings.ndim == 2 else None
+    elif (persist_dir / JSON_VECTOR_STORE_FNAME).exists():
+        with open(persist_dir / JSON_VECTOR_STORE_FNAME, "r") as f:
+            embedding_dict = json.load(f).get("embedding_dict", {})
+        node_count = len(embedding_dict)
+        embedding_dim = len(next(iter(embedding_dict.values()), [])) or None
+
+    page_count = None
+    if (persist_dir / PAGES_INDEX_FNAME).exists():
+        with open(persist_dir / PAGES_INDEX_FNAME, "r") as f:
+            page_count = len(json.load(f)["page_labels"])
+
+    files = [path for path in persist_dir.iterdir() if path.is_file()]
+    document_path = Path(index_config["document_path"])
+    return {
+        "index_id": index_config["index_id"],
+        "document_name": document_path.name,
+        "document_path": str(document_path),
+        "content_hash": index_config.get("content_hash"),
+        "node_count": node_count,
+        "embedding_dim": embedding_dim,
+        "page_count": page_count,
+        "size_bytes": sum(path.stat().st_size for path in files),
+        "created_at": index_config.get("created_at", config_path.stat().st_mtime),
+        "updated_at": max(path.stat().st_mtime for path in files),
+    }
+
+
+class _IndexCatalog:
+    """
+    Catalog of the knowledge base: one row per persisted index.
+
+    Listing the indexes is a single SQLite query instead of opening the config of
+    every persist directory. The catalog is kept up to date by the RagService
+    when an index is built, updated or deleted, and can be rebuilt from the
+    persist directories at any time.
+    """
+
+    def __init__(self, db_path: Path, storage_path: Path):
+        self._db_path = db_path
+        self._storage_path = storage_path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open the database on first use, filling it from disk if it is new.
+        """
+        if self._connection is None:
+            self._db_path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self._db_path), check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS indexes (
+                    index_id TEXT PRIMARY KEY,
+                    document_name TEXT NOT NULL,
+                    document_path TEXT NOT NULL,
+                    content_hash TEXT,
+                    node_count INTEGER NOT NULL,
+                    embedding_dim INTEGER,
+                    page_count INTEGER,
+                    size_bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS indexes_document_name "
+                "ON indexes (document_name)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS indexes_content_hash "
+                "ON indexes (content_hash)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._connection = connection
+            if not connection.execute(
+                "SELECT value FROM meta WHERE key = 'built_at'"
+            ).fetchone():
+                # First use, the indexes persisted so far are not in the catalog
+                self._rebuild(connection)
+        return self._connection
+
+    def _rebuild(self, connection: sqlite3.Connection) -> int:
+        entries = []
+        if self._storage_path.exists():
+            for persist_dir in sorted(self._storage_path.iterdir()):
+                if not persist_dir.is_dir():
+                    continue
+                entry = describe_index_dir(persist_dir)
+                if entry is None:
+                    logger.warning("Skipping %s, it has no index config", persist_dir)
+                    continue
+                entries.append(entry)
+
+        connection.execute("DELETE FROM indexes")
+        connection.executemany(
+            f"INSERT INTO indexes ({', '.join(_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+            [tuple(entry[column] for column in _COLUMNS) for entry in entries],
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('built_at', ?)",
+            (str(time.time()),),
+        )
+        connection.commit()
+        return len(entries)
+
+    def rebuild(self) -> int:
+        """
+        Replace the content of the catalog by the indexes found on disk.
+        Directories without an index config are skipped.
+        :return: The number of indexes in the catalog.
+        """
+        with self._lock:
+            return self._rebuild(self._connect())
+
+    def refresh(self, index_id: str) -> Optional[Dict]:
+        """
+        Insert or update the entry of an index from its persist directory.
+        :param index_id: The id of the index.
+        :return: The new entry, None if the index does not exist (its entry is removed).
+        """
+        entry = describe_index_dir(self._storage_path / index_id)
+        if entry is None:
+            self.remove(index_id)
+            return None
+
+        with self._lock:
+            connection = self._connect()
+            previous = connection.execute(
+                "SELECT created_at FROM indexes WHERE index_id = ?", (index_id,)
+            ).fetchone()
+            if previous is not None:
+                entry["created_at"] = previous["created_at"]
+            connection.execute(
+                f"INSERT OR REPLACE INTO indexes ({', '.join(_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+                tuple(entry[column] for column in _COLUMNS),
+            )
+            connection.commit()
+        return entry
+
+    def remove(self, index_id: str) -> None:
+        """
+        :param index_id: The id of the index to remove from the catalog.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM indexes WHERE index_id = ?", (index_id,))
+            connection.commit()
+
+    def get(self, index_id: str) -> Optional[Dict]:
+        """
+        :param index_id: The id of the index.
+        :return: The catalog entry of the index, None if it is not in the catalog.
+        """
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT * FROM indexes WHERE index_id = ?", (index_id,))
+                .fetchone()
+            )
+        return dict(row) if row is not None else None
+
+    def list(
+        self,
+        document_name: Optional[str] = None,
+        name_contains: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> List[Dict]:
+        """
+        List catalog entries, oldest first.
+        :param document_name: Only the indexes of documents with this file name.
+        :param name_contains: Only the indexes whose document name contains this text.
+        :param content_hash: Only the indexes of documents with this content hash.
+        :param limit: The maximum number of entries, all of them if not given.
+        :param offset: The number of entries to skip, for pagination.
+        :return: The catalog entries.
+        """
+        where, params = self._filters(document_name, name_contains, content_hash)
+        query = f"SELECT * FROM indexes{where} ORDER BY created_at, index_id"
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset]
+        with self._lock:
+            rows = self._connect().execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(
+        self,
+        document_name: Optional[str] = None,
+        name_contains: Optional[str] = None,
+        content_hash: Optional[str] = None,
+    ) -> int:
+        """
+        :return: The number of catalog entries matching the filters of list.
+        """
+        where, params = self._filters(document_name, name_contains, content_hash)
+        with self._lock:
+            return (
+                self._connect()
+                .execute(f"SELECT COUNT(*) FROM indexes{where}", params)
+                .fetchone()[0]
+            )
+
+    @staticmethod
+    def _filters(
+        document_name: Optional[str],
+        name_contains: Optional[str],
+        content_hash: Optional[str],
+    ):
+        clauses, params = [], []
+        if document_name is not None:
+            clauses.append("document_name = ?")
+            params.append(document_name)
+        if name_contains:
+            clauses.append("instr(lower(document_name), lower(?)) > 0")
+            params.append(name_contains)
+        if content_hash is not None:
+            clauses.append("content_hash = ?")
+            params.append(content_hash)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+
+IndexCatalog = _IndexCatalog(
+    DATA_PATH / "index_catalog.sqlite3", RAG_STORAGE_PATH
+)  # Singleton instance shared by the whole process
+
+
+if __name__ == "__main__":
+    # Rebuild the catalog from the persist directories:
+    # python -m advanced_chatbot.services.index_catalog rebuild
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m advanced_chatbot.services.index_catalog rebuild")
+    print(f"{IndexCatalog.rebuild()} indexes in the catalog")
@@ -0,0 +1,495 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from advanced_chatbot.config import (
+    DEFAULT_INGESTION_JOB_TTL,
+    DEFAULT_INGESTION_MAX_FINISHED_JOBS,
+    DEFAULT_INGESTION_WORKERS,
+    DEFAULT_PRECOMPUTE_DOCUMENT_INSIGHTS,
+    DEFAULT_STREAMING_MIN_FILE_SIZE,
+    UPLOAD_STAGING_PATH,
+)
+from advanced_chatbot.services.document_parser import file_content_hash
+from advanced_chatbot.services.rag_service import RagService, _RagService
+
+logger = logging.getLogger(__name__)
+
+
+def staging_upload_path(filename: str) -> Path:
+    """
+    :param filename: The name of an uploaded document.
+    :return: A new path in UPLOAD_STAGING_PATH to write the upload to, before it is
+    submitted with its destination in DATA_PATH.
+    """
+    staging_dir = UPLOAD_STAGING_PATH / uuid.uuid4().hex
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    return staging_dir / Path(filename).name
+
+
+class IngestionJob:
+    """
+    Ingestion of one document, run stage by stage by the IngestionQueue.
+
+    The output of each completed stage is kept on the job, so that retrying a
+    failed job resumes from the stage that failed instead of starting over.
+
+    A job either creates a new index or updates an existing one in place. It
+    stops after hashing the document if the content is already indexed, or
+    being indexed by another job: it then waits for that job and gets its index.
+    An uploaded document is hashed where it was staged, and only moved to its
+    destination when it is not a duplicate.
+
+    Large documents are streamed (see DEFAULT_STREAMING_MIN_FILE_SIZE): the embed
+    stage parses, splits and embeds them batch by batch into a checkpoint on disk,
+    which a retry resumes from its last committed batch. A streamed update
+    replaces the index with the checkpoint, unchanged chunks getting their
+    embeddings from the embedding cache.
+    """
+
+    STAGES = ("hash", "parse", "split", "embed", "persist")
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    CREATE = "create"
+    UPDATE = "update"
+    DUPLICATE = "duplicate"
+
+    def __init__(
+        self,
+        document_path: Path,
+        index_id: Optional[str] = None,
+        destination: Optional[Path] = None,
+    ):
+        self.job_id = str(uuid.uuid4()).split("-")[0]
+        self.document_path = Path(document_path)
+        self.destination = Path(destination) if destination else None
+        self.action = self.UPDATE if index_id else self.CREATE
+        self.content_hash: Optional[str] = None
+        self.changes: Optional[Dict[str, int]] = None
+        self.streaming = False
+        self.status = self.QUEUED
+        self.stage: Optional[str] = None
+        self.completed_stages: List[str] = []
+        self.progress = {
+            "pages_parsed": 0,
+            "pages_total": 0,
+            "chunks_total": 0,
+            "chunks_embedded": 0,
+            "chunks_per_second": 0.0,
+        }
+        self.error: Optional[str] = None
+        self.index_id = index_id
+        self.attempts = 0
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+        # Intermediate results of the completed stages
+        self._documents = None
+        self._nodes = None
+        self._checkpoint = None
+        # Set when a run of the job ends, done or failed
+        self._finished = threading.Event()
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    @property
+    def fraction_done(self) -> float:
+        """
+        :return: Rough progress of the job between 0 and 1, embedding weighing most.
+        """
+        if self.status == self.DONE:
+            return 1.0
+        done = len(self.completed_stages) / len(self.STAGES)
+        if self.stage == "embed" and self.streaming and self.progress["pages_total"]:
+            done += (
+                self.progress["pages_parsed"]
+                / self.progress["pages_total"]
+                / len(self.STAGES)
+            )
+        elif self.stage == "embed" and self.progress["chunks_total"]:
+            done += (
+                self.progress["chunks_embedded"]
+                / self.progress["chunks_total"]
+                / len(self.STAGES)
+            )
+        return min(done, 1.0)
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "document_path": str(self.document_path),
+            "action": self.action,
+            "content_hash": self.content_hash,
+            "changes": dict(self.changes) if self.changes else None,
+            "streaming": self.streaming,
+            "status": self.status,
+            "stage": self.stage,
+            "completed_stages": list(self.completed_stages),
+            "progress": dict(self.progress),
+            "fraction_done": self.fraction_done,
+            "error": self.error,
+            "index_id": self.index_id,
+            "attempts": self.attempts,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class _IngestionQueue:
+    """
+    Background ingestion of documents by a bounded pool of workers.
+
+    Each submitted document becomes an IngestionJob whose status and progress can
+    be polled while a worker parses, splits, embeds and persists it. Finished jobs
+    are forgotten job_ttl seconds after they finished, the oldest ones sooner when
+    more than max_finished_jobs are kept.
+    """
+
+    def __init__(
+        self,
+        rag_service: _RagService,
+        max_workers: int,
+        job_ttl: float = DEFAULT_INGESTION_JOB_TTL,
+        max_finished_jobs: int = DEFAULT_INGESTION_MAX_FINISHED_JOBS,
+    ):
+        self._rag_service = rag_service
+        self._max_workers = max_workers
+        self._job_ttl = job_ttl
+        self._max_finished_jobs = max_finished_jobs
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._jobs: Dict[str, IngestionJob] = {}
+        # content hash -> id of the job creating its index, until the job ends
+        self._content_hashes: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers, thread_name_prefix="ingestion"
+            )
+        return self._executor
+
+    def submit(
+        self,
+        document_path: Path,
+        index_id: Optional[str] = None,
+        destination: Optional[Path] = None,
+    ) -> str:
+        """
+        Queue a document for ingestion.
+        A document already queued or running is not queued twice.
+        :param document_path: Path to the document( Absolute path of a pdf or docx file.)
+        :param index_id: The id of the index to update with this new version of its
+        document. A new index is created if not given.
+        :param destination: Where to move the document, see staging_upload_path, once
+        it is known not to be a duplicate. A duplicate is deleted instead. The
+        document stays at document_path if not given.
+        :return: The id of the ingestion job.
+        """
+        document_path = Path(document_path)
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if job.document_path == document_path and job.is_active:
+                    return job.job_id
+
+            job = IngestionJob(
+                document_path, index_id=index_id, destination=destination
+            )
+            self._jobs[job.job_id] = job
+            self._get_executor().submit(self._run, job)
+            return job.job_id
+
+    def retry(self, job_id: str) -> str:
+        """
+        Queue a failed job again, resuming after its last completed stage.
+        :param job_id: The id of the failed job.
+        :return: The id of the job.
+        """
+        job = self.get(job_id)
+        with self._lock:
+            if job.status != IngestionJob.FAILED:
+                raise ValueError(f"Job {job_id} has not failed, it is {job.status}.")
+            job.status = IngestionJob.QUEUED
+            job.error = None
+            job.finished_at = None
+            job._finished.clear()
+            if job.action == IngestionJob.CREATE and "hash" in job.completed_stages:
+                # Another job may have indexed the same content meanwhile
+                job.completed_stages.remove("hash")
+            self._get_executor().submit(self._run, job)
+        return job_id
+
+    def get(self, job_id: str) -> IngestionJob:
+        """
+        :param job_id: The id of the job.
+        :return: The ingestion job.
+        """
+        if job_id not in self._jobs:
+            raise ValueError(f"Ingestion job with id {job_id} does not exist.")
+        return self._jobs[job_id]
+
+    def status(self, job_id: str) -> Dict:
+        """
+        :param job_id: The id of the job.
+        :return: The status and progress of the job, as a dict.
+        """
+        return self.get(job_id).to_dict()
+
+    def list_jobs(self) -> List[Dict]:
+        """
+        :return: The status of every job, most recent first.
+        """
+        with self._lock:
+            self._prune()
+            jobs = sorted(self._jobs.values(), key=lambda job: -job.created_at)
+        return [job.to_dict() for job in jobs]
+
+    def _prune(self) -> None:
+        """
+        Forget the finished jobs older than job_ttl, then the oldest finished jobs
+        over max_finished_jobs. Called with the lock held.
+        """
+        now = time.time()
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished_at is not None),
+            key=lambda job: job.finished_at,
+        )
+        excess = len(finished) - self._max_finished_jobs
+        for i, job in enumerate(finished):
+            if i < excess or now - job.finished_at > self._job_ttl:
+                del self._jobs[job.job_id]
+
+    def _run(self, job: IngestionJob) -> None:
+        """
+        Run the stages of a job that are not completed yet.
+        """
+        job.status = IngestionJob.RUNNING
+        job.attempts += 1
+        try:
+            for stage in IngestionJob.STAGES:
+                if stage in job.completed_stages:
+                    continue
+                job.stage = stage
+                getattr(self, f"_{stage}")(job)
+                job.completed_stages.append(stage)
+                if job.action == IngestionJob.DUPLICATE:
+                    break
+        except Exception as e:
+            job.status = IngestionJob.FAILED
+            job.error = f"{type(e).__name__}: {e}"
+            job.finished_at = time.time()
+            logger.error(
+                "Ingestion job %s failed at stage %s\n%s",
+                job.job_id,
+                job.stage,
+                traceback.format_exc(),
+            )
+            self._release(job)
+            return
+
+        job.status = IngestionJob.DONE
+        job.stage = None
+        job.finished_at = time.time()
+        self._release(job)
+        # Intermediate results are not needed anymore
+        job._documents = job._nodes = job._checkpoint = None
+
+        if (
+            DEFAULT_PRECOMPUTE_DOCUMENT_INSIGHTS
+            and job.action != IngestionJob.DUPLICATE
+        ):
+            # Queued after the job is done, the document is searchable meanwhile
+            self._get_executor().submit(self._precompute_insights, job)
+
+    def _precompute_insights(self, job: IngestionJob) -> None:
+        try:
+            self._rag_service.precompute_document_insights(job.index_id)
+        except Exception:
+            logger.error(
+                "Computing the insights of index %s failed\n%s",
+                job.index_id,
+                traceback.format_exc(),
+            )
+
+    def _hash(self, job: IngestionJob) -> None:
+        job.content_hash = file_content_hash(job.document_path)
+        if job.action == IngestionJob.UPDATE:
+            index_config = self._rag_service.load_index_config(job.index_id)
+            if index_config.get("content_hash") == job.content_hash:
+                job.action = IngestionJob.DUPLICATE
+        else:
+            self._reserve(job)
+        if job.action == IngestionJob.CREATE:
+            # An index persisted by a job that released the content hash is found
+            index_id = self._rag_service.find_index_by_content_hash(job.content_hash)
+            if index_id is not None:
+                logger.info("%s is already indexed as %s", job.document_path, index_id)
+                job.index_id = index_id
+                job.action = IngestionJob.DUPLICATE
+        self._place(job)
+
+        if job.action != IngestionJob.DUPLICATE:
+            job.streaming = (
+                job.document_path.stat().st_size >= DEFAULT_STREAMING_MIN_FILE_SIZE
+            )
+
+    def _reserve(self, job: IngestionJob) -> None:
+        """
+        Make the job the one creating the index of its content hash. While another
+        active job holds it, wait for that job: once it is done the job is a
+        duplicate of its index, if it failed the job takes its place.
+        """
+        while True:
+            with self._lock:
+                owner = self._jobs.get(self._content_hashes.get(job.content_hash))
+                if owner is None or owner is job or not owner.is_active:
+                    self._content_hashes[job.content_hash] = job.job_id
+                    return
+            logger.info(
+                "%s is being indexed by job %s, waiting for it",
+                job.document_path,
+                owner.job_id,
+            )
+            owner._finished.wait()
+            if owner.status == IngestionJob.DONE:
+                job.index_id = owner.index_id
+                job.action = IngestionJob.DUPLICATE
+                return
+
+    def _release(self, job: IngestionJob) -> None:
+        """
+        Release the content hash of a job whose run ended, and wake up the jobs
+        waiting for it.
+        """
+        with self._lock:
+            if self._content_hashes.get(job.content_hash) == job.job_id:
+                del self._content_hashes[job.content_hash]
+        job._finished.set()
+
+    def _place(self, job: IngestionJob) -> None:
+        """
+        Move a staged upload to its destination, or delete it if it is a duplicate.
+        """
+        if job.destination is None or job.document_path == job.destination:
+            return
+        staged = job.document_path
+        if job.action == IngestionJob.DUPLICATE:
+            staged.unlink(missing_ok=True)
+        else:
+            with self._lock:
+                for other in self._jobs.values():
+                    if other.document_path == job.destination and other.is_active:
+                        raise RuntimeError(
+                            f"{job.destination.name} is being ingested by job "
+                            f"{other.job_id}, retry once it is done."
+                        )
+                job.destination.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(staged, job.destination)
+                job.document_path = job.destination
+        if staged.parent.parent == UPLOAD_STAGING_PATH:
+            # The directory created by staging_upload_path
+            shutil.rmtree(staged.parent, ignore_errors=True)
+
+    def _parse(self, job: IngestionJob) -> None:
+        if job.streaming:
+            # Pages are parsed batch by batch in the embed stage
+            return
+
+        def on_progress(parsed: int, total: int) -> None:
+            job.progress["pages_parsed"] = parsed
+
+        job._documents = self._rag_service.parse_document(
+            job.document_path, progress_callback=on_progress
+        )
+        job.progress["pages_parsed"] = len(job._documents)
+
+    def _split(self, job: IngestionJob) -> None:
+        if job.streaming:
+            return
+        if job.action == IngestionJob.UPDATE:
+            # Only changed pages are split, by update_vector_store_index
+            return
+        job._nodes = self._rag_service.split_documents(job._documents)
+        job.progress["chunks_total"] = len(job._nodes)
+
+    def _embed(self, job: IngestionJob) -> None:
+        if job.streaming:
+            self._stream(job)
+            return
+        if job.action == IngestionJob.UPDATE:
+            return
+        started_at = time.perf_counter()
+        resumed_from = sum(node.embedding is not None for node in job._nodes)
+
+        def on_progress(done: int, total: int) -> None:
+            job.progress["chunks_embedded"] = done
+            elapsed = time.perf_counter() - started_at
+            if elapsed > 0:
+                job.progress["chunks_per_second"] = (done - resumed_from) / elapsed
+
+        self._rag_service.embed_nodes(job._nodes, progress_callback=on_progress)
+
+    def _stream(self, job: IngestionJob) -> None:
+        started_at = time.perf_counter()
+        resumed_from = None
+
+        def on_progress(pages_done: int, pages_total: int, nodes_done: int) -> None:
+            nonlocal resumed_from
+            if resumed_from is None:
+                resumed_from = job.progress["chunks_embedded"]
+            job.progress["pages_parsed"] = pages_done
+            job.progress["pages_total"] = pages_total
+            job.progress["chunks_total"] = job.progress["chunks_embedded"] = nodes_done
+            elapsed = time.perf_counter() - started_at
+            if elapsed > 0:
+                job.progress["chunks_per_second"] = (
+                    nodes_done - resumed_from
+                ) / elapsed
+
+        # Resumes the checkpoint of a previous attempt, if any
+        job._checkpoint = self._rag_service.stream_document_to_checkpoint(
+            job.document_path,
+            index_id=job.index_id,
+            content_hash=job.content_hash,
+            progress_callback=on_progress,
+        )
+
+    def _persist(self, job: IngestionJob) -> None:
+        if job.streaming:
+            # An update replaces the index of job.index_id
+            job.index_id, _ = self._rag_service.build_index_from_checkpoint(
+                job._checkpoint, index_id=job.index_id
+            )
+            return
+
+        if job.action == IngestionJob.UPDATE:
+            job.changes = self._rag_service.update_vector_store_index(
+                job.index_id, job.document_path, documents=job._documents
+            )
+            job.progress["chunks_total"] = job.progress["chunks_embedded"] = (
+                job.changes["nodes_added"]
+            )
+            return
+
+        job.index_id, _ = self._rag_service.build_vector_store_index(
+            job._nodes, job.document_path, documents=job._documents
+        )
+
+
+IngestionQueue = _IngestionQueue(
+    RagService, max_workers=DEFAULT_INGESTION_WORKERS
+)  # Singleton instance shared by the whole process
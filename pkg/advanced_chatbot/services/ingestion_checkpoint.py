@@ -0,0 +1,245 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+from llama_index.core.schema import BaseNode, Document
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+from advanced_chatbot.services.page_store import PAGES_FNAME, PAGES_INDEX_FNAME
+
+CHECKPOINT_FNAME = "checkpoint.json"
+# Raw float32 rows, one per node, in node order
+EMBEDDINGS_PART_FNAME = "embeddings.f32"
+# One serialized node (without its embedding) per line
+NODES_PART_FNAME = "nodes.jsonl"
+# One line per page: its label, the size of its text in PAGES_FNAME and its record
+PAGE_RECORDS_PART_FNAME = "page_records.jsonl"
+# Appended files, truncated back to their committed size when a run resumes
+_PART_FNAMES = (
+    EMBEDDINGS_PART_FNAME,
+    NODES_PART_FNAME,
+    PAGES_FNAME,
+    PAGE_RECORDS_PART_FNAME,
+)
+
+
+class IngestionCheckpoint:
+    """
+    Staging area of a streamed ingestion, committed batch by batch.
+
+    Every batch of pages is appended to the staging files (embeddings, nodes,
+    page texts and page records), then committed by rewriting the checkpoint with
+    the new file sizes and counters. The checkpoint does not grow with the pages. Bytes written after the last commit, by a batch interrupted halfway,
+    are truncated when the checkpoint is opened again, so an ingestion resumes
+    from its last committed batch. Nothing but the current batch is held in
+    memory.
+    """
+
+    def __init__(self, staging_dir: Path, state: Dict):
+        self.staging_dir = Path(staging_dir)
+        self._state = state
+
+    @classmethod
+    def open(
+        cls,
+        staging_dir: Path,
+        index_id: str,
+        document_path: Path,
+        content_hash: str,
+    ) -> "IngestionCheckpoint":
+        """
+        Resume the checkpoint of a document, or start a new one.
+        :param staging_dir: The staging directory of the document.
+        :param index_id: The id of the index, used if the checkpoint is new.
+        :param document_path: Path to the document.
+        :param content_hash: The content hash of the document. A checkpoint left by
+        another version of the document is discarded.
+        :return: The checkpoint.
+        """
+        staging_dir = Path(staging_dir)
+        state = None
+        try:
+            with open(staging_dir / CHECKPOINT_FNAME, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        # Checkpoints holding their page records in the checkpoint file start over
+        if (
+            state is None
+            or state["content_hash"] != content_hash
+            or PAGE_RECORDS_PART_FNAME not in state["sizes"]
+        ):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            staging_dir.mkdir(parents=True, exist_ok=True)
+            state = {
+                "index_id": index_id,
+                "document_path": str(document_path),
+                "content_hash": content_hash,
+                "pages_total": None,
+                "pages_done": 0,
+                "nodes_done": 0,
+                "dim": None,
+                "sizes": {fname: 0 for fname in _PART_FNAMES},
+            }
+        state["document_path"] = str(document_path)
+
+        for fname, size in state["sizes"].items():
+            # Drop what an interrupted batch wrote after the last commit
+            with open(staging_dir / fname, "ab") as f:
+                f.truncate(size)
+        checkpoint = cls(staging_dir, state)
+        checkpoint._commit()
+        return checkpoint
+
+    @property
+    def index_id(self) -> str:
+        return self._state["index_id"]
+
+    @property
+    def document_path(self) -> str:
+        return self._state["document_path"]
+
+    @property
+    def content_hash(self) -> str:
+        return self._state["content_hash"]
+
+    @property
+    def pages_done(self) -> int:
+        return self._state["pages_done"]
+
+    @property
+    def pages_total(self) -> Optional[int]:
+        return self._state["pages_total"]
+
+    @property
+    def nodes_done(self) -> int:
+        return self._state["nodes_done"]
+
+    @property
+    def page_records(self) -> List[Dict]:
+        """
+        :return: The label, text hash and doc_id of every committed page.
+        """
+        return [line["record"] for line in self._iter_page_lines()]
+
+    def _iter_page_lines(self) -> Iterator[Dict]:
+        with open(
+            self.staging_dir / PAGE_RECORDS_PART_FNAME, "r", encoding="utf-8"
+        ) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def set_pages_total(self, pages_total: int) -> None:
+        self._state["pages_total"] = pages_total
+
+    def append_batch(
+        self,
+        documents: List[Document],
+        page_records: List[Dict],
+        nodes: List[BaseNode],
+        embeddings: np.ndarray,
+    ) -> None:
+        """
+        Append a batch of pages with their nodes and embeddings, and commit it.
+        :param documents: The pages of the batch.
+        :param page_records: The label, text hash and doc_id of every page.
+        :param nodes: The nodes split from the pages.
+        :param embeddings: One float32 embedding per node.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if len(nodes):
+            self._state["dim"] = embeddings.shape[1]
+
+        sizes = self._state["sizes"]
+        with open(self.staging_dir / EMBEDDINGS_PART_FNAME, "ab") as f:
+            sizes[EMBEDDINGS_PART_FNAME] += f.write(embeddings.tobytes())
+        with open(self.staging_dir / NODES_PART_FNAME, "ab") as f:
+            for node in nodes:
+                node.embedding = None
+                line = json.dumps(doc_to_json(node), ensure_ascii=False) + "\n"
+                sizes[NODES_PART_FNAME] += f.write(line.encode("utf-8"))
+        with open(self.staging_dir / PAGES_FNAME, "ab") as pages_f, open(
+            self.staging_dir / PAGE_RECORDS_PART_FNAME, "ab"
+        ) as records_f:
+            for document, record in zip(documents, page_records):
+                size = pages_f.write(document.text.encode("utf-8"))
+                sizes[PAGES_FNAME] += size
+                line = {
+                    "page_label": document.metadata.get("page_label"),
+                    "size": size,
+                    "record": record,
+                }
+                sizes[PAGE_RECORDS_PART_FNAME] += records_f.write(
+                    (json.dumps(line, ensure_ascii=False) + "\n").encode("utf-8")
+                )
+
+        self._state["pages_done"] += len(documents)
+        self._state["nodes_done"] += len(nodes)
+        self._commit()
+
+    def _commit(self) -> None:
+        for fname in _PART_FNAMES:
+            with open(self.staging_dir / fname, "ab") as f:
+                os.fsync(f.fileno())
+        path = self.staging_dir / CHECKPOINT_FNAME
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def iter_nodes(self, batch_size: int = 1024) -> Iterator[List[BaseNode]]:
+        """
+        :param batch_size: The number of nodes per batch.
+        :return: An iterator of batches of the committed nodes, in node order.
+        """
+        batch = []
+        with open(self.staging_dir / NODES_PART_FNAME, "r", encoding="utf-8") as f:
+            for line in f:
+                batch.append(json_to_doc(json.loads(line)))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def embeddings(self) -> np.ndarray:
+        """
+        :return: The committed embeddings, memory-mapped, of shape (nodes, dim).
+        """
+        if not self.nodes_done:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.memmap(
+            self.staging_dir / EMBEDDINGS_PART_FNAME,
+            dtype=np.float32,
+            mode="r",
+            shape=(self.nodes_done, self._state["dim"]),
+        )
+
+    def move_page_store(self, persist_dir: Path) -> None:
+        """
+        Move the committed page texts to the persist directory of the index, as a
+        page store (see PageStore).
+        :param persist_dir: The persist directory of the index.
+        """
+        persist_dir = Path(persist_dir)
+        table = {"page_labels": [], "offsets": [0]}
+        for line in self._iter_page_lines():
+            table["page_labels"].append(line["page_label"])
+            table["offsets"].append(table["offsets"][-1] + line["size"])
+        index_path = persist_dir / PAGES_INDEX_FNAME
+        with open(index_path.with_name(PAGES_INDEX_FNAME + ".tmp"), "w") as f:
+            json.dump(table, f)
+        os.replace(self.staging_dir / PAGES_FNAME, persist_dir / PAGES_FNAME)
+        os.replace(index_path.with_name(PAGES_INDEX_FNAME + ".tmp"), index_path)
+
+    def discard(self) -> None:
+        """
+        Delete the staging directory.
+        """
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
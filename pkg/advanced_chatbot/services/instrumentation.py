@@ -0,0 +1,444 @@
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Callable, Dict, IO, List, Optional, Union
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from advanced_chatbot.config import (
+    DEFAULT_INSTRUMENTATION_ENABLED,
+    DEFAULT_INSTRUMENTATION_JSONL_PATH,
+)
+
+# Upper bounds in seconds of the buckets of the duration histograms
+DURATION_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    math.inf,
+)
+
+
+class Span:
+    """
+    A timed stage of a RagService call.
+
+    :attributes are counts (nodes, tokens...) and flags (cache_hit...) of the stage.
+    :self_time is the duration minus the time spent in child spans of the same
+    thread, e.g. the prompt assembly of a chat turn without its retrieval.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict):
+        self.name = name
+        self.span_id = next(Span._ids)
+        self.parent = parent
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.children_time = 0.0
+        self._started = time.perf_counter()
+
+    @property
+    def self_time(self) -> float:
+        return max(self.duration - self.children_time, 0.0)
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "started_at": self.started_at,
+            "duration_s": self.duration,
+            "self_s": self.self_time,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """
+    What spans are when the instrumentation is disabled.
+    """
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _SpanContext:
+    def __init__(self, instrumentation: "_Instrumentation", span: Span):
+        self._instrumentation = instrumentation
+        self._span = span
+        self._token = None
+
+    def __enter__(self) -> Span:
+        self._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self._span.error = exc_type.__name__
+        self._instrumentation.finish(self._span)
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class SpanSink(ABC):
+    """
+    Receives every finished span. Sinks are called from the thread that ran the
+    span, they must be thread-safe.
+    """
+
+    @abstractmethod
+    def on_span(self, span: Span) -> None:
+        pass
+
+
+class MetricsAggregator(SpanSink):
+    """
+    In-memory aggregate of the spans, by span name: count, errors, total and self
+    time, duration histogram and the totals of the numeric attributes (a boolean
+    attribute like cache_hit counts the spans where it is true).
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._metrics: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def on_span(self, span: Span) -> None:
+        with self._lock:
+            metrics = self._metrics.get(span.name)
+            if metrics is None:
+                metrics = self._metrics[span.name] = {
+                    "count": 0,
+                    "errors": 0,
+                    "total_s": 0.0,
+                    "self_s": 0.0,
+                    "max_s": 0.0,
+                    "buckets": [0] * len(self._buckets),
+                    "attributes": {},
+                }
+            metrics["count"] += 1
+            metrics["errors"] += span.error is not None
+            metrics["total_s"] += span.duration
+            metrics["self_s"] += span.self_time
+            metrics["max_s"] = max(metrics["max_s"], span.duration)
+            for i, bound in enumerate(self._buckets):
+                if span.duration <= bound:
+                    metrics["buckets"][i] += 1
+                    break
+            for key, value in span.attributes.items():
+                if isinstance(value, (bool, int, float)):
+                    metrics["attributes"][key] = (
+                        metrics["attributes"].get(key, 0) + value
+                    )
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """
+        :return: By span name, count, errors, total_s, self_s, mean_s, max_s, the
+        cumulative histogram {upper bound: count} and the attribute totals.
+        """
+        with self._lock:
+            snapshot = {}
+            for name, metrics in sorted(self._metrics.items()):
+                cumulative = list(itertools.accumulate(metrics["buckets"]))
+                snapshot[name] = {
+                    "count": metrics["count"],
+                    "errors": metrics["errors"],
+                    "total_s": metrics["total_s"],
+                    "self_s": metrics["self_s"],
+                    "mean_s": metrics["total_s"] / metrics["count"],
+                    "max_s": metrics["max_s"],
+                    "histogram": dict(zip(self._buckets, cumulative)),
+                    "attributes": dict(metrics["attributes"]),
+                }
+            return snapshot
+
+    def reset(self) -> None:
+        with self._lock:
+            self._metrics.clear()
+
+    def to_prometheus(self, prefix: str = "rag") -> str:
+        """
+        :param prefix: The prefix of the metric names.
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            f"# HELP {prefix}_span_duration_seconds Duration of the RagService spans.",
+            f"# TYPE {prefix}_span_duration_seconds histogram",
+        ]
+        snapshot = self.snapshot()
+        for name, metrics in snapshot.items():
+            label = f'span="{name}"'
+            for bound, count in metrics["histogram"].items():
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(
+                    f'{prefix}_span_duration_seconds_bucket{{{label},le="{le}"}} {count}'
+                )
+            lines.append(
+                f"{prefix}_span_duration_seconds_sum{{{label}}} {metrics['total_s']}"
+            )
+            lines.append(
+                f"{prefix}_span_duration_seconds_count{{{label}}} {metrics['count']}"
+            )
+
+        lines.append(f"# TYPE {prefix}_span_self_seconds_total counter")
+        for name, metrics in snapshot.items():
+            lines.append(
+                f'{prefix}_span_self_seconds_total{{span="{name}"}} {metrics["self_s"]}'
+            )
+        lines.append(f"# TYPE {prefix}_span_errors_total counter")
+        for name, metrics in snapshot.items():
+            lines.append(
+                f'{prefix}_span_errors_total{{span="{name}"}} {metrics["errors"]}'
+            )
+        lines.append(f"# TYPE {prefix}_span_attribute_total counter")
+        for name, metrics in snapshot.items():
+            for key, value in sorted(metrics["attributes"].items()):
+                lines.append(
+                    f'{prefix}_span_attribute_total{{span="{name}",attribute="{key}"}} '
+                    f"{float(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+class JsonLinesSink(SpanSink):
+    """
+    Write every span as one JSON line, to a file or an open text stream.
+    """
+
+    def __init__(self, output: Union[str, Path, IO[str]]):
+        if isinstance(output, (str, Path)):
+            self._file = open(output, "a", encoding="utf-8", buffering=1)
+            self._owned = True
+        else:
+            self._file = output
+            self._owned = False
+        self._lock = threading.Lock()
+
+    def on_span(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self) -> None:
+        if self._owned:
+            self._file.close()
+
+
+class _Instrumentation:
+    """
+    Process-wide switch and sinks of the spans of the RagService.
+
+    While disabled, span() returns a shared no-op span and traced functions call
+    straight through, so the instrumented code costs one attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._sinks: List[SpanSink] = []
+
+    def enable(self, *sinks: SpanSink) -> None:
+        """
+        Start recording spans.
+        :param sinks: Sinks to add to the current ones.
+        """
+        self._sinks = self._sinks + [s for s in sinks if s not in self._sinks]
+        self.enabled = True
+
+    def disable(self) -> None:
+        """
+        Stop recording spans. The sinks are kept for a later enable().
+        """
+        self.enabled = False
+
+    def remove_sink(self, sink: SpanSink) -> None:
+        self._sinks = [s for s in self._sinks if s is not sink]
+
+    def span(self, name: str, **attributes: Any) -> Union[_SpanContext, _NoopSpan]:
+        """
+        :param name: The name of the stage.
+        :param attributes: Initial attributes of the span.
+        :return: A context manager timing its block, child of the current span.
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _SpanContext(self, Span(name, _current_span.get(), attributes))
+
+    def annotate(self, **attributes: Any) -> None:
+        """
+        Set attributes of the current span, if any.
+        """
+        if self.enabled:
+            span = _current_span.get()
+            if span is not None:
+                span.attributes.update(attributes)
+
+    def record(
+        self,
+        name: str,
+        duration: float,
+        parent: Optional[Span] = None,
+        **attributes: Any,
+    ) -> None:
+        """
+        Record a span measured elsewhere, e.g. an LLM stream consumed by the caller.
+        :param name: The name of the stage.
+        :param duration: Its duration in seconds.
+        :param parent: Its parent span, none by default.
+        """
+        if not self.enabled:
+            return
+        span = Span(name, None, attributes)
+        span.parent = parent
+        span.started_at -= duration
+        span.duration = duration
+        for sink in self._sinks:
+            sink.on_span(span)
+
+    def current_span(self) -> Optional[Span]:
+        return _current_span.get() if self.enabled else None
+
+    def finish(self, span: Span) -> None:
+        span.duration = time.perf_counter() - span._started
+        if span.parent is not None:
+            span.parent.children_time += span.duration
+        for sink in self._sinks:
+            sink.on_span(span)
+
+
+Instrumentation = _Instrumentation()  # Singleton instance
+Metrics = MetricsAggregator()  # Aggregate of the spans, see enable_default_sinks
+
+
+def enable_default_sinks() -> None:
+    """
+    Enable the instrumentation with the Metrics aggregator, and a JSON lines sink
+    when DEFAULT_INSTRUMENTATION_JSONL_PATH is set.
+    """
+    sinks = [Metrics]
+    if DEFAULT_INSTRUMENTATION_JSONL_PATH:
+        sinks.append(JsonLinesSink(DEFAULT_INSTRUMENTATION_JSONL_PATH))
+    Instrumentation.enable(*sinks)
+
+
+def traced(name: str) -> Callable:
+    """
+    Decorator timing every call of a function in a span named :name. The span of
+    a generator function lasts until the generator is exhausted or closed.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        if inspect.isgeneratorfunction(fn):
+
+            @functools.wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                if not Instrumentation.enabled:
+                    return (yield from fn(*args, **kwargs))
+                with Instrumentation.span(name):
+                    return (yield from fn(*args, **kwargs))
+
+            return generator_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not Instrumentation.enabled:
+                return fn(*args, **kwargs)
+            with Instrumentation.span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class TracedRetriever(BaseRetriever):
+    """
+    Retriever timing the query embedding and the search of another retriever.
+
+    When :embed_model is given, the query is embedded here ("embed_query" span) and
+    the wrapped retriever reuses the embedding, so the "search" span is the search
+    alone.
+    """
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        name: str = "retrieve",
+        embed_model: Optional[BaseEmbedding] = None,
+    ):
+        super().__init__()
+        self._retriever = retriever
+        self._name = name
+        self._embed_model = embed_model
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with Instrumentation.span(self._name) as span:
+            if self._embed_model is not None and query_bundle.embedding is None:
+                with Instrumentation.span("embed_query"):
+                    query_bundle.embedding = (
+                        self._embed_model.get_agg_embedding_from_queries(
+                            query_bundle.embedding_strs
+                        )
+                    )
+            with Instrumentation.span("search"):
+                nodes = self._retriever.retrieve(query_bundle)
+            span.set(nodes=len(nodes))
+        return nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with Instrumentation.span(self._name) as span:
+            if self._embed_model is not None and query_bundle.embedding is None:
+                with Instrumentation.span("embed_query"):
+                    query_bundle.embedding = (
+                        await self._embed_model.aget_agg_embedding_from_queries(
+                            query_bundle.embedding_strs
+                        )
+                    )
+            with Instrumentation.span("search"):
+                nodes = await self._retriever.aretrieve(query_bundle)
+            span.set(nodes=len(nodes))
+        return nodes
+
+
+if DEFAULT_INSTRUMENTATION_ENABLED:
+    enable_default_sinks()
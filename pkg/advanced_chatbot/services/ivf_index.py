@@ -0,0 +1,477 @@
+"""
+Inverted-file (IVF-flat) approximate nearest-neighbour index in pure NumPy.
+
+Embeddings are clustered with spherical k-means. A query is compared with the
+cluster centroids first, and only the embeddings of the :nprobe closest clusters
+are scored exactly. Raising nprobe trades latency for recall, nprobe equal to
+the number of clusters is an exact search. The nprobe of an index can be
+calibrated when it is built: the smallest one reaching a target recall@k on
+held-out rows, rows the centroids were not trained on and that are not searched.
+
+Recall report against brute force, with held-out rows as queries, on random
+clustered data or on the embeddings of a persisted index:
+
+    python -m advanced_chatbot.services.ivf_index --rows 200000 --dim 256
+    python -m advanced_chatbot.services.ivf_index --index-id 1a2b3c4d
+"""
+
+import argparse
+import hashlib
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from advanced_chatbot.services.quantization import normalize
+
+IVF_INDEX_FNAME = "ivf_index.npz"
+
+# Rows scored at once, bounds the size of the temporary score matrices
+_BLOCK_ROWS = 16384
+
+
+def _assign(
+    vectors: np.ndarray, centroids: np.ndarray, normalized: bool = False
+) -> np.ndarray:
+    """
+    :return: The position of the closest centroid (by cosine) of every vector.
+    """
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _BLOCK_ROWS):
+        block = vectors[start : start + _BLOCK_ROWS]
+        if not normalized:
+            block = normalize(block)
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(
+    vectors: np.ndarray,
+    n_clusters: int,
+    n_iter: int = 20,
+    max_train_rows: int = 256,
+    seed: int = 0,
+    rows: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Cluster vectors by cosine similarity.
+    :param vectors: Array of shape (rows, dim).
+    :param n_clusters: The number of clusters.
+    :param n_iter: The number of k-means iterations.
+    :param max_train_rows: Centroids are trained on at most this many rows per cluster.
+    :param seed: Seed of the sampling, the same seed gives the same centroids.
+    :param rows: The rows the centroids may be trained on, all of them if None.
+    :return: The unit-norm centroids, of shape (n_clusters, dim).
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.arange(len(vectors)) if rows is None else np.asarray(rows)
+    n_clusters = max(1, min(n_clusters, len(rows)))
+    train_rows = min(len(rows), n_clusters * max_train_rows)
+    sample = np.sort(rng.choice(rows, train_rows, replace=False))
+    train = normalize(vectors[sample])
+    centroids = train[rng.choice(len(train), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = _assign(train, centroids, normalized=True)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_clusters)
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+        centroids[non_empty] = normalize(np.add.reduceat(train[order], starts))
+        # Empty clusters restart from random training rows
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = train[rng.choice(len(train), len(empty))]
+    return centroids
+
+
+def node_ids_digest(node_ids: Sequence[str]) -> str:
+    """
+    :param node_ids: The node ids of the embedding rows, in row order.
+    :return: A digest telling whether an IVF index was built on these exact rows.
+    """
+    digest = hashlib.sha256()
+    for node_id in node_ids:
+        digest.update(node_id.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class IVFIndex:
+    """
+    Cluster centroids plus inverted lists of row positions.
+
+    The embeddings themselves are not copied: the index only tells which rows of
+    the caller's embedding matrix are worth scoring for a query.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        list_rows: np.ndarray,
+        node_ids_digest: str = "",
+        nprobe: int = 0,
+    ):
+        self.centroids = centroids
+        # Rows of list c are list_rows[list_offsets[c]:list_offsets[c + 1]]
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.node_ids_digest = node_ids_digest
+        # Calibrated number of clusters searched per query, 0 if not calibrated
+        self.nprobe = nprobe
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.list_rows)
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        n_lists: Optional[int] = None,
+        node_ids: Optional[Sequence[str]] = None,
+        seed: int = 0,
+        target_recall: Optional[float] = None,
+        similarity_top_k: int = 4,
+        calibration_queries: int = 1000,
+    ) -> "IVFIndex":
+        """
+        Cluster the embeddings and build the inverted lists.
+        :param embeddings: Array of shape (rows, dim).
+        :param n_lists: The number of clusters, 4 * sqrt(rows) if not given.
+        :param node_ids: The node ids of the rows, checked when the index is loaded.
+        :param seed: Seed of the clustering.
+        :param target_recall: If given, the nprobe of the index is calibrated to reach
+        this recall@:similarity_top_k on :calibration_queries held-out rows.
+        :return: The built index.
+        """
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(embeddings))))
+        rng = np.random.default_rng(seed)
+        held_out = np.empty(0, dtype=np.int64)
+        if target_recall is not None:
+            num_held_out = min(calibration_queries, len(embeddings) // 10)
+            held_out = np.sort(rng.choice(len(embeddings), num_held_out, replace=False))
+        train_rows = np.setdiff1d(np.arange(len(embeddings)), held_out)
+
+        centroids = spherical_kmeans(embeddings, n_lists, seed=seed, rows=train_rows)
+        assignments = _assign(embeddings, centroids)
+        list_rows = np.argsort(assignments, kind="stable").astype(np.int64)
+        list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignments, minlength=len(centroids))))
+        ).astype(np.int64)
+        digest = node_ids_digest(node_ids) if node_ids is not None else ""
+        index = cls(centroids, list_offsets, list_rows, digest)
+        if len(held_out):
+            index.nprobe = calibrate_nprobe(
+                index.centroids,
+                assignments,
+                embeddings,
+                held_out,
+                similarity_top_k,
+                target_recall,
+            )
+        return index
+
+    def candidates(
+        self, query_embedding: Sequence[float], nprobe: Optional[int] = None
+    ) -> np.ndarray:
+        """
+        :param query_embedding: The query embedding.
+        :param nprobe: The number of clusters to search, the calibrated one if None
+        (every cluster if the index is not calibrated).
+        :return: The rows of the :nprobe clusters closest to the query, in
+        increasing row order.
+        """
+        if nprobe is None:
+            nprobe = self.nprobe or self.n_lists
+        if nprobe >= self.n_lists:
+            return np.arange(self.num_rows)
+        query = normalize(query_embedding)
+        scores = self.centroids @ query
+        probes = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        rows = np.concatenate(
+            [
+                self.list_rows[self.list_offsets[c] : self.list_offsets[c + 1]]
+                for c in probes.tolist()
+            ]
+        )
+        rows.sort()
+        return rows
+
+    def search(
+        self,
+        embeddings: np.ndarray,
+        query_embedding: Sequence[float],
+        similarity_top_k: int,
+        nprobe: Optional[int] = None,
+    ) -> List[int]:
+        """
+        Approximate top-k by cosine similarity.
+        :param embeddings: The embedding matrix the index was built on.
+        :param query_embedding: The query embedding.
+        :param similarity_top_k: The number of results.
+        :param nprobe: The number of clusters to search, see candidates.
+        :return: The rows of the best matches, best first.
+        """
+        rows = self.candidates(query_embedding, nprobe)
+        scores = normalize(embeddings[rows]) @ normalize(query_embedding)
+        k = min(similarity_top_k, len(rows))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return rows[best].tolist()
+
+    def save(self, persist_dir: Path) -> None:
+        """
+        Write the index next to the embeddings it was built on.
+        :param persist_dir: The persist directory of the vector store index.
+        """
+        path = Path(persist_dir) / IVF_INDEX_FNAME
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                list_offsets=self.list_offsets,
+                list_rows=self.list_rows,
+                node_ids_digest=np.array(self.node_ids_digest),
+                nprobe=np.array(self.nprobe),
+            )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(
+        cls, persist_dir: Path, node_ids: Optional[Sequence[str]] = None
+    ) -> Optional["IVFIndex"]:
+        """
+        :param persist_dir: The persist directory of the vector store index.
+        :param node_ids: The node ids of the current embedding rows.
+        :return: The persisted index, None if there is none or if it was built on
+        other rows than :node_ids.
+        """
+        path = Path(persist_dir) / IVF_INDEX_FNAME
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            index = cls(
+                data["centroids"],
+                data["list_offsets"],
+                data["list_rows"],
+                str(data["node_ids_digest"]),
+                # Indexes saved before the calibration search every cluster
+                int(data["nprobe"]) if "nprobe" in data else 0,
+            )
+        if node_ids is not None and (
+            index.num_rows != len(node_ids)
+            or index.node_ids_digest != node_ids_digest(node_ids)
+        ):
+            return None
+        return index
+
+    @staticmethod
+    def remove(persist_dir: Path) -> None:
+        """
+        Delete the persisted index of a directory, if any.
+        """
+        (Path(persist_dir) / IVF_INDEX_FNAME).unlink(missing_ok=True)
+
+
+def exact_top_k(
+    embeddings: np.ndarray,
+    query_embedding: Sequence[float],
+    similarity_top_k: int,
+    normalized: bool = False,
+) -> List[int]:
+    """
+    :param normalized: Whether the rows of :embeddings already have a unit norm.
+    :return: The rows of the exact top-k by cosine similarity, best first.
+    """
+    query = normalize(query_embedding)
+    scores = np.concatenate(
+        [
+            (block if normalized else normalize(block)) @ query
+            for block in (
+                embeddings[start : start + _BLOCK_ROWS]
+                for start in range(0, len(embeddings), _BLOCK_ROWS)
+            )
+        ]
+    )
+    k = min(similarity_top_k, len(scores))
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind="stable")].tolist()
+
+
+def calibrate_nprobe(
+    centroids: np.ndarray,
+    assignments: np.ndarray,
+    embeddings: np.ndarray,
+    held_out: np.ndarray,
+    similarity_top_k: int,
+    target_recall: float,
+) -> int:
+    """
+    :param centroids: The centroids of the index.
+    :param assignments: The cluster of every row of :embeddings.
+    :param embeddings: The indexed rows.
+    :param held_out: The rows used as queries, excluded from the searched rows.
+    :param similarity_top_k: The k of recall@k.
+    :param target_recall: The recall@k to reach.
+    :return: The smallest nprobe whose recall@k over the held-out queries is at
+    least :target_recall.
+    """
+    queries = normalize(embeddings[held_out])
+    k = min(similarity_top_k, len(embeddings) - len(held_out))
+    # Exact top-k of every query, merged block by block
+    truth = np.empty((len(queries), 0), dtype=np.int64)
+    truth_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(embeddings), _BLOCK_ROWS):
+        block = normalize(embeddings[start : start + _BLOCK_ROWS])
+        scores = queries @ block.T
+        in_block = held_out[(held_out >= start) & (held_out < start + len(block))]
+        scores[:, in_block - start] = -np.inf
+        rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+        scores = np.concatenate([truth_scores, scores], axis=1)
+        rows = np.concatenate([truth, rows], axis=1)
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        truth_scores = np.take_along_axis(scores, best, axis=1)
+        truth = np.take_along_axis(rows, best, axis=1)
+
+    # Rank of every cluster for every query, 0 for the closest centroid
+    cluster_ranks = np.empty((len(queries), len(centroids)), dtype=np.int64)
+    order = np.argsort(-(queries @ centroids.T), axis=1)
+    np.put_along_axis(cluster_ranks, order, np.arange(len(centroids))[None, :], axis=1)
+    # A true neighbour is found once the rank of its cluster is below nprobe
+    needed = np.sort(
+        np.take_along_axis(cluster_ranks, assignments[truth], axis=1).ravel()
+    )
+    found = int(np.ceil(target_recall * len(needed)))
+    return int(needed[max(found, 1) - 1]) + 1
+
+
+def recall_report(
+    index: IVFIndex,
+    embeddings: np.ndarray,
+    queries: np.ndarray,
+    similarity_top_k: int,
+    nprobes: Sequence[int],
+) -> List[Dict[str, float]]:
+    """
+    Measure recall@k and latency of the IVF index against brute force.
+    :param index: The IVF index built on :embeddings.
+    :param embeddings: The embedding matrix.
+    :param queries: Query embeddings, of shape (queries, dim). Stored rows make
+    optimistic queries: use held-out rows or real queries.
+    :param similarity_top_k: The k of recall@k.
+    :param nprobes: The nprobe values to measure.
+    :return: One row per nprobe (plus one for brute force, nprobe 0) with the
+    recall@k, the mean latency in ms and the fraction of rows scored.
+    """
+    embeddings = normalize(embeddings)
+    started_at = time.perf_counter()
+    truth = [
+        set(exact_top_k(embeddings, query, similarity_top_k, normalized=True))
+        for query in queries
+    ]
+    exact_ms = (time.perf_counter() - started_at) * 1000 / len(queries)
+    report = [{"nprobe": 0, "recall": 1.0, "latency_ms": exact_ms, "scanned": 1.0}]
+
+    for nprobe in nprobes:
+        hits, scanned = 0, 0
+        started_at = time.perf_counter()
+        for query, expected in zip(queries, truth):
+            found = index.search(embeddings, query, similarity_top_k, nprobe)
+            hits += len(expected.intersection(found))
+        latency_ms = (time.perf_counter() - started_at) * 1000 / len(queries)
+        for query in queries:
+            scanned += len(index.candidates(query, nprobe))
+        report.append(
+            {
+                "nprobe": nprobe,
+                "recall": hits / sum(len(expected) for expected in truth),
+                "latency_ms": latency_ms,
+                "scanned": scanned / (len(queries) * len(embeddings)),
+            }
+        )
+    return report
+
+
+def _clustered_embeddings(
+    rows: int, dim: int, n_topics: int, seed: int = 0
+) -> np.ndarray:
+    """
+    Random embeddings grouped around topics, closer to real text embeddings than
+    uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    topics = normalize(rng.standard_normal((n_topics, dim)))
+    embeddings = topics[rng.integers(0, n_topics, rows)]
+    embeddings += rng.standard_normal((rows, dim)).astype(np.float32) * 0.08
+    return normalize(embeddings)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--index-id", help="Measure on the embeddings of this index")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument(
+        "--target-recall",
+        type=float,
+        default=0.95,
+        help="Also report the nprobe calibrated for this recall@k",
+    )
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(1)
+    if args.index_id:
+        from advanced_chatbot.config import RAG_STORAGE_PATH
+
+        embeddings = np.load(
+            RAG_STORAGE_PATH / args.index_id / "embeddings.npy", mmap_mode="r"
+        )
+    else:
+        embeddings = _clustered_embeddings(args.rows, args.dim, n_topics=1000)
+    # Held-out chunks stand in for the queries: they are neither indexed nor used
+    # to train the centroids, so a query never finds itself
+    held_out = rng.choice(len(embeddings), args.queries, replace=False)
+    queries = np.asarray(embeddings[held_out], dtype=np.float32)
+    embeddings = np.delete(np.asarray(embeddings), held_out, axis=0)
+
+    started_at = time.perf_counter()
+    index = IVFIndex.build(
+        embeddings,
+        n_lists=args.n_lists,
+        target_recall=args.target_recall,
+        similarity_top_k=args.k,
+    )
+    print(
+        f"{len(embeddings)} rows x {embeddings.shape[1]} dims, {index.n_lists} lists "
+        f"built in {time.perf_counter() - started_at:.1f} s, nprobe {index.nprobe} "
+        f"calibrated for recall@{args.k} {args.target_recall}"
+    )
+    args.nprobe = sorted(set(args.nprobe) | {index.nprobe})
+    print(
+        f"{'nprobe':>8} {'recall@' + str(args.k):>10} {'ms/query':>10} {'scanned':>8}"
+    )
+    for row in recall_report(index, embeddings, queries, args.k, args.nprobe):
+        print(
+            f"{row['nprobe'] or 'exact':>8} {row['recall']:>10.3f} "
+            f"{row['latency_ms']:>10.2f} {row['scanned']:>8.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Offline language identification with character n-gram profiles.
+
+Every language has the ranked list of its most frequent character n-grams (1 to
+4 characters, words padded with spaces), built from the texts of
+resources/language_corpus and shipped in resources/language_profiles.json. A text
+gets the language whose profile is the closest to its own n-gram ranking, with the
+out-of-place distance of Cavnar & Trenkle. Detecting a few pages takes milliseconds.
+
+The confidence threshold of the callers is calibrated on the held-out sentences of
+resources/language_heldout, which are not part of the profiles, and on sentences of
+languages without a profile:
+
+    python -m advanced_chatbot.services.language_id "Quelle est la langue de ce texte ?"
+    python -m advanced_chatbot.services.language_id --build
+    python -m advanced_chatbot.services.language_id --calibrate
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+RESOURCES_PATH = Path(__file__).parent.parent / "resources"
+PROFILES_PATH = RESOURCES_PATH / "language_profiles.json"
+CORPUS_PATH = RESOURCES_PATH / "language_corpus"
+# One <code>.txt file of held-out sentences per language, and UNSUPPORTED_FNAME
+HELDOUT_PATH = RESOURCES_PATH / "language_heldout"
+# "<code>\t<sentence>" lines of languages without a profile
+UNSUPPORTED_FNAME = "unsupported.tsv"
+
+DEFAULT_MAX_NGRAM = 4
+DEFAULT_PROFILE_SIZE = 400
+# Below this many letters the closest profile is a guess, whatever its margin
+DEFAULT_MIN_LETTERS = 60
+
+_WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+
+def extract_ngrams(text: str, max_n: int = DEFAULT_MAX_NGRAM) -> Counter:
+    """
+    :param text: Any text. Digits, punctuation and symbols are ignored.
+    :param max_n: The length of the longest n-grams.
+    :return: The count of every n-gram of 1 to :max_n characters of the words of
+    the text, lowercased and padded with one space on each side.
+    """
+    counts = Counter()
+    text = unicodedata.normalize("NFC", text.lower())
+    for word in _WORD_PATTERN.findall(text):
+        padded = f" {word} "
+        for n in range(1, max_n + 1):
+            for i in range(len(padded) - n + 1):
+                counts[padded[i : i + n]] += 1
+    del counts[" "]
+    return counts
+
+
+def build_profile(
+    text: str, size: int = DEFAULT_PROFILE_SIZE, max_n: int = DEFAULT_MAX_NGRAM
+) -> List[str]:
+    """
+    :return: The :size most frequent n-grams of the text, most frequent first.
+    """
+    ranked = sorted(extract_ngrams(text, max_n).items(), key=lambda kv: (-kv[1], kv[0]))
+    return [ngram for ngram, _ in ranked[:size]]
+
+
+def count_letters(text: str) -> int:
+    """
+    :return: The number of letters of the text, the characters its n-grams use.
+    """
+    return sum(len(word) for word in _WORD_PATTERN.findall(text))
+
+
+def _prefix(text: str, letters: int) -> str:
+    """
+    :return: The first words of the text holding at least :letters letters.
+    """
+    words, count = [], 0
+    for word in text.split():
+        words.append(word)
+        count += count_letters(word)
+        if count >= letters:
+            break
+    return " ".join(words)
+
+
+class _LanguageIdentifier:
+    """
+    Language identifier over the profiles of a profiles file, read on first use.
+    """
+
+    def __init__(self, profiles_path: Path):
+        self._profiles_path = profiles_path
+        self._ranks: Optional[Dict[str, Dict[str, int]]] = None
+        self._size = DEFAULT_PROFILE_SIZE
+        self._max_n = DEFAULT_MAX_NGRAM
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict[str, int]]:
+        if self._ranks is None:
+            with self._lock:
+                if self._ranks is None:
+                    with open(self._profiles_path, "r", encoding="utf-8") as f:
+                        content = json.load(f)
+                    self._size = content["profile_size"]
+                    self._max_n = content["max_ngram"]
+                    self._ranks = {
+                        language: {ngram: rank for rank, ngram in enumerate(profile)}
+                        for language, profile in content["profiles"].items()
+                    }
+        return self._ranks
+
+    @property
+    def languages(self) -> List[str]:
+        """
+        :return: The codes of the languages that can be detected.
+        """
+        return sorted(self._load())
+
+    def distances(self, text: str) -> List[Tuple[str, float]]:
+        """
+        :param text: The text to identify.
+        :return: The normalized out-of-place distance (0 for the same ranking, 1
+        when no n-gram is shared) of the text to every language, closest first.
+        Empty if the text has no letters.
+        """
+        ranks = self._load()
+        profile = build_profile(text, self._size, self._max_n)
+        if not profile:
+            return []
+        max_distance = len(profile) * self._size
+        distances = []
+        for language, language_ranks in ranks.items():
+            distance = 0
+            for rank, ngram in enumerate(profile):
+                language_rank = language_ranks.get(ngram)
+                distance += (
+                    self._size if language_rank is None else abs(language_rank - rank)
+                )
+            distances.append((language, distance / max_distance))
+        return sorted(distances, key=lambda kv: kv[1])
+
+    def detect(
+        self, text: str, min_letters: int = DEFAULT_MIN_LETTERS
+    ) -> Tuple[Optional[str], float]:
+        """
+        :param text: The text to identify, a few hundred characters or more.
+        :param min_letters: Texts with fewer letters get a confidence of 0.
+        :return: The ISO 639-1 code of its language and a confidence between 0
+        and 1: the relative margin between the distances of the closest and the
+        second closest languages. It is close to 0 for texts mixing languages and
+        languages without a profile, see calibrate. (None, 0.0) if the text has no
+        letters.
+        """
+        distances = self.distances(text)
+        if not distances:
+            return None, 0.0
+        if len(distances) == 1:
+            language, confidence = distances[0][0], 1.0 - distances[0][1]
+        else:
+            (language, best), (_, second) = distances[0], distances[1]
+            confidence = (second - best) / second if second > 0 else 0.0
+        if count_letters(text) < min_letters:
+            confidence = 0.0
+        return language, confidence
+
+
+def build_profiles(
+    corpus_path: Path = CORPUS_PATH,
+    profiles_path: Path = PROFILES_PATH,
+    size: int = DEFAULT_PROFILE_SIZE,
+    max_n: int = DEFAULT_MAX_NGRAM,
+) -> List[str]:
+    """
+    Build the profiles file from a corpus directory holding one <code>.txt file
+    per language.
+    :return: The codes of the languages of the profiles.
+    """
+    profiles = {
+        path.stem: build_profile(path.read_text(encoding="utf-8"), size, max_n)
+        for path in sorted(Path(corpus_path).glob("*.txt"))
+    }
+    content = {"profile_size": size, "max_ngram": max_n, "profiles": profiles}
+    tmp_path = Path(profiles_path).with_name(Path(profiles_path).name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(content, f, ensure_ascii=False)
+    os.replace(tmp_path, profiles_path)
+    return list(profiles)
+
+
+LanguageIdentifier = _LanguageIdentifier(PROFILES_PATH)  # Singleton instance
+
+
+def calibrate(
+    heldout_path: Path = HELDOUT_PATH,
+    min_letters: int = DEFAULT_MIN_LETTERS,
+    identifier: _LanguageIdentifier = LanguageIdentifier,
+) -> Dict:
+    """
+    Find the confidence above which detect is never wrong on held-out text.
+    Every held-out sentence is detected whole and cut to its first :min_letters
+    letters, the shortest text detect trusts. Sentences of languages without a
+    profile are always wrong.
+    :param heldout_path: The directory of the held-out sentences.
+    :param min_letters: See detect.
+    :param identifier: The identifier to calibrate.
+    :return: {"min_confidence": the highest confidence of a wrong detection,
+    "languages": {code: {"texts", "accuracy", "recall"}}} where recall is the
+    fraction of texts detected correctly with a confidence above min_confidence.
+    """
+    heldout_path = Path(heldout_path)
+    results: Dict[str, List[Tuple[bool, float]]] = {}
+    for path in sorted(heldout_path.glob("*.txt")):
+        for line in path.read_text(encoding="utf-8").splitlines():
+            for text in (line, _prefix(line, min_letters)):
+                language, confidence = identifier.detect(text, min_letters)
+                results.setdefault(path.stem, []).append(
+                    (language == path.stem, confidence)
+                )
+    unsupported_path = heldout_path / UNSUPPORTED_FNAME
+    if unsupported_path.exists():
+        for line in unsupported_path.read_text(encoding="utf-8").splitlines():
+            code, sentence = line.split("\t", 1)
+            for text in (sentence, _prefix(sentence, min_letters)):
+                _, confidence = identifier.detect(text, min_letters)
+                results.setdefault(code, []).append((False, confidence))
+
+    min_confidence = max(
+        (
+            confidence
+            for detections in results.values()
+            for correct, confidence in detections
+            if not correct
+        ),
+        default=0.0,
+    )
+    return {
+        "min_confidence": min_confidence,
+        "languages": {
+            code: {
+                "texts": len(detections),
+                "accuracy": sum(correct for correct, _ in detections) / len(detections),
+                "recall": sum(
+                    correct and confidence > min_confidence
+                    for correct, confidence in detections
+                )
+                / len(detections),
+            }
+            for code, detections in results.items()
+        },
+    }
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("text", nargs="?", help="The text to identify")
+    parser.add_argument(
+        "--calibrate",
+        action="store_true",
+        help=f"Measure the confidence of the detections of {HELDOUT_PATH.name}",
+    )
+    parser.add_argument(
+        "--min-letters",
+        type=int,
+        default=DEFAULT_MIN_LETTERS,
+        help="Texts with fewer letters get a confidence of 0",
+    )
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help=f"Rebuild {PROFILES_PATH.name} from the texts of {CORPUS_PATH.name}",
+    )
+    args = parser.parse_args(argv)
+
+    if args.build:
+        languages = build_profiles()
+        print(f"Profiles of {', '.join(languages)} written to {PROFILES_PATH}")
+    if args.calibrate:
+        report = calibrate(min_letters=args.min_letters)
+        for code, row in report["languages"].items():
+            print(
+                f"{code}  texts {row['texts']:3d}  accuracy {row['accuracy']:.3f}  "
+                f"recall {row['recall']:.3f}"
+            )
+        print(
+            f"Highest confidence of a wrong detection: {report['min_confidence']:.4f}"
+        )
+    if args.text:
+        for language, distance in LanguageIdentifier.distances(args.text):
+            print(f"{language}  {distance:.4f}")
+        language, confidence = LanguageIdentifier.detect(args.text, args.min_letters)
+        print(f"Detected: {language} (confidence {confidence:.3f})")
+
+
+if __name__ == "__main__":
+    main()
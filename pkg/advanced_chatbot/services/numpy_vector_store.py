@@ -0,0 +1,301 @@
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+from advanced_chatbot.services.ivf_index import IVFIndex
+
+# File names of the binary layout, next to docstore.json and index_store.json
+EMBEDDINGS_FNAME = "embeddings.npy"
+VECTOR_IDS_FNAME = "vector_ids.json"
+# File name of the legacy JSON layout written by SimpleVectorStore
+JSON_VECTOR_STORE_FNAME = "default__vector_store.json"
+
+
+def _atomic_write(path: Path, write_fn) -> None:
+    """
+    Write a file through a temporary file so readers never see a partial file.
+    :param path: The destination path.
+    :param write_fn: Callable receiving the opened temporary file.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Vector store persisting embeddings as a raw float32 .npy matrix.
+
+    On load the matrix is memory-mapped read-only: nothing is parsed or copied,
+    and processes loading the same index share the same pages.
+    Node ids and their reference document ids are kept in a compact JSON table,
+    row i of the matrix being the embedding of node_ids[i].
+    """
+
+    stores_text: bool = False
+
+    def __init__(
+        self,
+        embeddings: Optional[np.ndarray] = None,
+        node_ids: Optional[List[str]] = None,
+        ref_doc_ids: Optional[List[str]] = None,
+    ):
+        self._embeddings = embeddings
+        self._node_ids: List[str] = list(node_ids or [])
+        self._ref_doc_ids: List[str] = list(ref_doc_ids or [])
+        self._id_to_row = {node_id: row for row, node_id in enumerate(self._node_ids)}
+        self._norms: Optional[np.ndarray] = None
+        # Rows added since the last consolidation, appended lazily
+        self._pending: List[np.ndarray] = []
+        # Optional approximate search, only valid for the rows it was built on
+        self.ann_index: Optional[IVFIndex] = None
+        self.ann_nprobe: Optional[int] = None
+
+    @property
+    def client(self) -> None:
+        """Get client."""
+        return
+
+    @property
+    def dim(self) -> Optional[int]:
+        matrix = self.get_embeddings()[1]
+        return matrix.shape[1] if matrix.size else None
+
+    def __len__(self) -> int:
+        return len(self._node_ids)
+
+    def _consolidate(self) -> np.ndarray:
+        """
+        Merge pending rows into the embedding matrix.
+        :return: The full embedding matrix.
+        """
+        if self._pending:
+            blocks = list(self._pending)
+            if self._embeddings is not None and len(self._embeddings):
+                blocks.insert(0, self._embeddings)
+            self._embeddings = np.concatenate(blocks, axis=0).astype(np.float32)
+            self._pending = []
+            self._norms = None
+        if self._embeddings is None:
+            self._embeddings = np.empty((0, 0), dtype=np.float32)
+        return self._embeddings
+
+    def set_ann_index(
+        self, ann_index: Optional[IVFIndex], nprobe: Optional[int] = None
+    ) -> None:
+        """
+        Search the candidate rows of an IVF index instead of every row.
+        The IVF index is dropped as soon as rows are added or deleted.
+        :param ann_index: An IVF index built on the current rows, None for exact search.
+        :param nprobe: The number of clusters searched per query, the calibrated one
+        of the IVF index if None.
+        """
+        self.ann_index = ann_index
+        self.ann_nprobe = nprobe
+
+    def get_embeddings(self) -> Tuple[List[str], np.ndarray]:
+        """
+        :return: A tuple (node_ids, embeddings), one embedding row per node id.
+        """
+        return self._node_ids, self._consolidate()
+
+    def get(self, text_id: str) -> List[float]:
+        """Get embedding."""
+        return self._consolidate()[self._id_to_row[text_id]].tolist()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Add nodes to index."""
+        if not nodes:
+            return []
+        rows = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        for node in nodes:
+            self._id_to_row[node.node_id] = len(self._node_ids)
+            self._node_ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id or "None")
+        self._pending.append(rows)
+        self.ann_index = None
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Delete the nodes of a reference document, or a single node by its id.
+        :param ref_doc_id: The doc_id of the document (or the id of the node) to delete.
+        """
+        keep = [
+            row
+            for row, (node_id, doc_id) in enumerate(
+                zip(self._node_ids, self._ref_doc_ids)
+            )
+            if doc_id != ref_doc_id and node_id != ref_doc_id
+        ]
+        if len(keep) == len(self._node_ids):
+            return
+
+        matrix = self._consolidate()
+        self._embeddings = np.ascontiguousarray(matrix[keep])
+        self._node_ids = [self._node_ids[row] for row in keep]
+        self._ref_doc_ids = [self._ref_doc_ids[row] for row in keep]
+        self._id_to_row = {node_id: row for row, node_id in enumerate(self._node_ids)}
+        self._norms = None
+        self.ann_index = None
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Get nodes for response."""
+        if query.filters is not None:
+            raise ValueError("Metadata filters are not supported by NumpyVectorStore.")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+
+        matrix = self._consolidate()
+        if not len(self._node_ids):
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        if self._norms is None:
+            self._norms = np.linalg.norm(matrix, axis=1)
+            self._norms[self._norms == 0] = 1.0
+
+        rows = None
+        if query.node_ids is not None and len(query.node_ids) != len(self._node_ids):
+            rows = np.array(
+                [self._id_to_row[i] for i in query.node_ids if i in self._id_to_row],
+                dtype=np.int64,
+            )
+        elif self.ann_index is not None:
+            rows = self.ann_index.candidates(query.query_embedding, self.ann_nprobe)
+
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query_embedding) or 1.0
+        if rows is None:
+            scores = (matrix @ query_embedding) / (self._norms * query_norm)
+        else:
+            scores = (matrix[rows] @ query_embedding) / (self._norms[rows] * query_norm)
+
+        k = min(query.similarity_top_k, len(scores))
+        if k == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        best_rows = best if rows is None else rows[best]
+
+        return VectorStoreQueryResult(
+            similarities=scores[best].tolist(),
+            ids=[self._node_ids[row] for row in best_rows.tolist()],
+        )
+
+    async def aquery(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> VectorStoreQueryResult:
+        """Get nodes for response, in a worker thread to keep the event loop free."""
+        return await asyncio.to_thread(self.query, query, **kwargs)
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """
+        Persist the embeddings next to the other stores.
+        :param persist_path: The path StorageContext gives to the vector store, only
+        its directory is used.
+        """
+        persist_dir = Path(persist_path).parent
+        persist_dir.mkdir(parents=True, exist_ok=True)
+        node_ids, matrix = self.get_embeddings()
+
+        _atomic_write(
+            persist_dir / EMBEDDINGS_FNAME,
+            lambda f: np.save(f, np.ascontiguousarray(matrix, dtype=np.float32)),
+        )
+
+        # Reference document ids repeat for every node of a page, store them once.
+        ref_doc_table: Dict[str, int] = {}
+        ref_doc_rows = [
+            ref_doc_table.setdefault(doc_id, len(ref_doc_table))
+            for doc_id in self._ref_doc_ids
+        ]
+        vector_ids = {
+            "node_ids": node_ids,
+            "ref_doc_ids": list(ref_doc_table),
+            "ref_doc_rows": ref_doc_rows,
+        }
+        _atomic_write(
+            persist_dir / VECTOR_IDS_FNAME,
+            lambda f: f.write(json.dumps(vector_ids).encode("utf-8")),
+        )
+
+    @classmethod
+    def from_persist_dir(
+        cls, persist_dir: Path, mmap: bool = True
+    ) -> "NumpyVectorStore":
+        """
+        Load a persisted store.
+        :param persist_dir: The directory of the index.
+        :param mmap: Memory-map the embedding matrix instead of reading it.
+        """
+        persist_dir = Path(persist_dir)
+        embeddings = np.load(
+            persist_dir / EMBEDDINGS_FNAME, mmap_mode="r" if mmap else None
+        )
+        with open(persist_dir / VECTOR_IDS_FNAME, "r") as f:
+            vector_ids = json.load(f)
+        ref_doc_ids = [
+            vector_ids["ref_doc_ids"][row] for row in vector_ids["ref_doc_rows"]
+        ]
+        return cls(embeddings, vector_ids["node_ids"], ref_doc_ids)
+
+    @staticmethod
+    def exists(persist_dir: Path) -> bool:
+        """
+        Check whether an index directory uses the binary layout.
+        """
+        return (Path(persist_dir) / EMBEDDINGS_FNAME).exists()
+
+
+def convert_json_vector_store(persist_dir: Path) -> bool:
+    """
+    Convert an index persisted with the JSON layout to the binary layout.
+    :param persist_dir: The directory of the index.
+    :return: True if the index was converted, False if there was nothing to convert.
+    """
+    persist_dir = Path(persist_dir)
+    json_path = persist_dir / JSON_VECTOR_STORE_FNAME
+    if not json_path.exists():
+        return False
+
+    with open(json_path, "r") as f:
+        data = json.load(f)
+
+    embedding_dict = data.get("embedding_dict", {})
+    node_ids = list(embedding_dict.keys())
+    ref_doc_map = data.get("text_id_to_ref_doc_id", {})
+    embeddings = np.asarray([embedding_dict[i] for i in node_ids], dtype=np.float32)
+    store = NumpyVectorStore(
+        embeddings.reshape(len(node_ids), -1),
+        node_ids,
+        [ref_doc_map.get(i, "None") for i in node_ids],
+    )
+    store.persist(str(json_path))
+    json_path.unlink()
+    return True
+
+
+if __name__ == "__main__":
+    # One-shot conversion of every persisted index:
+    # python -m advanced_chatbot.services.numpy_vector_store [index_id ...]
+    from advanced_chatbot.config import RAG_STORAGE_PATH
+
+    index_ids = sys.argv[1:] or [
+        p.name for p in RAG_STORAGE_PATH.iterdir() if p.is_dir()
+    ]
+    for index_id in index_ids:
+        converted = convert_json_vector_store(RAG_STORAGE_PATH / index_id)
+        print(f"{index_id}: {'converted' if converted else 'nothing to convert'}")
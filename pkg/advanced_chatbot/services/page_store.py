@@ -0,0 +1,123 @@
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+# Texts of all the pages, utf-8 encoded and concatenated
+PAGES_FNAME = "pages.bin"
+# Page labels and byte offsets of every page in PAGES_FNAME
+PAGES_INDEX_FNAME = "pages_index.json"
+
+
+class PageStore:
+    """
+    Extracted page texts of a document, persisted next to its index.
+
+    The texts are concatenated in a single blob and located by an offset table,
+    so any page or range of pages is read with one seek, without re-parsing the
+    original document (which may not even exist anymore).
+    """
+
+    def __init__(self, persist_dir: Path):
+        self._persist_dir = Path(persist_dir)
+        with open(self._persist_dir / PAGES_INDEX_FNAME, "r") as f:
+            table = json.load(f)
+        self.page_labels: List[Optional[str]] = table["page_labels"]
+        self._offsets: List[int] = table["offsets"]
+        self._positions = {}
+        for position, page_label in enumerate(self.page_labels):
+            self._positions.setdefault(page_label, position)
+
+    def __len__(self) -> int:
+        return len(self.page_labels)
+
+    @staticmethod
+    def exists(persist_dir: Path) -> bool:
+        """
+        :param persist_dir: The persist directory of an index.
+        :return: True if a page store was written in the directory.
+        """
+        persist_dir = Path(persist_dir)
+        return (persist_dir / PAGES_INDEX_FNAME).exists() and (
+            persist_dir / PAGES_FNAME
+        ).exists()
+
+    @staticmethod
+    def write(
+        persist_dir: Path, page_labels: Sequence[Optional[str]], texts: Sequence[str]
+    ) -> "PageStore":
+        """
+        Write (or replace) the page store of an index.
+        :param persist_dir: The persist directory of the index.
+        :param page_labels: The label of every page, in page order.
+        :param texts: The text of every page, in page order.
+        :return: The written page store.
+        """
+        persist_dir = Path(persist_dir)
+        offsets = [0]
+        blob_path = persist_dir / PAGES_FNAME
+        with open(blob_path.with_name(PAGES_FNAME + ".tmp"), "wb") as f:
+            for text in texts:
+                offsets.append(offsets[-1] + f.write(text.encode("utf-8")))
+        index_path = persist_dir / PAGES_INDEX_FNAME
+        with open(index_path.with_name(PAGES_INDEX_FNAME + ".tmp"), "w") as f:
+            json.dump({"page_labels": list(page_labels), "offsets": offsets}, f)
+
+        # The blob goes first, the old offset table never points into a new blob
+        # for longer than the two renames
+        os.replace(blob_path.with_name(PAGES_FNAME + ".tmp"), blob_path)
+        os.replace(index_path.with_name(PAGES_INDEX_FNAME + ".tmp"), index_path)
+        return PageStore(persist_dir)
+
+    def get_pages(self, start: int, end: int) -> List[str]:
+        """
+        :param start: Position of the first page (0 for the first page of the document).
+        :param end: Position after the last page.
+        :return: The texts of the pages in [start, end).
+        """
+        start, end, _ = slice(start, end).indices(len(self))
+        if start >= end:
+            return []
+        base = self._offsets[start]
+        with open(self._persist_dir / PAGES_FNAME, "rb") as f:
+            f.seek(base)
+            blob = f.read(self._offsets[end] - base)
+        offsets = [offset - base for offset in self._offsets[start : end + 1]]
+        return [
+            blob[offsets[i] : offsets[i + 1]].decode("utf-8")
+            for i in range(len(offsets) - 1)
+        ]
+
+    def get_page(self, position: int) -> str:
+        """
+        :param position: Position of the page (0 for the first page of the document).
+        :return: The text of the page.
+        """
+        if not -len(self) <= position < len(self):
+            raise IndexError(f"Page {position} out of range ({len(self)} pages).")
+        position %= len(self)
+        return self.get_pages(position, position + 1)[0]
+
+    def get_page_by_label(self, page_label: str) -> Optional[str]:
+        """
+        :param page_label: The label of the page, as in the page_label metadata.
+        :return: The text of the first page with this label, None if there is none.
+        """
+        position = self._positions.get(page_label)
+        return None if position is None else self.get_page(position)
+
+    def sample_pages(self, num_pages: int, max_chars: int) -> List[str]:
+        """
+        Pick pages spread evenly over the document, always the same ones.
+        :param num_pages: The maximum number of pages to pick.
+        :param max_chars: Every picked page is cut to its first max_chars characters.
+        :return: The beginning of the picked pages, empty pages being skipped.
+        """
+        positions = [i for i in range(len(self)) if self._page_size(i) > 0]
+        if len(positions) > num_pages:
+            step = len(positions) / num_pages
+            positions = [positions[int(i * step)] for i in range(num_pages)]
+        return [self.get_page(position)[:max_chars] for position in positions]
+
+    def _page_size(self, position: int) -> int:
+        return self._offsets[position + 1] - self._offsets[position]
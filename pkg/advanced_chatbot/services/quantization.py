@@ -0,0 +1,184 @@
+"""
+Compact embedding codes for in-memory similarity search.
+
+"float16" halves the memory of float32 embeddings, "int8" divides it by four
+(plus one float32 scale per vector). Candidates found with the codes are then
+rescored against the float32 embeddings to recover exact scores and order.
+
+Accuracy report of every mode on random clustered data or on a persisted index:
+
+    python -m advanced_chatbot.services.quantization --rows 50000 --dim 1536
+    python -m advanced_chatbot.services.quantization --index-id 1a2b3c4d
+"""
+
+import argparse
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+QUANTIZATION_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# Rows decoded at once, bounds the size of the temporary float32 blocks
+_BLOCK_ROWS = 16384
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    :return: The vectors scaled to unit norm (zero vectors are left unchanged).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize(
+    vectors: np.ndarray, dtype: str
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Encode unit-norm vectors.
+    :param vectors: Array of shape (rows, dim), L2-normalized.
+    :param dtype: "float32", "float16" or "int8".
+    :return: A tuple (codes, scales). scales holds one float32 per row for int8,
+    it is None for the float types.
+    """
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return np.asarray(vectors, dtype=QUANTIZATION_DTYPES[dtype]), None
+
+
+def quantized_scores(
+    codes: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray
+) -> np.ndarray:
+    """
+    Approximate dot products of a query with encoded vectors, decoded by blocks.
+    :param codes: The codes returned by quantize.
+    :param scales: The scales returned by quantize.
+    :param query: A unit-norm float32 query.
+    :return: One approximate score per row of :codes.
+    """
+    if codes.dtype == np.float32:
+        return codes @ query
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), _BLOCK_ROWS):
+        block = codes[start : start + _BLOCK_ROWS].astype(np.float32)
+        scores[start : start + len(block)] = block @ query
+    if scales is not None:
+        scores *= scales
+    return scores
+
+
+def top_k_positions(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    :return: The positions of the :k highest scores, highest first.
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+def accuracy_report(
+    embeddings: np.ndarray,
+    queries: np.ndarray,
+    similarity_top_k: int,
+    rescore_factor: int,
+    dtypes: Sequence[str] = ("float16", "int8"),
+) -> List[Dict[str, float]]:
+    """
+    Measure the effect of each code type on the top-k of cosine similarity.
+    :param embeddings: The float32 embeddings.
+    :param queries: Query embeddings, of shape (queries, dim).
+    :param similarity_top_k: The k of recall@k.
+    :param rescore_factor: similarity_top_k * rescore_factor candidates are rescored.
+    :param dtypes: The code types to measure.
+    :return: One row per code type: bytes per vector, recall@k of the codes alone,
+    recall@k after rescoring, and the largest score error of the codes.
+    """
+    vectors = normalize(embeddings)
+    queries = normalize(queries)
+    truth = [
+        set(top_k_positions(vectors @ query, similarity_top_k).tolist())
+        for query in queries
+    ]
+
+    report = []
+    for dtype in dtypes:
+        codes, scales = quantize(vectors, dtype)
+        hits, rescored_hits, max_error = 0, 0, 0.0
+        started_at = time.perf_counter()
+        for query, expected in zip(queries, truth):
+            scores = quantized_scores(codes, scales, query)
+            hits += len(
+                expected.intersection(
+                    top_k_positions(scores, similarity_top_k).tolist()
+                )
+            )
+            candidates = top_k_positions(scores, similarity_top_k * rescore_factor)
+            exact = vectors[candidates] @ query
+            rescored = candidates[top_k_positions(exact, similarity_top_k)]
+            rescored_hits += len(expected.intersection(rescored.tolist()))
+            max_error = max(max_error, float(np.abs(exact - scores[candidates]).max()))
+        total = sum(len(expected) for expected in truth)
+        report.append(
+            {
+                "dtype": dtype,
+                "bytes_per_vector": codes.itemsize * codes.shape[1]
+                + (4 if scales is not None else 0),
+                "recall": hits / total,
+                "recall_rescored": rescored_hits / total,
+                "max_score_error": max_error,
+                "latency_ms": (time.perf_counter() - started_at) * 1000 / len(queries),
+            }
+        )
+    return report
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--index-id", help="Measure on the embeddings of this index")
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    if args.index_id:
+        from advanced_chatbot.config import RAG_STORAGE_PATH
+
+        embeddings = np.load(RAG_STORAGE_PATH / args.index_id / "embeddings.npy")
+    else:
+        topics = normalize(rng.standard_normal((1000, args.dim)))
+        embeddings = topics[rng.integers(0, len(topics), args.rows)]
+        embeddings += rng.standard_normal(embeddings.shape).astype(np.float32) * 0.03
+    # Stored chunks with some noise stand in for the queries
+    queries = embeddings[rng.choice(len(embeddings), args.queries)]
+    queries = queries + rng.standard_normal(queries.shape).astype(np.float32) * 0.02
+
+    print(
+        f"{len(embeddings)} rows x {embeddings.shape[1]} dims, recall@{args.k}, "
+        f"{args.k * args.rescore_factor} candidates rescored"
+    )
+    print(
+        f"{'dtype':>8} {'bytes/vec':>10} {'recall':>8} {'rescored':>9} "
+        f"{'max err':>9} {'ms/query':>9}"
+    )
+    for row in accuracy_report(embeddings, queries, args.k, args.rescore_factor):
+        print(
+            f"{row['dtype']:>8} {row['bytes_per_vector']:>10} {row['recall']:>8.3f} "
+            f"{row['recall_rescored']:>9.3f} {row['max_score_error']:>9.1e} "
+            f"{row['latency_ms']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,118 @@
 import json
-import random
-from typing import Dict, Generator, List, Tuple
+import threading
+import time
+from typing import Callable, Dict, Generator, List, Optional, Tuple
 import uuid
+import numpy as np
 from llama_index.core import VectorStoreIndex
 from pathlib import Path
-from typing import List
-from llama_index_client import ChatMessage, Document
 from llama_index.core import SimpleDirectoryReader
 
 from advanced_chatbot.config import (
     DATA_PATH,
+    DEFAULT_ANN_ENABLED,
+    DEFAULT_ANN_LISTS,
+    DEFAULT_ANN_MIN_ROWS,
+    DEFAULT_ANN_NPROBE,
+    DEFAULT_ANN_TARGET_RECALL,
+    DEFAULT_CONTEXT_DUPLICATE_THRESHOLD,
+    DEFAULT_CONTEXT_TOKEN_BUDGET,
+    DEFAULT_EMBEDDING_CACHE_ENABLED,
+    DEFAULT_EMBEDDING_MATRIX_DTYPE,
+    DEFAULT_INSIGHTS_PAGE_CHARS,
+    DEFAULT_LANGUAGE_MIN_CONFIDENCE,
+    DEFAULT_LANGUAGE_MIN_LETTERS,
+    DEFAULT_LANGUAGE_SAMPLE_PAGES,
+    DEFAULT_MEMORY_RECENT_TOKEN_LIMIT,
+    DEFAULT_MEMORY_SUMMARY_MAX_WORDS,
+    DEFAULT_PARSE_PARALLEL_MIN_PAGES,
+    DEFAULT_PARSE_WORKERS,
     DEFAULT_RAG_CHUNK_OVERLAP,
     DEFAULT_RAG_CHUNK_SIZE,
+    DEFAULT_RAG_RETRIEVAL_MODE,
     DEFAULT_RAG_SIMILARITY_TOP_K,
     DEFAULT_RAG_TOKEN_LIMIT,
+    DEFAULT_RAG_VECTOR_FORMAT,
     DEFAULT_RAG_WINDOW_SIZE,
+    DEFAULT_RESCORE_FACTOR,
+    DEFAULT_STREAMING_BATCH_PAGES,
+    DEFAULT_SUMMARY_CHUNKS_PER_CLUSTER,
+    DEFAULT_SUMMARY_CLUSTERS,
+    DEFAULT_SUMMARY_MAP_CONCURRENCY,
+    DEFAULT_SUMMARY_MODE,
+    DEFAULT_SUMMARY_SAMPLE_PAGES,
+    DEFAULT_SUMMARY_TOKEN_BUDGET,
+    INGESTION_CHECKPOINT_PATH,
+    LLM_MODEL_NAME,
+    OPENAI_API_BASE,
     OPENAI_API_KEY,
+    OPENAI_EMBEDDING_MODEL,
+    OPENAI_LLM_MODEL,
+    RAG_STORAGE_PATH,
     USE_MOCK_MODELS,
 )
+from advanced_chatbot.services.chat_stream import ChatStream
+from advanced_chatbot.services.cluster_summary import (
+    fit_token_budget,
+    map_reduce_summary,
+    representative_rows,
+)
+from advanced_chatbot.services.context_assembly import ContextAssemblyPostProcessor
+from advanced_chatbot.services.conversation_memory import ConversationMemory
+from advanced_chatbot.services.document_insights import (
+    insights_fingerprint,
+    load_insights,
+    save_insights,
+)
+from advanced_chatbot.services.document_parser import (
+    count_pdf_pages,
+    file_content_hash,
+    iter_pdf_page_batches,
+    page_content_hash,
+    parse_pdf_in_parallel,
+)
+from advanced_chatbot.services.embedding_cache import CachedEmbedding, EmbeddingCache
+from advanced_chatbot.services.embedding_pipeline import EmbeddingPipeline
+from advanced_chatbot.services.embedding_matrix import (
+    EmbeddingMatrix,
+    MatrixRetriever,
+    VectorStoreRows,
+    index_embeddings,
+)
+from advanced_chatbot.services.index_cache import IndexCache
+from advanced_chatbot.services.index_catalog import IndexCatalog
+from advanced_chatbot.services.ingestion_checkpoint import IngestionCheckpoint
+from advanced_chatbot.services.instrumentation import (
+    Instrumentation,
+    TracedRetriever,
+    traced,
+)
+from advanced_chatbot.services.ivf_index import IVFIndex
+from advanced_chatbot.services.language_id import LanguageIdentifier
+from advanced_chatbot.services.numpy_vector_store import (
+    EMBEDDINGS_FNAME,
+    NumpyVectorStore,
+)
+from advanced_chatbot.services.page_store import PageStore
+from advanced_chatbot.services.sentence_window import (
+    CompactSentenceWindowNodeParser,
+    SentenceWindowPostProcessor,
+    window_node_id,
+)
 
-from llama_index.core.llms import MockLLM
+from llama_index.core.llms import LLM, MockLLM
 from llama_index.core import MockEmbedding
+from llama_index.core.base.embeddings.base import BaseEmbedding
 
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core.node_parser import (
-    SentenceSplitter,
-    SentenceWindowNodeParser,
-)
+from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core import StorageContext, load_index_from_storage
-from llama_index.core.retrievers import QueryFusionRetriever
-from llama_index.core.chat_engine import ContextChatEngine
-from llama_index.core.memory.chat_memory_buffer import (
-    ChatMemoryBuffer,
-)
-from llama_index.core.schema import NodeWithScore
-from llama_index.core.postprocessor import MetadataReplacementPostProcessor
-from llama_index.core.chat_engine.types import (
-    StreamingAgentChatResponse,
-)
+from llama_index.core.data_structs.data_structs import IndexDict
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import BaseNode, Document, MetadataMode, NodeWithScore
 from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.utils import get_tokenizer
 from llama_index.core import ChatPromptTemplate
 import shutil
 
@@ -76,6 +149,13 @@ SUMMARIZATION_USER_PROMPT = """
 """
 
 
+PART_SUMMARIZATION_SYSTEM_PROMPT = """
+You will be given excerpts about one topic of a longer document.
+Summarize the main points of these excerpts in french, in two or three sentences.
+Directly provide the summary and nothing else.
+"""
+
+
 LANGUAGE_DETECTION_SYSTEM_PROMPT = """
 You are a language detection tool. Given a text, you should detect the language of the text.
 If french, respon with 'fr', if english respond with 'en'. etc. 
@@ -84,7 +164,33 @@ In the short version of the language.
 Don't always with nothing but that short version of the language.
 """
 
-RAG_STORAGE_PATH = DATA_PATH / "rag_storage"
+# Prompt of summarize_content, {source_text} being the content to summarize
+SUMMARIZATION_PROMPT = ChatPromptTemplate(
+    message_templates=[
+        ChatMessage(role=MessageRole.SYSTEM, content=SUMMARIZATION_SYSTEM_PROMPT),
+        ChatMessage(role=MessageRole.USER, content=SUMMARIZATION_USER_PROMPT),
+    ]
+)
+
+# Prompt of the summary of one cluster of a document, see DEFAULT_SUMMARY_MODE
+PART_SUMMARIZATION_PROMPT = ChatPromptTemplate(
+    message_templates=[
+        ChatMessage(role=MessageRole.SYSTEM, content=PART_SUMMARIZATION_SYSTEM_PROMPT),
+        ChatMessage(role=MessageRole.USER, content=SUMMARIZATION_USER_PROMPT),
+    ]
+)
+
+# Prompts the stored document insights depend on, changing one recomputes them
+INSIGHTS_PROMPTS = [
+    TRANSLATION_SYSTEM_PROMPT,
+    TRANSATION_USER_PROMPT,
+    SUMMARIZATION_SYSTEM_PROMPT,
+    SUMMARIZATION_USER_PROMPT,
+    PART_SUMMARIZATION_SYSTEM_PROMPT,
+    LANGUAGE_DETECTION_SYSTEM_PROMPT,
+    # Not a prompt, but the summary depends on it too
+    f"summary_mode={DEFAULT_SUMMARY_MODE}",
+]
 
 
 class _RagService:
@@ -93,38 +199,142 @@ class _RagService:
     """
 
     def __init__(self):
-        self.__init_llm_and_embedding()
+        # Models are created on first use, importing the OpenAI clients is slow
+        self._llm: Optional[LLM] = None
+        # Known without creating the LLM, see __cached_insight
+        self._llm_model_name = LLM_MODEL_NAME
+        self._embedding: Optional[BaseEmbedding] = None
+        self._models_lock = threading.Lock()
         RAG_STORAGE_PATH.mkdir(parents=True, exist_ok=True)
-
-    def __init_llm_and_embedding(self) -> None:
+        # Embeddings of every index used in matrix retrieval mode
+        self._embedding_matrix = EmbeddingMatrix(
+            dtype=DEFAULT_EMBEDDING_MATRIX_DTYPE, rescore_factor=DEFAULT_RESCORE_FACTOR
+        )
+        # The matrix only holds the rows of the cached indexes
+        IndexCache.add_removal_listener(self._embedding_matrix.remove_index)
+        # One lock per index, so that an insight is never computed twice at once
+        self._insights_locks: Dict[str, threading.Lock] = {}
+        self._insights_locks_guard = threading.Lock()
+
+    @staticmethod
+    def __create_llm() -> LLM:
         """
-        Initialize the language model and the embedding.
+        Create the language model.
         """
+        if USE_MOCK_MODELS:
+            return MockLLM(max_tokens=256)
+
+        from llama_index.llms.openai import OpenAI
 
+        return OpenAI(api_key=OPENAI_API_KEY, model=OPENAI_LLM_MODEL)
+
+    @staticmethod
+    def __create_embedding() -> BaseEmbedding:
+        """
+        Create the embedding model.
+        """
         if USE_MOCK_MODELS:
-            self._llm = MockLLM(max_tokens=256)
-            self._embedding = MockEmbedding(embed_dim=1536)
+            embedding = MockEmbedding(embed_dim=1536)
         else:
-            self._llm = OpenAI(api_key=OPENAI_API_KEY, model="gpt-3.5-turbo")
-            self._embedding = OpenAIEmbedding(
-                api_key=OPENAI_API_KEY, model="text-embedding-3-small"
+            from llama_index.embeddings.openai import OpenAIEmbedding
+
+            embedding = OpenAIEmbedding(
+                api_key=OPENAI_API_KEY,
+                api_base=OPENAI_API_BASE,
+                model=OPENAI_EMBEDDING_MODEL,
             )
 
-    def parse_document(self, document_path: Path) -> List[Document]:
+        if DEFAULT_EMBEDDING_CACHE_ENABLED:
+            # Identical chunks are never embedded twice, whatever their index
+            embedding = CachedEmbedding(embedding, EmbeddingCache)
+        return embedding
+
+    def use_models(
+        self, llm: Optional[LLM] = None, embed_model: Optional[BaseEmbedding] = None
+    ) -> None:
+        """
+        Replace the language model and/or the embedding model, e.g. by deterministic
+        fakes in the benchmarks. The embedding model is cached like the default one.
+        :param llm: The new language model, unchanged if not given.
+        :param embed_model: The new embedding model, unchanged if not given.
+        """
+        with self._models_lock:
+            if llm is not None:
+                self._llm = llm
+                self._llm_model_name = llm.metadata.model_name
+            if embed_model is not None:
+                self._embedding = embed_model
+                if DEFAULT_EMBEDDING_CACHE_ENABLED:
+                    self._embedding = CachedEmbedding(embed_model, EmbeddingCache)
+
+    @property
+    def llm(self) -> LLM:
+        """
+        The language model answering the chats, created on first use.
+        """
+        if self._llm is None:
+            with self._models_lock:
+                if self._llm is None:
+                    self._llm = self.__create_llm()
+        return self._llm
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        """
+        The embedding model of the chunks and the queries, created on first use.
+        """
+        if self._embedding is None:
+            with self._models_lock:
+                if self._embedding is None:
+                    self._embedding = self.__create_embedding()
+        return self._embedding
+
+    @traced("parse_document")
+    def parse_document(
+        self,
+        document_path: Path,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> List[Document]:
         """
         Read a document and return a list of pages.
+        Large pdf files are parsed by page ranges in a process pool
+        (see DEFAULT_PARSE_WORKERS and DEFAULT_PARSE_PARALLEL_MIN_PAGES).
         :param document_path: Path to the document( Absolute path of a pdf or docx file.)
         ex: document_path = "/home/user/toto.pdf"
+        :param progress_callback: Called with (pages parsed, total pages).
         :return: List[Document] : A list of Document objects.
 
         """
+        document_path = Path(document_path)
         file_extension = document_path.suffix
 
         if file_extension not in [".pdf", ".docx"]:
             raise ValueError("The document must be a pdf or a docx file.")
 
-        reader = SimpleDirectoryReader(input_files=[document_path])
-        return reader.load_data()
+        # Docx files have no pages to split on, they are always parsed serially
+        num_pages = None
+        if file_extension == ".pdf" and DEFAULT_PARSE_WORKERS > 1:
+            num_pages = count_pdf_pages(document_path)
+
+        if num_pages is not None and num_pages >= DEFAULT_PARSE_PARALLEL_MIN_PAGES:
+            documents = parse_pdf_in_parallel(
+                document_path,
+                num_workers=DEFAULT_PARSE_WORKERS,
+                num_pages=num_pages,
+                progress_callback=progress_callback,
+            )
+        else:
+            reader = SimpleDirectoryReader(input_files=[document_path])
+            documents = reader.load_data()
+            if progress_callback is not None:
+                progress_callback(len(documents), len(documents))
+
+        for document in documents:
+            # Keep the upload location out of the embedded text, so that the same
+            # content embeds the same wherever it is stored.
+            document.excluded_embed_metadata_keys.append("file_path")
+        Instrumentation.annotate(pages=len(documents))
+        return documents
 
     def __get_index_persist_dir(self, index_id: str) -> Path:
         """
@@ -134,62 +344,454 @@ class _RagService:
         """
         return RAG_STORAGE_PATH / index_id
 
-    def create_vector_store_index(
-        self, document_path: Path, persist=True
-    ) -> Tuple[str, VectorStoreIndex]:
+    @traced("split_documents")
+    def split_documents(self, documents: List[Document]) -> List[BaseNode]:
         """
-        Create a vector store index using a given document.
-        :param document_path: Path to the document( Absolute path of a pdf or docx file.)
-        ex: document_path = "/home/user/toto.pdf"
-        :param persist: Whether to persist the index or not.
-        :return : Tuple[Dict, VectorStoreIndex] : A tuple containing the index config and the index object.
-
+        Split parsed pages into sentence nodes, each one carrying the range of its
+        surrounding window (the window text is rebuilt at retrieval time).
+        :param documents: The pages returned by parse_document.
+        :return: List[BaseNode] : The nodes to embed.
         """
-        # 1.Read the document
         sentence_splitter = SentenceSplitter.from_defaults(
             chunk_size=DEFAULT_RAG_CHUNK_SIZE, chunk_overlap=DEFAULT_RAG_CHUNK_OVERLAP
         )
         text_plitter_fn = lambda x: sentence_splitter.split_text(x)
-        parser = SentenceWindowNodeParser.from_defaults(
-            sentence_splitter=text_plitter_fn, window_size=DEFAULT_RAG_WINDOW_SIZE
+        parser = CompactSentenceWindowNodeParser.from_defaults(
+            sentence_splitter=text_plitter_fn,
+            window_size=DEFAULT_RAG_WINDOW_SIZE,
+            include_prev_next_rel=False,
+            id_func=window_node_id,
         )
+        nodes = parser.get_nodes_from_documents(documents)
+        Instrumentation.annotate(pages=len(documents), nodes=len(nodes))
+        return nodes
 
-        # 2. Parse nodes.
-        nodes = parser.get_nodes_from_documents(self.parse_document(document_path))
+    @traced("embed_nodes")
+    def embed_nodes(
+        self,
+        nodes: List[BaseNode],
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ) -> List[BaseNode]:
+        """
+        Compute the embedding of every node that does not have one yet.
+        Nodes already embedded are skipped, so an interrupted call can be resumed.
+        :param nodes: The nodes to embed, updated in place.
+        :param progress_callback: Called with (embedded nodes, total nodes) after each batch.
+        :return: List[BaseNode] : The same nodes.
+        """
+        pending = [node for node in nodes if node.embedding is None]
+        already_embedded = len(nodes) - len(pending)
+
+        def on_batch(positions: List[int], embeddings: List[List[float]]) -> None:
+            # Embeddings land on the nodes batch by batch, so they survive a failure
+            for position, embedding in zip(positions, embeddings):
+                pending[position].embedding = embedding
+
+        def on_progress(embedded: int, _: int) -> None:
+            if progress_callback is not None:
+                progress_callback(already_embedded + embedded, len(nodes))
+
+        cache_hits = EmbeddingCache.hits
+        EmbeddingPipeline(self.embed_model).embed(
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending],
+            progress_callback=on_progress,
+            batch_callback=on_batch,
+        )
+        # Cache hits of concurrent ingestions are counted too
+        Instrumentation.annotate(
+            nodes=len(nodes),
+            embedded=len(pending),
+            embedding_cache_hits=EmbeddingCache.hits - cache_hits,
+        )
+        return nodes
 
-        # 3. Generate index UUID
-        index_id = str(uuid.uuid4()).split("-")[0]
+    @traced("build_vector_store_index")
+    def build_vector_store_index(
+        self,
+        nodes: List[BaseNode],
+        document_path: Path,
+        persist: bool = True,
+        index_id: Optional[str] = None,
+        documents: Optional[List[Document]] = None,
+    ) -> Tuple[str, VectorStoreIndex]:
+        """
+        Build (and persist) a vector store index from split nodes.
+        Embeddings are computed for the nodes which do not have one yet.
+        :param nodes: The nodes of the document.
+        :param document_path: Path to the indexed document.
+        :param persist: Whether to persist the index or not.
+        :param index_id: The id of the index, generated if not given.
+        :param documents: The pages the nodes were split from. Their hashes are saved
+        in the index config so that a new version of the document can be indexed
+        incrementally (see update_vector_store_index).
+        :return : Tuple[str, VectorStoreIndex] : A tuple containing the index id and the index object.
+        """
+        # Generate index UUID
+        index_id = index_id or str(uuid.uuid4()).split("-")[0]
 
         if persist:
-            persist_dir = self.__get_index_persist_dir(index_id)
-            persist_dir.mkdir(parents=True, exist_ok=True)
-            storage_context = StorageContext.from_defaults()
+            if DEFAULT_RAG_VECTOR_FORMAT == "npy":
+                storage_context = StorageContext.from_defaults(
+                    vector_store=NumpyVectorStore()
+                )
+            else:
+                storage_context = StorageContext.from_defaults()
         else:
             storage_context = None
 
         index_config = {
             "index_id": index_id,
             "document_path": str(document_path),
+            "created_at": time.time(),
         }
+        if persist:
+            index_config["content_hash"] = file_content_hash(document_path)
+        if documents is not None:
+            index_config["pages"] = self.__page_records(documents)
 
-        # 4. Create the index
+        # Create the index
         index = VectorStoreIndex(
             nodes=nodes,
             storage_context=storage_context,
-            embed_model=self._embedding,
+            embed_model=self.embed_model,
             show_progress=True,
         )
 
         if persist:
+            persist_dir = self.__get_index_persist_dir(index_id)
+            persist_dir.mkdir(parents=True, exist_ok=True)
             storage_context.persist(persist_dir=persist_dir)
+            self.__build_ann_index(persist_dir, index)
             # Save the index config in the persist directory
-            with open(
-                self.__get_index_persist_dir(index_id) / "index_config.json", "w"
-            ) as f:
+            with open(persist_dir / "index_config.json", "w") as f:
                 json.dump(index_config, f)
+            if documents is not None:
+                self.__write_page_store(persist_dir, documents)
+            IndexCatalog.refresh(index_id)
+            # The freshly built index is the one the next chat turn will need
+            IndexCache.put(index_id, persist_dir, index)
+            self.__sync_embedding_matrix(index_id, index)
+
+        return index_id, index
+
+    @traced("create_vector_store_index")
+    def create_vector_store_index(
+        self, document_path: Path, persist=True
+    ) -> Tuple[str, VectorStoreIndex]:
+        """
+        Create a vector store index using a given document.
+        :param document_path: Path to the document( Absolute path of a pdf or docx file.)
+        ex: document_path = "/home/user/toto.pdf"
+        :param persist: Whether to persist the index or not.
+        :return : Tuple[Dict, VectorStoreIndex] : A tuple containing the index config and the index object.
+
+        """
+        # 1. Read the document
+        documents = self.parse_document(document_path)
+
+        # 2. Parse nodes.
+        nodes = self.split_documents(documents)
+
+        # 3. Embed nodes
+        self.embed_nodes(nodes)
+
+        # 4. Create the index
+        return self.build_vector_store_index(
+            nodes, document_path, persist=persist, documents=documents
+        )
+
+    @traced("stream_vector_store_index")
+    def stream_vector_store_index(
+        self,
+        document_path: Path,
+        progress_callback: Optional[Callable[[int, int, int], None]] = None,
+    ) -> Tuple[str, VectorStoreIndex]:
+        """
+        Create and persist a vector store index with bounded memory, see
+        stream_document_to_checkpoint. Running it again after a failure resumes the
+        ingestion from its last committed batch.
+        :param document_path: Path to the document( Absolute path of a pdf or docx file.)
+        :param progress_callback: Called with (pages done, total pages, nodes done).
+        :return : Tuple[str, VectorStoreIndex] : A tuple containing the index id and the index object.
+        """
+        checkpoint = self.stream_document_to_checkpoint(
+            document_path, progress_callback=progress_callback
+        )
+        return self.build_index_from_checkpoint(checkpoint)
+
+    def __iter_page_batches(
+        self, document_path: Path, batch_pages: int, start_page: int, doc_id_prefix: str
+    ) -> Generator[Tuple[int, List[Document]], None, None]:
+        """
+        Parse a document by batches of pages, starting at a given page.
+        Pages get the doc_id "<doc_id_prefix>-<page index>" so that the pages of a
+        resumed run have the ids they would have had in the first run.
+        :return: A generator of (total pages, pages of the batch).
+        """
+        if document_path.suffix == ".pdf":
+            for _, num_pages, documents in iter_pdf_page_batches(
+                document_path, batch_pages, start_page, doc_id_prefix=doc_id_prefix
+            ):
+                for document in documents:
+                    document.excluded_embed_metadata_keys.append("file_path")
+                yield num_pages, documents
+            return
+
+        # Docx files have no pages to stream, they are read at once
+        documents = self.parse_document(document_path)
+        for position, document in enumerate(documents):
+            document.id_ = f"{doc_id_prefix}-{position}"
+        for start in range(start_page, len(documents), batch_pages):
+            yield len(documents), documents[start : start + batch_pages]
+
+    @traced("stream_document_to_checkpoint")
+    def stream_document_to_checkpoint(
+        self,
+        document_path: Path,
+        index_id: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, int, int], None]] = None,
+    ) -> IngestionCheckpoint:
+        """
+        Parse, split and embed a document DEFAULT_STREAMING_BATCH_PAGES pages at a
+        time, each batch being appended to the ingestion checkpoint of the document
+        before the next one is parsed. Only one batch is ever held in memory.
+        The checkpoint left by an interrupted run on the same content is resumed
+        after its last committed batch.
+        :param document_path: Path to the document( Absolute path of a pdf or docx file.)
+        :param index_id: The id of the index to create, generated if not given.
+        A resumed checkpoint keeps the id it was started with.
+        :param content_hash: The content hash of the document, computed if not given.
+        :param progress_callback: Called with (pages done, total pages, nodes done)
+        after each committed batch.
+        :return: IngestionCheckpoint : The complete checkpoint, see
+        build_index_from_checkpoint.
+        """
+        document_path = Path(document_path)
+        content_hash = content_hash or file_content_hash(document_path)
+        checkpoint = IngestionCheckpoint.open(
+            INGESTION_CHECKPOINT_PATH / content_hash,
+            index_id or str(uuid.uuid4()).split("-")[0],
+            document_path,
+            content_hash,
+        )
+
+        batches = self.__iter_page_batches(
+            document_path,
+            DEFAULT_STREAMING_BATCH_PAGES,
+            checkpoint.pages_done,
+            doc_id_prefix=checkpoint.index_id,
+        )
+        for pages_total, documents in batches:
+            checkpoint.set_pages_total(pages_total)
+            nodes = self.split_documents(documents)
+            embeddings = np.empty((0, 0), dtype=np.float32)
+            if nodes:
+                embeddings = np.asarray(
+                    EmbeddingPipeline(self.embed_model).embed(
+                        [
+                            node.get_content(metadata_mode=MetadataMode.EMBED)
+                            for node in nodes
+                        ]
+                    ),
+                    dtype=np.float32,
+                )
+            checkpoint.append_batch(
+                documents, self.__page_records(documents), nodes, embeddings
+            )
+            if progress_callback is not None:
+                progress_callback(
+                    checkpoint.pages_done, pages_total, checkpoint.nodes_done
+                )
+        return checkpoint
+
+    @traced("build_index_from_checkpoint")
+    def build_index_from_checkpoint(
+        self, checkpoint: IngestionCheckpoint, index_id: Optional[str] = None
+    ) -> Tuple[str, VectorStoreIndex]:
+        """
+        Persist the index of a complete ingestion checkpoint, then delete the checkpoint.
+        Embeddings are copied from the memory-mapped staging file, they are never
+        loaded in memory at once.
+        :param checkpoint: The checkpoint returned by stream_document_to_checkpoint.
+        :param index_id: The id of an existing index to replace with the checkpoint,
+        e.g. for a new version of its document. The id of the checkpoint if not
+        given.
+        :return : Tuple[str, VectorStoreIndex] : A tuple containing the index id and the index object.
+        """
+        index_id = index_id or checkpoint.index_id
+        persist_dir = self.__get_index_persist_dir(index_id)
+
+        docstore = SimpleDocumentStore()
+        index_struct = IndexDict()
+        node_ids, ref_doc_ids = [], []
+        for nodes in checkpoint.iter_nodes():
+            docstore.add_documents(nodes, allow_update=True)
+            for node in nodes:
+                index_struct.add_node(node, text_id=node.node_id)
+                node_ids.append(node.node_id)
+                ref_doc_ids.append(node.ref_doc_id or "None")
+        storage_context = StorageContext.from_defaults(
+            docstore=docstore,
+            vector_store=NumpyVectorStore(
+                checkpoint.embeddings(), node_ids, ref_doc_ids
+            ),
+        )
+        storage_context.index_store.add_index_struct(index_struct)
 
+        persist_dir.mkdir(parents=True, exist_ok=True)
+        storage_context.persist(persist_dir=persist_dir)
+        checkpoint.move_page_store(persist_dir)
+        index_config = {
+            "index_id": index_id,
+            "document_path": checkpoint.document_path,
+            "created_at": time.time(),
+            "content_hash": checkpoint.content_hash,
+            "pages": checkpoint.page_records,
+        }
+        with open(persist_dir / "index_config.json", "w") as f:
+            json.dump(index_config, f)
+
+        # Read back from disk, the embeddings are memory-mapped from embeddings.npy
+        index = self.__load_index_from_disk(persist_dir)
+        self.__build_ann_index(persist_dir, index)
+        IndexCatalog.refresh(index_id)
+        IndexCache.put(index_id, persist_dir, index)
+        self.__sync_embedding_matrix(index_id, index)
+        checkpoint.discard()
         return index_id, index
 
+    def __page_records(self, documents: List[Document]) -> List[Dict]:
+        """
+        :param documents: The pages of a document.
+        :return: The label, text hash and doc_id (the ref_doc_id of its nodes) of
+        every page, in page order.
+        """
+        return [
+            {
+                "page_label": document.metadata.get("page_label"),
+                "hash": page_content_hash(document.text),
+                "ref_doc_id": document.doc_id,
+            }
+            for document in documents
+        ]
+
+    def __write_page_store(
+        self, persist_dir: Path, documents: List[Document]
+    ) -> PageStore:
+        """
+        Write the page texts of a document next to its index.
+        :param persist_dir: The persist directory of the index.
+        :param documents: The pages of the document.
+        :return: The written page store.
+        """
+        return PageStore.write(
+            persist_dir,
+            [document.metadata.get("page_label") for document in documents],
+            [document.text for document in documents],
+        )
+
+    @traced("get_page_store")
+    def get_page_store(self, index_id: str) -> PageStore:
+        """
+        Get the page texts of an indexed document.
+        Indexes built before page stores existed get theirs written from the
+        original document on first use.
+        :param index_id: The id of the index.
+        :return: PageStore : The pages of the document.
+        """
+        persist_dir = self.__get_index_persist_dir(index_id)
+        if PageStore.exists(persist_dir):
+            return PageStore(persist_dir)
+
+        index_config = self.load_index_config(index_id)
+        documents = self.parse_document(index_config["document_path"])
+        page_store = self.__write_page_store(persist_dir, documents)
+        IndexCatalog.refresh(index_id)
+        return page_store
+
+    @traced("find_index_by_content_hash")
+    def find_index_by_content_hash(self, content_hash: str) -> Optional[str]:
+        """
+        :param content_hash: The sha256 of the bytes of a document.
+        :return: The id of the index of a byte-identical document, None if there is none.
+        """
+        entries = IndexCatalog.list(content_hash=content_hash, limit=1)
+        return entries[0]["index_id"] if entries else None
+
+    @traced("update_vector_store_index")
+    def update_vector_store_index(
+        self,
+        index_id: str,
+        document_path: Path,
+        documents: Optional[List[Document]] = None,
+    ) -> Dict[str, int]:
+        """
+        Update an index in place with a new version of its document.
+        Pages whose label and text are unchanged keep their nodes and embeddings,
+        only the changed and new pages are split and embedded. The nodes of changed
+        and removed pages are deleted.
+        :param index_id: The id of the index to update.
+        :param document_path: Path to the new version of the document.
+        :param documents: The pages of the new version, parsed if not given.
+        :return: Dict[str, int] : The number of unchanged, re-indexed and dropped
+        pages and of added nodes.
+        """
+        index_config = self.load_index_config(index_id)
+        persist_dir = self.__get_index_persist_dir(index_id)
+        if documents is None:
+            documents = self.parse_document(document_path)
+
+        # Load a private copy, the cached index may be serving chat turns
+        index = self.__load_index_from_disk(persist_dir)
+
+        # Indexes built before page hashes were saved have every page replaced
+        old_pages = index_config.get("pages") or [
+            {"page_label": None, "hash": None, "ref_doc_id": ref_doc_id}
+            for ref_doc_id in index.ref_doc_info
+        ]
+        unmatched: Dict[Tuple, List[Dict]] = {}
+        for page in old_pages:
+            unmatched.setdefault((page["page_label"], page["hash"]), []).append(page)
+
+        pages, changed_documents = [], []
+        for document, record in zip(documents, self.__page_records(documents)):
+            candidates = unmatched.get((record["page_label"], record["hash"]))
+            if candidates:
+                pages.append(candidates.pop(0))
+            else:
+                pages.append(record)
+                changed_documents.append(document)
+
+        removed = [page for group in unmatched.values() for page in group]
+        for page in removed:
+            index.delete_ref_doc(page["ref_doc_id"], delete_from_docstore=True)
+
+        nodes = self.split_documents(changed_documents) if changed_documents else []
+        if nodes:
+            self.embed_nodes(nodes)
+            index.insert_nodes(nodes)
+
+        index.storage_context.persist(persist_dir=persist_dir)
+        self.__build_ann_index(persist_dir, index)
+        self.__write_page_store(persist_dir, documents)
+        index_config.update(
+            document_path=str(document_path),
+            content_hash=file_content_hash(document_path),
+            pages=pages,
+        )
+        self.update_index_config(index_id, index_config)
+        IndexCache.put(index_id, persist_dir, index)
+        self.__sync_embedding_matrix(index_id, index)
+
+        return {
+            "pages_unchanged": len(pages) - len(changed_documents),
+            "pages_indexed": len(changed_documents),
+            "pages_dropped": len(removed),
+            "nodes_added": len(nodes),
+        }
+
+    @traced("delete_vector_store_index")
     def delete_vector_store_index(self, index_id: str):
         """
         Delete a vector store index from a given path.
@@ -200,8 +802,14 @@ class _RagService:
             raise ValueError(f"Index with id {index_id} does not exist.")
 
         # Delete the index directory
+        with self._insights_locks_guard:
+            self._insights_locks.pop(index_id, None)
+        IndexCache.invalidate(index_id)
+        self._embedding_matrix.remove_index(index_id)
+        IndexCatalog.remove(index_id)
         shutil.rmtree(self.__get_index_persist_dir(index_id), ignore_errors=True)
 
+    @traced("update_index_config")
     def update_index_config(self, index_id: str, new_config: Dict) -> None:
         """
         Update the index config with new values.
@@ -216,7 +824,9 @@ class _RagService:
 
         with open(index_dir / "index_config.json", "w") as f:
             json.dump(new_config, f)
+        IndexCatalog.refresh(index_id)
 
+    @traced("load_index_config")
     def load_index_config(self, index_id: str) -> Dict:
         """
         Load the index config from the index id.
@@ -233,25 +843,297 @@ class _RagService:
             config["document_path"] = Path(config["document_path"])
             return config
 
+    @traced("load_vector_store_index")
     def load_vector_store_index(self, index_id: str) -> VectorStoreIndex:
         """
         Load a vector store index from a given path.
+        Indexes are served from the process-wide IndexCache, the disk is only read
+        on a cache miss or when the persist directory changed.
         :param index_id: The id of the index to load.
-        :return: Tuple[Dict, VectorStoreIndex] : A tuple containing the index config and the index object.
+        :return: VectorStoreIndex : The index object.
         """
-        storage_context = StorageContext.from_defaults(
-            persist_dir=self.__get_index_persist_dir(index_id)
-        )
+        persist_dir = self.__get_index_persist_dir(index_id)
+
+        def load() -> VectorStoreIndex:
+            Instrumentation.annotate(cache_hit=False)
+            return self.__load_index_from_disk(persist_dir)
+
+        Instrumentation.annotate(index_id=index_id, cache_hit=True)
+        return IndexCache.get_or_load(index_id, persist_dir, load)
+
+    def __load_index_from_disk(self, persist_dir: Path) -> VectorStoreIndex:
+        """
+        Read a vector store index from its persist directory.
+        Both the binary (memory-mapped .npy) and the JSON vector layouts are supported.
+        :param persist_dir: The directory where the index is persisted.
+        :return: VectorStoreIndex : The index object.
+        """
+        if NumpyVectorStore.exists(persist_dir):
+            vector_store = NumpyVectorStore.from_persist_dir(persist_dir)
+            if DEFAULT_ANN_ENABLED:
+                node_ids, _ = vector_store.get_embeddings()
+                vector_store.set_ann_index(
+                    IVFIndex.load(persist_dir, node_ids), DEFAULT_ANN_NPROBE
+                )
+            storage_context = StorageContext.from_defaults(
+                persist_dir=persist_dir, vector_store=vector_store
+            )
+        else:
+            storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
         return load_index_from_storage(
-            storage_context=storage_context, embed_model=self._embedding
+            storage_context=storage_context, embed_model=self.embed_model
+        )
+
+    def index_cache_stats(self) -> Dict[str, int]:
+        """
+        :return: Hit, miss, eviction and invalidation counters of the index cache.
+        """
+        return IndexCache.stats()
+
+    def embedding_cache_stats(self) -> Dict[str, float]:
+        """
+        :return: Hit, miss and eviction counters and hit rate of the embedding cache.
+        """
+        return EmbeddingCache.stats()
+
+    def __build_ann_index(self, persist_dir: Path, index: VectorStoreIndex) -> None:
+        """
+        Build and persist the IVF index of a large index stored in the binary
+        layout, and attach it to its vector store. Small indexes are searched
+        exactly and have no IVF index.
+        :param persist_dir: The directory where the index is persisted.
+        :param index: The persisted index.
+        """
+        vector_store = index.vector_store
+        if not isinstance(vector_store, NumpyVectorStore):
+            return
+        node_ids, embeddings = vector_store.get_embeddings()
+        if not DEFAULT_ANN_ENABLED or len(node_ids) < DEFAULT_ANN_MIN_ROWS:
+            IVFIndex.remove(persist_dir)
+            return
+
+        ann_index = IVFIndex.build(
+            embeddings,
+            DEFAULT_ANN_LISTS,
+            node_ids=node_ids,
+            target_recall=DEFAULT_ANN_TARGET_RECALL,
+            similarity_top_k=DEFAULT_RAG_SIMILARITY_TOP_K,
+        )
+        ann_index.save(persist_dir)
+        vector_store.set_ann_index(ann_index, DEFAULT_ANN_NPROBE)
+
+    def __sync_embedding_matrix(self, index_id: str, index: VectorStoreIndex) -> None:
+        """
+        Make sure the embedding matrix holds the embeddings of the given index object.
+        :param index_id: The id of the index.
+        :param index: The loaded index.
+        """
+        if self._embedding_matrix.is_current(index_id, index):
+            return
+        with Instrumentation.span("sync_embedding_matrix", index_id=index_id) as span:
+            node_ids, embeddings = index_embeddings(index)
+            full_precision = None
+            embeddings_path = self.__get_index_persist_dir(index_id) / EMBEDDINGS_FNAME
+            if self._embedding_matrix.quantized and embeddings_path.exists():
+                # Rescoring reads a few rows from disk instead of keeping float32 rows
+                full_precision = np.load(embeddings_path, mmap_mode="r")
+            elif self._embedding_matrix.quantized:
+                # JSON layout: the rows are read from the loaded vector store
+                full_precision = VectorStoreRows(index.vector_store, node_ids)
+            self._embedding_matrix.add_index(
+                index_id,
+                node_ids,
+                embeddings,
+                source=index,
+                ann_index=getattr(index.vector_store, "ann_index", None),
+                full_precision=full_precision,
+            )
+            span.set(nodes=len(node_ids))
+
+    def __build_retriever(
+        self, indexes: Dict[str, VectorStoreIndex], retrieval_mode: str
+    ) -> BaseRetriever:
+        """
+        Build the retriever searching the given indexes.
+        :param indexes: The loaded indexes to search, by id.
+        :param retrieval_mode: "matrix" or "fusion", see DEFAULT_RAG_RETRIEVAL_MODE.
+        """
+        if retrieval_mode == "matrix":
+            # Rows of indexes served without being cached (too big for the cache,
+            # or evicted during a search) are dropped once no longer searched
+            self._embedding_matrix.retain(IndexCache.keys() + list(indexes))
+            for index_id, index in indexes.items():
+                self.__sync_embedding_matrix(index_id, index)
+            retriever = MatrixRetriever(
+                matrix=self._embedding_matrix,
+                indexes=indexes,
+                embed_model=self.embed_model,
+                similarity_top_k=DEFAULT_RAG_SIMILARITY_TOP_K,
+                sync_index=self.__sync_embedding_matrix,
+            )
+            if Instrumentation.enabled:
+                retriever = TracedRetriever(retriever, embed_model=self.embed_model)
+            return retriever
+
+        if retrieval_mode == "fusion":
+            from llama_index.core.retrievers import QueryFusionRetriever
+
+            retrievers = [
+                index.as_retriever(similarity_top_k=DEFAULT_RAG_SIMILARITY_TOP_K)
+                for index in indexes.values()
+            ]
+            if Instrumentation.enabled:
+                # QueryFusionRetriever hands every index retriever the query string,
+                # not one shared QueryBundle: each retrieve_index span embeds the
+                # query again (its embed_query span) before its search, so a turn
+                # has one embed_query span per searched index
+                retrievers = [
+                    TracedRetriever(
+                        retriever, name="retrieve_index", embed_model=self.embed_model
+                    )
+                    for retriever in retrievers
+                ]
+            retriever = QueryFusionRetriever(
+                retrievers=retrievers,
+                num_queries=1,
+                similarity_top_k=DEFAULT_RAG_SIMILARITY_TOP_K,
+            )
+            if Instrumentation.enabled:
+                retriever = TracedRetriever(retriever)
+            return retriever
+
+        raise ValueError(f"Unknown retrieval mode: {retrieval_mode}")
+
+    @traced("build_retrieval")
+    def build_retrieval(
+        self, index_ids: List[str], retrieval_mode: str = DEFAULT_RAG_RETRIEVAL_MODE
+    ) -> Tuple[BaseRetriever, List[BaseNodePostprocessor]]:
+        """
+        Load the given indexes and build what retrieves the context of a chat turn.
+        :param index_ids: The ids of the indexes to search.
+        :param retrieval_mode: "matrix" or "fusion", see DEFAULT_RAG_RETRIEVAL_MODE.
+        :return: The retriever and the postprocessors of the retrieved nodes, which
+        replace every retrieved sentence by its window, merge the overlapping windows,
+        drop the duplicates and keep the best ones within the context token budget.
+        """
+        indexes = {
+            index_id: self.load_vector_store_index(index_id) for index_id in index_ids
+        }
+        retriever = self.__build_retriever(indexes, retrieval_mode)
+        Instrumentation.annotate(indexes=len(indexes), retrieval_mode=retrieval_mode)
+        return retriever, [
+            ContextAssemblyPostProcessor(
+                docstores=[index.docstore for index in indexes.values()],
+                token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET,
+                duplicate_threshold=DEFAULT_CONTEXT_DUPLICATE_THRESHOLD,
+            )
+        ]
+
+    def new_conversation_memory(self) -> ConversationMemory:
+        """
+        :return: An empty memory for the turns of one conversation, its oldest turns
+        being summarized by the LLM. Pass it to every stream_chat of the conversation.
+        """
+        return ConversationMemory(
+            llm=self.llm,
+            token_limit=DEFAULT_RAG_TOKEN_LIMIT,
+            recent_token_limit=DEFAULT_MEMORY_RECENT_TOKEN_LIMIT,
+            summary_max_words=DEFAULT_MEMORY_SUMMARY_MAX_WORDS,
         )
 
+    @traced("stream_chat")
+    def stream_chat(
+        self,
+        query: str,
+        conversation_history: List[ChatMessage],
+        index_ids: List[str],
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+        retrieval_mode: str = DEFAULT_RAG_RETRIEVAL_MODE,
+        memory: Optional[ConversationMemory] = None,
+    ) -> ChatStream:
+        """
+        Generate a response to a given question, streamed as the LLM produces it.
+        Parameters are the same as complete_chat.
+        :return: ChatStream : An iterable of tokens. Its source_nodes are available
+        before the first token, its time_to_first_token once the first token is out.
+        """
+        from llama_index.core.chat_engine import ContextChatEngine
+
+        started_at = time.perf_counter()
+
+        retriever, node_postprocessors = self.build_retrieval(index_ids, retrieval_mode)
+
+        if memory is None:
+            # Without a memory kept across turns, the history is only truncated
+            memory = ConversationMemory(
+                chat_history=conversation_history, token_limit=DEFAULT_RAG_TOKEN_LIMIT
+            )
+
+        chat_engine = ContextChatEngine.from_defaults(
+            retriever=retriever,
+            memory=memory,
+            llm=self.llm,
+            node_postprocessors=node_postprocessors,
+            system_prompt=system_prompt,
+        )
+
+        # Retrieval happens here, the LLM then streams from a background thread.
+        # The self time of the span is the prompt assembly.
+        with Instrumentation.span("chat_context") as span:
+            response = chat_engine.stream_chat(query)
+            if Instrumentation.enabled:
+                context = "\n\n".join(
+                    n.node.get_content(metadata_mode=MetadataMode.LLM)
+                    for n in response.source_nodes
+                )
+                span.set(
+                    nodes=len(response.source_nodes),
+                    context_tokens=len(memory.tokenizer_fn(context)),
+                )
+
+        return ChatStream(
+            token_gen=response.response_gen,
+            source_nodes=response.source_nodes,
+            started_at=started_at,
+            on_complete=(
+                self.__llm_span_recorder(memory.tokenizer_fn)
+                if Instrumentation.enabled
+                else None
+            ),
+        )
+
+    @staticmethod
+    def __llm_span_recorder(
+        tokenizer_fn: Callable[[str], List],
+    ) -> Callable[[ChatStream], None]:
+        """
+        :return: A callback recording the "llm" span of a chat turn, from now to the
+        last token of its stream, with the time to first token and the number of
+        tokens of the answer.
+        """
+        llm_started_at = time.perf_counter()
+        parent = Instrumentation.current_span()
+
+        def record(stream: ChatStream) -> None:
+            Instrumentation.record(
+                "llm",
+                time.perf_counter() - llm_started_at,
+                parent=parent,
+                time_to_first_token_s=stream.time_to_first_token,
+                completion_tokens=len(tokenizer_fn(stream.response)),
+            )
+
+        return record
+
+    @traced("complete_chat")
     def complete_chat(
         self,
         query: str,
         conversation_history: List[ChatMessage],
         index_ids: List[str],
         system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+        retrieval_mode: str = DEFAULT_RAG_RETRIEVAL_MODE,
+        memory: Optional[ConversationMemory] = None,
     ) -> Tuple[Generator[str, None, None], List[NodeWithScore]]:
         """
         Generate a response to a given question.
@@ -264,74 +1146,141 @@ class _RagService:
         :param document_list: A list of document paths to search for the answer.
         The index of document index to search for the answer.
 
-        """
+        :param retrieval_mode: "matrix" searches every document with a single
+        vectorized top-k, "fusion" fuses one retriever per document.
 
-        # 1. Load the indexes
-        index_list = [self.load_vector_store_index(index_id) for index_id in index_ids]
+        :param memory: The memory of the conversation, see new_conversation_memory.
+        The query and the answer are added to it, the conversation_history is
+        ignored.
 
-        # 2.Retriever
-        retriever = QueryFusionRetriever(
-            retrievers=[
-                index.as_retriever(similarity_top_k=DEFAULT_RAG_SIMILARITY_TOP_K)
-                for index in index_list
-            ],
-            num_queries=1,
-            similarity_top_k=DEFAULT_RAG_SIMILARITY_TOP_K,
+        """
+        stream = self.stream_chat(
+            query,
+            conversation_history,
+            index_ids,
+            system_prompt=system_prompt,
+            retrieval_mode=retrieval_mode,
+            memory=memory,
         )
+        return iter(stream), stream.source_nodes
 
-        memory = ChatMemoryBuffer(
-            chat_history=conversation_history, token_limit=DEFAULT_RAG_TOKEN_LIMIT
+    @traced("list_vector_store_index")
+    def list_vector_store_index(
+        self,
+        document_name: Optional[str] = None,
+        name_contains: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> List[dict]:
+        """
+        List the vector store indexes from the IndexCatalog, oldest first.
+        :param document_name: Only the indexes of documents with this file name.
+        :param name_contains: Only the indexes whose document name contains this text.
+        :param limit: The maximum number of indexes, all of them if not given.
+        :param offset: The number of indexes to skip, for pagination.
+        :return A list of catalog entries: index_id, document_name, document_path,
+        content_hash, node_count, embedding_dim, page_count, size_bytes, created_at
+        and updated_at.
+        """
+        return IndexCatalog.list(
+            document_name=document_name,
+            name_contains=name_contains,
+            limit=limit,
+            offset=offset,
         )
 
-        chat_engine = ContextChatEngine.from_defaults(
-            retriever=retriever,
-            memory=memory,
-            llm=self._llm,
-            node_postprocessors=[
-                MetadataReplacementPostProcessor(target_metadata_key="window")
-            ],
-            system_prompt=system_prompt,
+    @traced("count_vector_store_index")
+    def count_vector_store_index(
+        self, document_name: Optional[str] = None, name_contains: Optional[str] = None
+    ) -> int:
+        """
+        :return: The number of indexes matching the filters of list_vector_store_index.
+        """
+        return IndexCatalog.count(
+            document_name=document_name, name_contains=name_contains
         )
 
-        response: StreamingAgentChatResponse = chat_engine.stream_chat(query)
-
-        response_generator = response.response_gen
-        source_nodes = response.source_nodes
-
-        return response_generator, source_nodes
+    @traced("rebuild_index_catalog")
+    def rebuild_index_catalog(self) -> int:
+        """
+        Rebuild the IndexCatalog from the persist directories.
+        :return: The number of indexes in the catalog.
+        """
+        return IndexCatalog.rebuild()
 
-    def list_vector_store_index(self) -> List[dict]:
+    def __cached_insight(
+        self, index_id: str, name: str, compute: Callable[[], str]
+    ) -> str:
         """
-        List all the vector store indexes
-        :return A list of vector _index configs
+        Get an insight of a document from its document_insights.json, computing
+        and storing it first if it is missing or was computed with another LLM,
+        other prompts or another version of the document.
+        :param index_id: The id of the index.
+        :param name: The name of the insight.
+        :param compute: Computes the insight.
+        :return: The insight.
         """
+        with self._insights_locks_guard:
+            lock = self._insights_locks.setdefault(index_id, threading.Lock())
 
-        index_configs = []
-        for index_dir in RAG_STORAGE_PATH.iterdir():
-            with open(index_dir / "index_config.json", "r") as f:
-                index_config = json.load(f)
-                index_configs.append(index_config)
-        return index_configs
+        with lock:
+            persist_dir = self.__get_index_persist_dir(index_id)
+            # Stored insights are returned without creating the LLM
+            model_name = self._llm_model_name
+            fingerprint = insights_fingerprint(
+                model_name,
+                INSIGHTS_PROMPTS,
+                self.load_index_config(index_id).get("content_hash"),
+            )
+            insights = load_insights(persist_dir, fingerprint)
+            if name not in insights:
+                insights[name] = compute()
+                save_insights(persist_dir, fingerprint, model_name, insights)
+            return insights[name]
+
+    @traced("precompute_document_insights")
+    def precompute_document_insights(self, index_id: str) -> None:
+        """
+        Compute the insights the summarize button needs: the language of the
+        document, then the summary of its first page translated to french if it is
+        not in french, or the summary of the whole document otherwise.
+        :param index_id: The id of the index.
+        """
+        if self.detect_document_language(index_id) != "fr":
+            self.translate_and_summarize_first_page_fr(index_id)
+        else:
+            self.summarize_document_index(index_id)
 
+    @traced("translate_and_summarize_first_page_fr")
     def translate_and_summarize_first_page_fr(self, index_id: str) -> str:
         """
-        Translate a document to french.
-        :param document_content: The content of the document to translate.
-        :return: The translated document.
+        Translate the first page of a document to french and summarize it.
+        Computed once per document, see precompute_document_insights.
+        :param index_id: The id of the index of the document.
+        :return: The summary in french.
         """
-        # 1. Load the file path of the document
-        index_dir = self.__get_index_persist_dir(index_id)
-        with open(index_dir / "index_config.json", "r") as f:
-            index_config = json.load(f)
-            document_path = index_config["document_path"]
+        return self.__cached_insight(
+            index_id,
+            "first_page_summary_fr",
+            lambda: self.__translate_and_summarize_first_page_fr(index_id),
+        )
+
+    def __translate_and_summarize_first_page_fr(self, index_id: str) -> str:
+        """
+        Translate the first page of a document to french, then summarize it.
+        The first page is the one labelled "1", or the first page of the document.
+        :param index_id: The id of the index of the document.
+        :return: The french summary of the first page.
+        """
+        # 1. Load the pages of the document
+        page_store = self.get_page_store(index_id)
 
-        # 2. Load the document
-        document_list = self.parse_document(document_path)
-        # First page
-        first_page_document = [k for k in document_list if k.page_label == "1"]
-        first_page_content = first_page_document[0].text
+        # 2. First page, the first one of the document if none is labelled "1"
+        first_page_content = page_store.get_page_by_label("1")
+        if first_page_content is None:
+            first_page_content = page_store.get_page(0)
 
-        # 3. Translate the document to french
+        # 3. Translate the first page to french
         chat_messages = ChatPromptTemplate(
             message_templates=[
                 ChatMessage(role=MessageRole.SYSTEM, content=TRANSLATION_SYSTEM_PROMPT),
@@ -339,69 +1288,135 @@ class _RagService:
             ]
         )
 
-        first_page_fr = self._llm.predict(
+        first_page_fr = self.llm.predict(
             prompt=chat_messages, source_text=first_page_content
         )
         return self.summarize_content(first_page_fr)
 
+    @traced("summarize_content")
     def summarize_content(self, input_content: str) -> str:
         """
         Summarize a given :input_content into few words.
         :param prompt: The prompt to translate.
         :return: The translated prompt.
         """
+        return self.llm.predict(prompt=SUMMARIZATION_PROMPT, source_text=input_content)
 
-        chat_messages = ChatPromptTemplate(
-            message_templates=[
-                ChatMessage(
-                    role=MessageRole.SYSTEM, content=SUMMARIZATION_SYSTEM_PROMPT
-                ),
-                ChatMessage(role=MessageRole.USER, content=SUMMARIZATION_USER_PROMPT),
-            ]
-        )
-
-        return self._llm.predict(prompt=chat_messages, source_text=input_content)
-
+    @traced("summarize_document_index")
     def summarize_document_index(self, index_id) -> str:
         """
         Summarize the content of a vector store index.
+        Computed once per document, see precompute_document_insights.
         :param index_id: The id of the index to summarize.
         """
+        return self.__cached_insight(
+            index_id, "summary", lambda: self.__summarize_document_index(index_id)
+        )
 
-        # 1. First load the index
-        index = self.load_vector_store_index(index_id)
-
-        # 2. Retriever (Dummy to get sources nodes)
-        query = "__"
-        nodes = index.as_retriever(similarity_top_k=50).retrieve(query)
-
-        # 3. Randomly select 10 sources
-        source_nodes = random.sample(nodes, 20)
+    def __summarize_document_index(self, index_id) -> str:
+        """
+        Summarize the content of a vector store index.
+        :param index_id: The id of the index to summarize.
+        """
+        if DEFAULT_SUMMARY_MODE == "clusters":
+            summary = self.__summarize_clusters(index_id)
+            if summary is not None:
+                return summary
+
+        # 1. Pages spread over the document
+        pages = self.get_page_store(index_id).sample_pages(
+            DEFAULT_SUMMARY_SAMPLE_PAGES, DEFAULT_INSIGHTS_PAGE_CHARS
+        )
 
-        # 4. Content to use for summarization
-        content = "\n".join([node.get_text() for node in source_nodes])
+        # 2. Content to use for summarization
+        content = "\n".join(pages)
 
         return self.summarize_content(content)
 
+    def __summarize_clusters(self, index_id: str) -> Optional[str]:
+        """
+        Map-reduce summary of the chunks which best represent the topics of a
+        document: its stored embeddings are clustered (no query is embedded), the
+        chunks closest to each centroid are summarized per cluster concurrently,
+        then the partial summaries are merged. The same index always gives the same
+        excerpts, in the same order.
+        :param index_id: The id of the index to summarize.
+        :return: The summary, None if the index has no chunks.
+        """
+        index = self.load_vector_store_index(index_id)
+        node_ids, embeddings = index_embeddings(index)
+        clusters = representative_rows(
+            embeddings, DEFAULT_SUMMARY_CLUSTERS, DEFAULT_SUMMARY_CHUNKS_PER_CLUSTER
+        )
+        if not clusters:
+            return None
+
+        # Every chunk is read with its sentence window, as in a chat
+        window_postprocessor = SentenceWindowPostProcessor(docstores=[index.docstore])
+        tokenizer = get_tokenizer()
+        token_budget = DEFAULT_SUMMARY_TOKEN_BUDGET // len(clusters)
+        parts = []
+        for rows in clusters:
+            nodes = window_postprocessor.postprocess_nodes(
+                [
+                    NodeWithScore(node=index.docstore.get_document(node_ids[row]))
+                    for row in rows
+                ]
+            )
+            excerpts = [
+                n.node.get_content(metadata_mode=MetadataMode.NONE) for n in nodes
+            ]
+            parts.append("\n".join(fit_token_budget(excerpts, token_budget, tokenizer)))
+        Instrumentation.annotate(clusters=len(clusters), chunks=len(node_ids))
+
+        return map_reduce_summary(
+            parts,
+            summarize_part=lambda part: self.llm.predict(
+                PART_SUMMARIZATION_PROMPT, source_text=part
+            ),
+            merge=self.summarize_content,
+            max_workers=DEFAULT_SUMMARY_MAP_CONCURRENCY,
+        )
+
+    @traced("detect_document_language")
     def detect_document_language(self, index_id: str) -> str:
         """
+        Computed once per document, see precompute_document_insights.
         :param index_id: The id of the index to detect the language of.
         :return: The language of the document.
         """
+        return self.__cached_insight(
+            index_id, "language", lambda: self.__detect_document_language(index_id)
+        )
 
-        # Load the index
-        index = self.load_vector_store_index(index_id)
-
-        # Retriever (Dummy to get sources nodes)
-        query = "__"
-        nodes = index.as_retriever(similarity_top_k=50).retrieve(query)
+    def __detect_document_language(self, index_id: str) -> str:
+        """
+        Identify the language offline, see LanguageIdentifier. The LLM is only asked
+        for too little text or when the confidence is below
+        DEFAULT_LANGUAGE_MIN_CONFIDENCE.
+        :param index_id: The id of the index to detect the language of.
+        :return: The language of the document.
+        """
 
-        # Randomly select 10 sources
-        source_nodes = random.sample(nodes, 5)
+        # Pages spread over the document
+        pages = self.get_page_store(index_id).sample_pages(
+            DEFAULT_LANGUAGE_SAMPLE_PAGES, DEFAULT_INSIGHTS_PAGE_CHARS
+        )
 
         # Content to use for language detection
-        content = "\n".join([node.get_text() for node in source_nodes])
+        content = "\n".join(pages)
+
+        language, confidence = LanguageIdentifier.detect(
+            content, min_letters=DEFAULT_LANGUAGE_MIN_LETTERS
+        )
+        fallback = language is None or confidence < DEFAULT_LANGUAGE_MIN_CONFIDENCE
+        Instrumentation.annotate(
+            language=language, confidence=confidence, llm_fallback=fallback
+        )
+        if not fallback:
+            return language
 
+        # Too little text, mixed or unknown language: the LLM decides
         chat_messages = ChatPromptTemplate(
             [
                 ChatMessage(
@@ -411,8 +1426,8 @@ class _RagService:
             ]
         )
 
-        language = self._llm.predict(prompt=chat_messages, source_text=content)
-        return language
+        language = self.llm.predict(prompt=chat_messages, source_text=content)
+        return language.strip()
 
 
 RagService = _RagService()  # Singleton instance of the RagService class
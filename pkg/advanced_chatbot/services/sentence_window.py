@@ -0,0 +1,213 @@
+from typing import Dict, List, Optional, Sequence
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.node_parser import SentenceWindowNodeParser
+from llama_index.core.node_parser.node_utils import build_nodes_from_splits
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import (
+    BaseNode,
+    Document,
+    MetadataMode,
+    NodeWithScore,
+    QueryBundle,
+)
+from llama_index.core.storage.docstore.types import BaseDocumentStore
+
+from advanced_chatbot.services.instrumentation import Instrumentation
+
+# [start, end) positions of the sentences making the window of a node
+WINDOW_RANGE_METADATA_KEY = "window_range"
+# Full window text, only found in the nodes of indexes built before window ranges
+WINDOW_METADATA_KEY = "window"
+
+
+def window_node_id(position: int, document: Document) -> str:
+    """
+    Id of a sentence node, derived from its page so its neighbours can be found.
+    :param position: The position of the sentence in the page.
+    :param document: The page.
+    :return: The node id.
+    """
+    return f"{document.doc_id}-{position}"
+
+
+class CompactSentenceWindowNodeParser(SentenceWindowNodeParser):
+    """
+    Sentence window parser storing every sentence once.
+
+    SentenceWindowNodeParser copies the window and the sentence itself in the
+    metadata of every node, and the node relationships copy that metadata again,
+    so the docstore holds each sentence several times. Here a node only keeps the
+    positions of its window, the text is rebuilt at retrieval time from the
+    neighbouring nodes by SentenceWindowPostProcessor.
+    Build it with from_defaults(id_func=window_node_id, include_prev_next_rel=False),
+    the postprocessor finds the neighbours of a node by their ids.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CompactSentenceWindowNodeParser"
+
+    def build_window_nodes_from_documents(
+        self, documents: Sequence[Document]
+    ) -> List[BaseNode]:
+        all_nodes: List[BaseNode] = []
+        for doc in documents:
+            nodes = build_nodes_from_splits(
+                self.sentence_splitter(doc.text), doc, id_func=self.id_func
+            )
+            for i, node in enumerate(nodes):
+                node.metadata[WINDOW_RANGE_METADATA_KEY] = [
+                    max(0, i - self.window_size),
+                    min(i + self.window_size + 1, len(nodes)),
+                ]
+                # Not part of the embedded text, embeddings are unchanged
+                node.excluded_embed_metadata_keys.append(WINDOW_RANGE_METADATA_KEY)
+                node.excluded_llm_metadata_keys.append(WINDOW_RANGE_METADATA_KEY)
+            all_nodes.extend(nodes)
+        return all_nodes
+
+
+class SentenceWindowPostProcessor(BaseNodePostprocessor):
+    """
+    Replace the text of retrieved sentence nodes by their window.
+
+    The window of a node built by CompactSentenceWindowNodeParser is read from
+    the docstores, the window text of older nodes from their metadata, exactly
+    like MetadataReplacementPostProcessor(target_metadata_key="window"), unless a
+    window range was derived for them (see ContextAssemblyPostProcessor).
+    """
+
+    _docstores: List[BaseDocumentStore] = PrivateAttr()
+
+    def __init__(self, docstores: Sequence[BaseDocumentStore], **kwargs):
+        """
+        :param docstores: The docstores of the searched indexes.
+        """
+        super().__init__(**kwargs)
+        self._docstores = list(docstores)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SentenceWindowPostProcessor"
+
+    def _get_text(self, node_id: str, cache: Dict[str, Optional[str]]) -> Optional[str]:
+        if node_id not in cache:
+            cache[node_id] = None
+            for docstore in self._docstores:
+                node = docstore.get_document(node_id, raise_error=False)
+                if isinstance(node, BaseNode):
+                    cache[node_id] = node.get_content(metadata_mode=MetadataMode.NONE)
+                    break
+        return cache[node_id]
+
+    def _get_page_node_ids(
+        self, ref_doc_id: str, pages: Dict[str, List[str]]
+    ) -> List[str]:
+        """
+        :return: The ids of the sentence nodes of a page, in the order of the page.
+        """
+        if ref_doc_id not in pages:
+            pages[ref_doc_id] = []
+            for docstore in self._docstores:
+                ref_doc_info = docstore.get_ref_doc_info(ref_doc_id)
+                if ref_doc_info is not None:
+                    pages[ref_doc_id] = list(ref_doc_info.node_ids)
+                    break
+        return pages[ref_doc_id]
+
+    def _derive_window_ranges(
+        self,
+        nodes: List[NodeWithScore],
+        texts: Dict[str, Optional[str]],
+        pages: Dict[str, List[str]],
+    ) -> None:
+        """
+        Give the nodes of indexes built before window ranges the range of their
+        window, so that they are merged and rebuilt like newer nodes. The position
+        of a sentence is its position in the nodes of its page in the docstore, its
+        window the run of neighbouring sentences whose joined texts are the window
+        text. A node whose window text is not found keeps it.
+        """
+        for n in nodes:
+            node = n.node
+            window = node.metadata.get(WINDOW_METADATA_KEY)
+            if (
+                window is None
+                or WINDOW_RANGE_METADATA_KEY in node.metadata
+                or node.ref_doc_id is None
+            ):
+                continue
+            page_node_ids = self._get_page_node_ids(node.ref_doc_id, pages)
+            if node.node_id not in page_node_ids:
+                continue
+            texts[node.node_id] = node.get_content(metadata_mode=MetadataMode.NONE)
+
+            def joined(start: int, end: int) -> str:
+                return " ".join(
+                    self._get_text(node_id, texts) or ""
+                    for node_id in page_node_ids[start:end]
+                )
+
+            start = page_node_ids.index(node.node_id)
+            end = start + 1
+            while start > 0 and joined(start - 1, end) in window:
+                start -= 1
+            while end < len(page_node_ids) and joined(start, end + 1) in window:
+                end += 1
+            if joined(start, end) != window:
+                continue
+            node.metadata[WINDOW_RANGE_METADATA_KEY] = [start, end]
+            for excluded_keys in (
+                node.excluded_embed_metadata_keys,
+                node.excluded_llm_metadata_keys,
+            ):
+                if WINDOW_RANGE_METADATA_KEY not in excluded_keys:
+                    excluded_keys.append(WINDOW_RANGE_METADATA_KEY)
+
+    def _window_node_ids(
+        self, node: BaseNode, pages: Dict[str, List[str]]
+    ) -> List[str]:
+        """
+        :return: The ids of the sentence nodes in the window range of a node.
+        """
+        window_range = node.metadata[WINDOW_RANGE_METADATA_KEY]
+        if WINDOW_METADATA_KEY in node.metadata:
+            # Range derived by _derive_window_ranges, the ids are not positional
+            return self._get_page_node_ids(node.ref_doc_id, pages)[
+                window_range[0] : window_range[1]
+            ]
+        return [f"{node.ref_doc_id}-{position}" for position in range(*window_range)]
+
+    def _replace_by_windows(
+        self,
+        nodes: List[NodeWithScore],
+        texts: Dict[str, Optional[str]],
+        pages: Dict[str, List[str]],
+    ) -> List[NodeWithScore]:
+        for n in nodes:
+            node = n.node
+            text = node.get_content(metadata_mode=MetadataMode.NONE)
+            if (
+                WINDOW_RANGE_METADATA_KEY not in node.metadata
+                or node.ref_doc_id is None
+            ):
+                node.set_content(node.metadata.get(WINDOW_METADATA_KEY, text))
+                continue
+
+            texts[node.node_id] = text
+            window = [
+                self._get_text(node_id, texts)
+                for node_id in self._window_node_ids(node, pages)
+            ]
+            node.set_content(" ".join(t for t in window if t is not None))
+        return nodes
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        with Instrumentation.span("postprocess", nodes=len(nodes)):
+            # Neighbouring hits share sentences, each one is read once
+            return self._replace_by_windows(nodes, {}, {})
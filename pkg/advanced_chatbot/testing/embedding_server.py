@@ -0,0 +1,152 @@
+"""
+Local stand-in for the OpenAI embeddings endpoint.
+
+Answers POST /embeddings (and /v1/embeddings) with deterministic hashed
+embeddings, optionally with a latency and a rate limit, so that the ingestion
+embedding pipeline can be exercised without an API key:
+
+    python -m advanced_chatbot.testing.embedding_server --port 8089 --rate-limit-every 5
+    OPENAI_API_BASE=http://127.0.0.1:8089/v1 OPENAI_API_KEY=fake streamlit run app.py
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def hashed_embedding(text: str, dim: int = 1536) -> np.ndarray:
+    """
+    Deterministic bag-of-words embedding: every word is hashed to a signed bucket.
+    Texts sharing words get similar embeddings, which keeps retrieval meaningful.
+    :param text: The text to embed.
+    :param dim: The dimension of the embedding.
+    :return: A unit-norm float32 vector.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in _TOKEN_RE.findall(text.lower()):
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dim] += 1.0 if (value >> 63) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        return vector
+    return vector / norm
+
+
+class _EmbeddingHandler(BaseHTTPRequestHandler):
+    dim = 1536
+    latency = 0.0
+    rate_limit_every = 0
+    _requests = 0
+    _lock = threading.Lock()
+
+    def do_POST(self) -> None:
+        if not self.path.rstrip("/").endswith("/embeddings"):
+            self._reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        with self._lock:
+            type(self)._requests += 1
+            request_number = self._requests
+
+        if self.rate_limit_every and request_number % self.rate_limit_every == 0:
+            self._reply(429, {"error": {"message": "Rate limit reached"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        time.sleep(self.latency)
+
+        data = []
+        for i, text in enumerate(inputs):
+            vector = hashed_embedding(str(text), self.dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+        tokens = sum(len(_TOKEN_RE.findall(str(text))) for text in inputs)
+        self._reply(
+            200,
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model", "stub"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            },
+        )
+
+    def _reply(self, status: int, payload: dict) -> None:
+        content = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def start_embedding_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    dim: int = 1536,
+    latency: float = 0.0,
+    rate_limit_every: int = 0,
+) -> ThreadingHTTPServer:
+    """
+    Start the stand-in server in a background thread.
+    :param port: The port to listen on, 0 picks a free one (see server.server_port).
+    :param dim: The dimension of the returned embeddings.
+    :param latency: Seconds to wait before answering each request.
+    :param rate_limit_every: Answer every n-th request with HTTP 429 (0 disables it).
+    :return: The running server, stop it with server.shutdown().
+    """
+    handler = type(
+        "EmbeddingHandler",
+        (_EmbeddingHandler,),
+        {"dim": dim, "latency": latency, "rate_limit_every": rate_limit_every},
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = start_embedding_server(
+        args.host, args.port, args.dim, args.latency, args.rate_limit_every
+    )
+    print(f"Embedding server listening on http://{args.host}:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ from setuptools import find_packages, setup
 
 requirements = """
 llama-index==0.10.8
+numpy
 streamlit
 python-dotenv
 """
@@ -14,6 +15,7 @@ setup(
     install_requires=requirements,
     python_requires="==3.10.12",
     include_package_data=True,
+    package_data={"advanced_chatbot": ["resources/language_profiles.json"]},
     scripts=[],
     zip_safe=False,
 )
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# advanced_chatbot.config reads DATA_PATH when it is imported
+if not os.environ.get("DATA_PATH"):
+    os.environ["DATA_PATH"] = tempfile.mkdtemp(prefix="advanced_chatbot_tests_")
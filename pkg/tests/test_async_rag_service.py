@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+
+# The service layer needs a working llama-index install
+pytest.importorskip("advanced_chatbot.services.rag_service", exc_type=ImportError)
+
+from llama_index.core.base.llms.types import ChatResponse
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from advanced_chatbot.services.async_rag_service import _AsyncRagService
+from advanced_chatbot.services.conversation_memory import ConversationMemory
+
+
+class _Counter:
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+
+    async def run(self, seconds: float) -> None:
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(seconds)
+        self.running -= 1
+
+
+class _FakeRetriever:
+    def __init__(self, counter: _Counter):
+        self._counter = counter
+
+    async def aretrieve(self, query):
+        await self._counter.run(0.01)
+        return []
+
+
+class _FakeLLM:
+    class metadata:
+        system_role = MessageRole.SYSTEM
+
+    def __init__(self, tokens, fail_after=None):
+        self.tokens = tokens
+        self.fail_after = fail_after
+        self.messages = None
+
+    async def astream_chat(self, messages):
+        self.messages = messages
+
+        async def gen():
+            for position, token in enumerate(self.tokens):
+                if position == self.fail_after:
+                    raise RuntimeError("LLM failure")
+                await asyncio.sleep(0)
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=token),
+                    delta=token,
+                )
+
+        return gen()
+
+
+class _FakeRagService:
+    def __init__(self, llm=None):
+        self.llm = llm or _FakeLLM(["an ", "answer"])
+        self.retrievals = _Counter()
+
+    def build_retrieval(self, index_ids, retrieval_mode):
+        return _FakeRetriever(self.retrievals), []
+
+
+def test_retrievals_wait_for_a_free_slot():
+    rag_service = _FakeRagService()
+    service = _AsyncRagService(rag_service, 2, 1, 1)
+
+    async def main():
+        await asyncio.gather(*(service.aretrieve("q", ["index"]) for _ in range(6)))
+
+    asyncio.run(main())
+    assert rag_service.retrievals.max_running == 2
+
+
+def test_a_stream_holds_its_llm_slot_until_exhausted():
+    service = _AsyncRagService(_FakeRagService(), 4, 1, 1)
+
+    async def main():
+        first = await service.astream_chat("q1", [], ["index"])
+        second = asyncio.ensure_future(service.astream_chat("q2", [], ["index"]))
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        assert [token async for token in first] == ["an ", "answer"]
+        second = await asyncio.wait_for(second, 1)
+        await second.aclose()
+        # The slot of a closed stream is free again
+        third = await asyncio.wait_for(service.astream_chat("q3", [], ["index"]), 1)
+        assert "".join([token async for token in third]) == "an answer"
+
+    asyncio.run(main())
+
+
+def test_slots_work_across_event_loops():
+    rag_service = _FakeRagService()
+    service = _AsyncRagService(rag_service, 1, 1, 1)
+
+    async def main():
+        await asyncio.gather(*(service.aretrieve("q", ["index"]) for _ in range(3)))
+
+    # A new loop per run, like a new asyncio.run or a Streamlit rerun
+    for _ in range(3):
+        asyncio.run(main())
+    assert rag_service.retrievals.max_running == 1
+
+
+def test_memory_is_written_once_the_stream_is_exhausted():
+    service = _AsyncRagService(_FakeRagService(), 1, 1, 1)
+    memory = ConversationMemory(token_limit=1000, tokenizer_fn=str.split)
+
+    async def main():
+        stream = await service.astream_chat("question", [], ["index"], memory=memory)
+        tokens = stream.__aiter__()
+        assert await tokens.__anext__() == "an "
+        assert memory.get_all() == []
+        async for _ in tokens:
+            pass
+
+    asyncio.run(main())
+    assert [(m.role, m.content) for m in memory.get_all()] == [
+        (MessageRole.USER, "question"),
+        (MessageRole.ASSISTANT, "an answer"),
+    ]
+
+
+def test_closed_or_failed_stream_leaves_the_memory_unchanged():
+    llm = _FakeLLM(["an ", "answer"], fail_after=1)
+    service = _AsyncRagService(_FakeRagService(llm), 1, 1, 1)
+    memory = ConversationMemory(token_limit=1000, tokenizer_fn=str.split)
+
+    async def main():
+        stream = await service.astream_chat("failed", [], ["index"], memory=memory)
+        with pytest.raises(RuntimeError):
+            async for _ in stream:
+                pass
+        llm.fail_after = None
+        stream = await service.astream_chat("closed", [], ["index"], memory=memory)
+        await stream.aclose()
+        # The question is sent last, after the history
+        tokens, sources = await service.acomplete_chat(
+            "completed", [], ["index"], memory=memory
+        )
+        assert llm.messages[-1].content == "completed"
+        assert sources == []
+        return "".join([token async for token in tokens])
+
+    assert asyncio.run(main()) == "an answer"
+    assert [m.content for m in memory.get_all()] == ["completed", "an answer"]
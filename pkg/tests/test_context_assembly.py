@@ -0,0 +1,144 @@
+import pytest
+
+pytest.importorskip("llama_index.core", exc_type=ImportError)
+
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceWindowNodeParser
+from llama_index.core.schema import (
+    MetadataMode,
+    NodeRelationship,
+    NodeWithScore,
+    RelatedNodeInfo,
+    TextNode,
+)
+from llama_index.core.storage.docstore import SimpleDocumentStore
+
+from advanced_chatbot.services.context_assembly import (
+    MERGED_NODE_IDS_METADATA_KEY,
+    ContextAssemblyPostProcessor,
+    containment,
+    merge_window_ranges,
+    shingles,
+)
+from advanced_chatbot.services.sentence_window import (
+    WINDOW_RANGE_METADATA_KEY,
+    CompactSentenceWindowNodeParser,
+    window_node_id,
+)
+
+
+def _hit(node_id, page, window_range, score):
+    node = TextNode(
+        id_=node_id,
+        text=node_id,
+        metadata={WINDOW_RANGE_METADATA_KEY: list(window_range)},
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=page)},
+    )
+    return NodeWithScore(node=node, score=score)
+
+
+_WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "golf", "hotel", "india"]
+
+
+def _sentence(page, position):
+    # 8 words found in no other sentence
+    return " ".join(f"{word}{page}{position}" for word in _WORDS) + "."
+
+
+def _pages(count=8):
+    return [
+        Document(
+            text=" ".join(_sentence(page, i) for i in range(count)),
+            metadata={"page_label": str(page)},
+        )
+        for page in (1, 2)
+    ]
+
+
+def test_overlapping_and_adjacent_windows_of_a_page_are_merged():
+    hits = [
+        _hit("a", "page1", (2, 5), 0.9),
+        _hit("b", "page1", (0, 3), 0.8),
+        _hit("c", "page2", (1, 4), 0.7),
+        _hit("d", "page1", (5, 7), 0.6),
+        _hit("e", "page1", (9, 11), 0.5),
+    ]
+
+    merged = merge_window_ranges(hits)
+
+    assert [n.node.node_id for n in merged] == ["a", "c", "e"]
+    assert merged[0].node.metadata[WINDOW_RANGE_METADATA_KEY] == [0, 7]
+    assert sorted(merged[0].node.metadata[MERGED_NODE_IDS_METADATA_KEY]) == [
+        "b",
+        "d",
+    ]
+    assert merged[1].node.metadata[WINDOW_RANGE_METADATA_KEY] == [1, 4]
+    assert MERGED_NODE_IDS_METADATA_KEY not in merged[2].node.metadata
+    # The merged ids are not sent to the LLM
+    assert "merged" not in merged[0].node.get_content(MetadataMode.LLM)
+
+
+def test_shingles_and_containment():
+    text = shingles("The cat sat on the mat")
+    assert len(text) == 4
+    assert ("cat", "sat", "on") in text
+    assert shingles("Two words") == frozenset(["two", "words"])
+    assert containment(shingles("the cat SAT on"), text) == 1.0
+    assert containment(shingles("the cat sat on a hat"), text) == 0.5
+    assert containment(frozenset(), text) == 1.0
+
+
+def _assembled(nodes, docstores, positions, token_budget=1000):
+    postprocessor = ContextAssemblyPostProcessor(
+        docstores, tokenizer_fn=str.split, token_budget=token_budget
+    )
+    hits = [
+        NodeWithScore(node=nodes[position].copy(), score=1.0 - rank / 10)
+        for rank, position in enumerate(positions)
+    ]
+    return postprocessor.postprocess_nodes(hits)
+
+
+def _words(text):
+    return " ".join(text.split())
+
+
+def test_neighbouring_hits_become_one_window_and_duplicates_are_dropped():
+    parser = CompactSentenceWindowNodeParser.from_defaults(
+        window_size=1, id_func=window_node_id, include_prev_next_rel=False
+    )
+    report = parser.get_nodes_from_documents(_pages())
+    # The same pages in another document
+    copy = parser.get_nodes_from_documents(_pages())
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(report + copy)
+
+    # Sentences 2 and 3 of the first page, the copy of sentence 2, sentence 7
+    context = _assembled(report + copy, [docstore], [2, 3, 16 + 2, 7])
+
+    assert [n.node.node_id for n in context] == [report[2].node_id, report[7].node_id]
+    assert _words(context[0].node.get_content()) == " ".join(
+        _sentence(1, i) for i in range(1, 5)
+    )
+    assert sorted(context[0].node.metadata[MERGED_NODE_IDS_METADATA_KEY]) == sorted(
+        [report[3].node_id, copy[2].node_id]
+    )
+
+    # 8 words per sentence: the best window fits, the next one does not
+    context = _assembled(report + copy, [docstore], [2, 7], token_budget=30)
+    assert [n.node.node_id for n in context] == [report[2].node_id]
+
+
+def test_windows_of_older_indexes_are_merged_too():
+    nodes = SentenceWindowNodeParser.from_defaults(
+        window_size=1
+    ).get_nodes_from_documents(_pages())
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(nodes)
+
+    context = _assembled(nodes, [docstore], [2, 3])
+
+    assert [n.node.node_id for n in context] == [nodes[2].node_id]
+    assert _words(context[0].node.get_content()) == " ".join(
+        _sentence(1, i) for i in range(1, 5)
+    )
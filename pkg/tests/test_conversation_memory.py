@@ -0,0 +1,145 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("llama_index.core", exc_type=ImportError)
+
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from advanced_chatbot.services.conversation_memory import (
+    SUMMARY_MESSAGE_HEADER,
+    ConversationMemory,
+)
+
+
+class _FakeLLM:
+    """
+    Summarizes a conversation as the list of its questions.
+    """
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def predict(self, prompt, **kwargs):
+        self.calls += 1
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("LLM failure")
+        questions = [
+            line.split(": ", 1)[1]
+            for line in kwargs["messages"].splitlines()
+            if line.startswith("user: ")
+        ]
+        return " ".join(filter(None, [kwargs["summary"], *questions]))
+
+
+def _turn(number: int):
+    # 4 tokens per message with str.split, its role included
+    return [
+        ChatMessage(role=MessageRole.USER, content=f"question {number} ?"),
+        ChatMessage(role=MessageRole.ASSISTANT, content=f"answer {number} ."),
+    ]
+
+
+def _wait_compressed(memory):
+    deadline = time.time() + 5
+    while memory._compressing:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_without_llm_the_oldest_messages_are_dropped():
+    memory = ConversationMemory(
+        token_limit=20, recent_token_limit=8, tokenizer_fn=str.split
+    )
+    for number in range(4):
+        for message in _turn(number):
+            memory.put(message)
+
+    # 8 messages of 4 tokens, the oldest ones do not fit in 20 tokens
+    assert [m.content for m in memory.get_all()] == [
+        "answer 1 .",
+        "question 2 ?",
+        "answer 2 .",
+        "question 3 ?",
+        "answer 3 .",
+    ]
+    # The history never starts with an answer
+    assert [m.content for m in memory.get(initial_token_count=4)] == [
+        "question 2 ?",
+        "answer 2 .",
+        "question 3 ?",
+        "answer 3 .",
+    ]
+    assert [m.content for m in memory.get(initial_token_count=12)] == [
+        "question 3 ?",
+        "answer 3 .",
+    ]
+    with pytest.raises(ValueError):
+        memory.get(initial_token_count=21)
+
+
+def test_the_oldest_turns_are_folded_into_the_summary():
+    llm = _FakeLLM()
+    memory = ConversationMemory(
+        llm=llm, token_limit=100, recent_token_limit=16, tokenizer_fn=str.split
+    )
+    for number in range(3):
+        for message in _turn(number):
+            memory.put(message)
+            _wait_compressed(memory)
+
+    assert llm.calls == 1
+    assert memory.summary == "question 0 ? question 1 ?"
+    history = memory.get()
+    assert history[0].role == MessageRole.SYSTEM
+    assert history[0].content == SUMMARY_MESSAGE_HEADER + memory.summary
+    assert [m.content for m in history[1:]] == ["question 2 ?", "answer 2 ."]
+    assert memory.stats() == {
+        "messages": 2,
+        "message_tokens": 8,
+        "summary_tokens": 6,
+    }
+    # The summary goes first, the messages get the tokens it leaves
+    assert memory.get(initial_token_count=88) == history[:1]
+    assert memory.get(initial_token_count=95) == []
+
+
+def test_a_summary_of_a_replaced_conversation_is_dropped():
+    llm = _FakeLLM()
+    llm.release.clear()
+    memory = ConversationMemory(
+        llm=llm, token_limit=100, recent_token_limit=8, tokenizer_fn=str.split
+    )
+    for message in _turn(0) + _turn(1):
+        memory.put(message)
+    # Replaced while the LLM summarizes
+    deadline = time.time() + 5
+    while llm.calls == 0:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    memory.set(_turn(2))
+    llm.release.set()
+    _wait_compressed(memory)
+
+    assert memory.summary == ""
+    assert [m.content for m in memory.get_all()] == ["question 2 ?", "answer 2 ."]
+
+
+def test_messages_stay_when_the_summary_fails():
+    memory = ConversationMemory(
+        llm=_FakeLLM(fail=True),
+        token_limit=100,
+        recent_token_limit=8,
+        tokenizer_fn=str.split,
+    )
+    for message in _turn(0) + _turn(1):
+        memory.put(message)
+        _wait_compressed(memory)
+
+    assert memory.summary == ""
+    assert len(memory.get_all()) == 4
@@ -0,0 +1,30 @@
+import pytest
+
+pytest.importorskip("pypdf")
+
+from advanced_chatbot.benchmarks.corpus import write_pdf
+from advanced_chatbot.services import document_parser
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_parallel_ranges_are_merged_in_page_order(tmp_path, monkeypatch, num_workers):
+    num_pages = 23
+    path = tmp_path / "document.pdf"
+    write_pdf(path, [f"page number {page}" for page in range(num_pages)])
+    # The extracted pages, without building llama-index Documents
+    monkeypatch.setattr(
+        document_parser, "_page_documents", lambda document_path, pages: pages
+    )
+    progress = []
+
+    pages = document_parser.parse_pdf_in_parallel(
+        path, num_workers, progress_callback=lambda *args: progress.append(args)
+    )
+
+    assert [label for label, _ in pages] == [str(p + 1) for p in range(num_pages)]
+    assert [int(text.split()[-1]) for _, text in pages] == list(range(num_pages))
+    assert [total for _, total in progress] == [num_pages] * len(progress)
+    assert [parsed for parsed, _ in progress] == sorted(
+        parsed for parsed, _ in progress
+    )
+    assert progress[-1] == (num_pages, num_pages)
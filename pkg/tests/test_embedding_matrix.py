@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("llama_index.core", exc_type=ImportError)
+
+from advanced_chatbot.services.embedding_matrix import EmbeddingMatrix, VectorStoreRows
+from advanced_chatbot.services.ivf_index import _clustered_embeddings
+from advanced_chatbot.services.quantization import normalize
+
+DIM = 16
+
+
+def _index(index_id: str, rows: int, seed: int):
+    node_ids = [f"{index_id}-{row}" for row in range(rows)]
+    return node_ids, _clustered_embeddings(rows, DIM, 5, seed=seed)
+
+
+def _check_rows(matrix: EmbeddingMatrix, indexes: dict) -> None:
+    """
+    Every row maps back to its index, its node id and its row in the embeddings of
+    its index, and holds that embedding.
+    """
+    assert len(matrix) == sum(len(node_ids) for node_ids, _ in indexes.values())
+    assert sorted(matrix.index_ids()) == sorted(indexes)
+    for index_id, (node_ids, embeddings) in indexes.items():
+        rows = matrix._index_rows[index_id]
+        assert len(rows) == len(node_ids)
+        assert (rows < len(matrix)).all()
+        for local, row in enumerate(rows.tolist()):
+            assert matrix._index_ids[matrix._row_index[row]] == index_id
+            assert matrix._row_node_ids[row] == node_ids[local]
+            assert matrix._row_local[row] == local
+        np.testing.assert_allclose(
+            matrix._matrix[rows], normalize(embeddings), atol=1e-6
+        )
+
+
+def _exact_top_k(indexes: dict, query: np.ndarray, k: int, index_ids=None):
+    scored = [
+        (float(score), index_id, node_id)
+        for index_id, (node_ids, embeddings) in indexes.items()
+        if index_ids is None or index_id in index_ids
+        for node_id, score in zip(node_ids, normalize(embeddings) @ normalize(query))
+    ]
+    scored.sort(reverse=True)
+    return [(index_id, node_id) for _, index_id, node_id in scored[:k]]
+
+
+def test_rows_stay_consistent_through_interleaved_add_and_remove():
+    rng = np.random.default_rng(0)
+    matrix = EmbeddingMatrix(initial_capacity=8)
+    indexes = {}
+    for step in range(60):
+        index_id = f"index{rng.integers(8)}"
+        if index_id in indexes and rng.random() < 0.5:
+            matrix.remove_index(index_id)
+            del indexes[index_id]
+        else:
+            indexes[index_id] = _index(index_id, int(rng.integers(1, 40)), seed=step)
+            matrix.add_index(index_id, *indexes[index_id])
+        if step % 10 == 9:
+            kept = sorted(indexes)[: len(indexes) // 2 + 1]
+            matrix.retain(kept)
+            indexes = {index_id: indexes[index_id] for index_id in kept}
+        _check_rows(matrix, indexes)
+
+        query = rng.standard_normal(DIM)
+        found = matrix.top_k(query, 5)
+        assert [(i, n) for i, n, _ in found] == _exact_top_k(indexes, query, 5)
+        selected = sorted(indexes)[:1]
+        found = matrix.top_k(query, 5, index_ids=selected)
+        assert [(i, n) for i, n, _ in found] == _exact_top_k(
+            indexes, query, 5, selected
+        )
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_matrix_rescores_with_exact_scores(dtype):
+    rng = np.random.default_rng(1)
+    exact = EmbeddingMatrix()
+    quantized = EmbeddingMatrix(dtype=dtype)
+    for position in range(3):
+        index_id = f"index{position}"
+        node_ids, embeddings = _index(index_id, 300, seed=position)
+        exact.add_index(index_id, node_ids, embeddings)
+        quantized.add_index(index_id, node_ids, embeddings)
+    quantized.remove_index("index1")
+    exact.remove_index("index1")
+
+    for _ in range(20):
+        query = rng.standard_normal(DIM)
+        expected = exact.top_k(query, 5)
+        found = quantized.top_k(query, 5)
+        assert [(i, n) for i, n, _ in found] == [(i, n) for i, n, _ in expected]
+        np.testing.assert_allclose(
+            [s for _, _, s in found], [s for _, _, s in expected], rtol=1e-5
+        )
+
+
+class _FakeVectorStore:
+    def __init__(self, node_ids, embeddings):
+        self._embeddings = dict(zip(node_ids, embeddings.tolist()))
+
+    def get(self, node_id):
+        return self._embeddings[node_id]
+
+
+def test_vector_store_rows_rescore_like_the_embeddings():
+    node_ids, embeddings = _index("json", 200, seed=3)
+    rows = VectorStoreRows(_FakeVectorStore(node_ids, embeddings), node_ids)
+    assert len(rows) == len(node_ids)
+    np.testing.assert_array_equal(rows[np.array([5, 0, 7])], embeddings[[5, 0, 7]])
+
+    exact = EmbeddingMatrix()
+    exact.add_index("json", node_ids, embeddings)
+    quantized = EmbeddingMatrix(dtype="int8")
+    quantized.add_index("json", node_ids, embeddings, full_precision=rows)
+    query = np.random.default_rng(4).standard_normal(DIM)
+    assert quantized.top_k(query, 5) == pytest.approx(exact.top_k(query, 5))
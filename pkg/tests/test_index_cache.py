@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+from advanced_chatbot.services.index_cache import _IndexCache
+
+
+def _persist_dir(tmp_path, index_id, size=10):
+    persist_dir = tmp_path / index_id
+    persist_dir.mkdir()
+    (persist_dir / "default__vector_store.json").write_bytes(b"x" * size)
+    return persist_dir
+
+
+def _loader(value, loads):
+    def load():
+        loads.append(value)
+        return value
+
+    return load
+
+
+def test_least_recently_used_index_is_evicted(tmp_path):
+    cache = _IndexCache(max_entries=2, max_bytes=1000)
+    removed = []
+    cache.add_removal_listener(removed.append)
+    loads = []
+    dirs = {key: _persist_dir(tmp_path, key) for key in ["a", "b", "c"]}
+
+    cache.get_or_load("a", dirs["a"], _loader("A", loads))
+    cache.get_or_load("b", dirs["b"], _loader("B", loads))
+    # "a" is used again, "b" becomes the least recently used
+    assert cache.get_or_load("a", dirs["a"], _loader("A", loads)) == "A"
+    cache.get_or_load("c", dirs["c"], _loader("C", loads))
+
+    assert cache.keys() == ["a", "c"]
+    assert removed == ["b"]
+    assert loads == ["A", "B", "C"]
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_size_budget_evicts_and_oversized_indexes_are_not_cached(tmp_path):
+    cache = _IndexCache(max_entries=10, max_bytes=25)
+    loads = []
+    cache.get_or_load("a", _persist_dir(tmp_path, "a"), _loader("A", loads))
+    cache.get_or_load("b", _persist_dir(tmp_path, "b"), _loader("B", loads))
+    cache.get_or_load("c", _persist_dir(tmp_path, "c"), _loader("C", loads))
+    assert cache.keys() == ["b", "c"]
+    assert cache.stats()["bytes"] == 20
+
+    big_dir = _persist_dir(tmp_path, "big", size=30)
+    assert cache.get_or_load("big", big_dir, _loader("BIG", loads)) == "BIG"
+    assert cache.get_or_load("big", big_dir, _loader("BIG", loads)) == "BIG"
+    assert loads.count("BIG") == 2
+    assert cache.keys() == ["b", "c"]
+
+
+def test_changed_persist_directory_is_loaded_again(tmp_path):
+    cache = _IndexCache(max_entries=10, max_bytes=1000)
+    removed = []
+    cache.add_removal_listener(removed.append)
+    loads = []
+    persist_dir = _persist_dir(tmp_path, "a")
+
+    cache.get_or_load("a", persist_dir, _loader("v1", loads))
+    # Files ignored by the signature do not invalidate the index
+    (persist_dir / "index_config.json").write_text("{}")
+    assert cache.get_or_load("a", persist_dir, _loader("v2", loads)) == "v1"
+
+    store = persist_dir / "default__vector_store.json"
+    store.write_bytes(b"y" * 12)
+    assert cache.get_or_load("a", persist_dir, _loader("v2", loads)) == "v2"
+    # Same size, newer modification time
+    stat = store.stat()
+    store.write_bytes(b"z" * 12)
+    os.utime(store, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.get_or_load("a", persist_dir, _loader("v3", loads)) == "v3"
+
+    assert loads == ["v1", "v2", "v3"]
+    assert removed == ["a", "a"]
+    assert cache.stats()["invalidations"] == 2
+
+
+def test_concurrent_misses_share_one_load(tmp_path):
+    cache = _IndexCache(max_entries=10, max_bytes=1000)
+    persist_dir = _persist_dir(tmp_path, "a")
+    loads = []
+
+    def load():
+        loads.append("A")
+        time.sleep(0.1)
+        return "A"
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_load("a", persist_dir, load))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["A"] * 4
+    assert loads == ["A"]
+    assert cache.stats()["shared_loads"] == 3
@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("llama_index.core", exc_type=ImportError)
+
+from advanced_chatbot.services.index_catalog import _IndexCatalog, describe_index_dir
+
+
+def _persist(storage_path, index_id, document_path, created_at, rows=3, pages=2):
+    persist_dir = storage_path / index_id
+    persist_dir.mkdir(parents=True)
+    with open(persist_dir / "index_config.json", "w") as f:
+        json.dump(
+            {
+                "index_id": index_id,
+                "document_path": document_path,
+                "content_hash": f"hash-{index_id}",
+                "created_at": created_at,
+            },
+            f,
+        )
+    np.save(persist_dir / "embeddings.npy", np.zeros((rows, 8), dtype=np.float32))
+    with open(persist_dir / "pages_index.json", "w") as f:
+        json.dump({"page_labels": [str(i + 1) for i in range(pages)]}, f)
+    return persist_dir
+
+
+@pytest.fixture
+def storage_path(tmp_path):
+    storage_path = tmp_path / "rag_storage"
+    _persist(storage_path, "a", "/data/Annual Report.pdf", 1.0, rows=5, pages=4)
+    _persist(storage_path, "b", "/data/notes.docx", 2.0)
+    _persist(storage_path, "c", "/data/old/notes.docx", 3.0)
+    # Not an index, skipped
+    (storage_path / "tmp").mkdir()
+    return storage_path
+
+
+def test_describe_index_dir(storage_path):
+    entry = describe_index_dir(storage_path / "a")
+    assert entry["document_name"] == "Annual Report.pdf"
+    assert entry["content_hash"] == "hash-a"
+    assert (entry["node_count"], entry["embedding_dim"], entry["page_count"]) == (
+        5,
+        8,
+        4,
+    )
+    assert entry["created_at"] == 1.0
+    assert describe_index_dir(storage_path / "tmp") is None
+
+
+def test_a_new_catalog_is_filled_from_disk_and_filtered(tmp_path, storage_path):
+    catalog = _IndexCatalog(tmp_path / "catalog.sqlite3", storage_path)
+
+    assert [entry["index_id"] for entry in catalog.list()] == ["a", "b", "c"]
+    assert catalog.count() == 3
+    assert [e["index_id"] for e in catalog.list(document_name="notes.docx")] == [
+        "b",
+        "c",
+    ]
+    assert [e["index_id"] for e in catalog.list(name_contains="REPORT")] == ["a"]
+    assert [e["index_id"] for e in catalog.list(content_hash="hash-c")] == ["c"]
+    assert [e["index_id"] for e in catalog.list(limit=1, offset=1)] == ["b"]
+    assert [e["index_id"] for e in catalog.list(offset=2)] == ["c"]
+    assert catalog.count(name_contains="notes") == 2
+
+
+def test_refresh_remove_and_rebuild(tmp_path, storage_path):
+    db_path = tmp_path / "catalog.sqlite3"
+    catalog = _IndexCatalog(db_path, storage_path)
+    assert catalog.count() == 3
+
+    # A new index, then an update keeping its creation time
+    _persist(storage_path, "d", "/data/new.pdf", 4.0, rows=2)
+    catalog.refresh("d")
+    assert catalog.get("d")["node_count"] == 2
+    np.save(storage_path / "d" / "embeddings.npy", np.zeros((7, 8), np.float32))
+    with open(storage_path / "d" / "index_config.json", "w") as f:
+        json.dump({"index_id": "d", "document_path": "/data/new.pdf"}, f)
+    catalog.refresh("d")
+    assert catalog.get("d")["node_count"] == 7
+    assert catalog.get("d")["created_at"] == 4.0
+
+    catalog.remove("a")
+    assert catalog.get("a") is None
+    # The catalog is persisted, a new process reads it without scanning the disk
+    assert catalog.count() == _IndexCatalog(db_path, storage_path).count() == 3
+
+    # Indexes deleted from disk are removed by refresh and by rebuild
+    for path in (storage_path / "b").iterdir():
+        path.unlink()
+    catalog.refresh("b")
+    assert catalog.get("b") is None
+    assert catalog.rebuild() == 3
+    assert [entry["index_id"] for entry in catalog.list()] == ["a", "c", "d"]
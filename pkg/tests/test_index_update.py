@@ -0,0 +1,86 @@
+import pytest
+
+# The service layer needs a working llama-index install
+pytest.importorskip("advanced_chatbot.services.rag_service", exc_type=ImportError)
+
+from llama_index.core import Document
+
+from advanced_chatbot.benchmarks.rag_benchmark import HashEmbedding
+from advanced_chatbot.services.rag_service import _RagService
+
+
+def _pages(texts):
+    return [
+        Document(text=text, metadata={"page_label": str(number + 1)})
+        for number, text in enumerate(texts)
+    ]
+
+
+def _version(tmp_path, name, pages):
+    path = tmp_path / name / "report.pdf"
+    path.parent.mkdir()
+    path.write_text("\n".join(page.text for page in pages))
+    return path
+
+
+def test_update_reembeds_only_the_changed_pages(tmp_path, monkeypatch):
+    service = _RagService()
+    service.use_models(embed_model=HashEmbedding(dim=32))
+    first = _pages(
+        [
+            "The first page is unchanged. It keeps its nodes.",
+            "The second page is about cats.",
+            "The third page is about dogs.",
+        ]
+    )
+    index_id, _ = service.build_vector_store_index(
+        service.split_documents(first), _version(tmp_path, "v1", first), documents=first
+    )
+    kept_ids = {
+        node_id
+        for node_id, node in service.load_vector_store_index(
+            index_id
+        ).docstore.docs.items()
+        if node.ref_doc_id == first[0].doc_id
+    }
+
+    embedded = []
+    embed_nodes = service.embed_nodes
+
+    def spy(nodes, progress_callback=None):
+        embedded.extend(nodes)
+        return embed_nodes(nodes, progress_callback=progress_callback)
+
+    monkeypatch.setattr(service, "embed_nodes", spy)
+    # The second page changed and the third one was removed
+    second = _pages(
+        [
+            "The first page is unchanged. It keeps its nodes.",
+            "The second page is about birds now.",
+        ]
+    )
+    changes = service.update_vector_store_index(
+        index_id, _version(tmp_path, "v2", second), documents=second
+    )
+
+    assert changes == {
+        "pages_unchanged": 1,
+        "pages_indexed": 1,
+        "pages_dropped": 2,
+        "nodes_added": len(embedded),
+    }
+    assert embedded and {node.ref_doc_id for node in embedded} == {second[1].doc_id}
+
+    docs = service.load_vector_store_index(index_id).docstore.docs
+    assert {node.ref_doc_id for node in docs.values()} == {
+        first[0].doc_id,
+        second[1].doc_id,
+    }
+    assert kept_ids <= set(docs)
+    assert service.get_page_store(index_id).get_page(1) == second[1].text
+    assert [
+        page["ref_doc_id"] for page in service.load_index_config(index_id)["pages"]
+    ] == [
+        first[0].doc_id,
+        second[1].doc_id,
+    ]
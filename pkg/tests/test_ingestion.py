@@ -0,0 +1,187 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+# The service layer needs a working llama-index install
+pytest.importorskip("advanced_chatbot.services.rag_service", exc_type=ImportError)
+
+from advanced_chatbot.services.ingestion import IngestionJob, _IngestionQueue
+
+
+class _FakeRagService:
+    """
+    Indexes a document as one node per line, slowly enough for jobs to overlap.
+    """
+
+    def __init__(self, fail_first_build: bool = False, fail_first_embed: bool = False):
+        self.indexes = {}
+        self.builds = 0
+        self.parses = 0
+        self.embeds = 0
+        self.fail_first_build = fail_first_build
+        self.fail_first_embed = fail_first_embed
+        self._lock = threading.Lock()
+
+    def find_index_by_content_hash(self, content_hash):
+        with self._lock:
+            for index_id, index_hash in self.indexes.items():
+                if index_hash == content_hash:
+                    return index_id
+        return None
+
+    def parse_document(self, document_path, progress_callback=None):
+        self.parses += 1
+        return document_path.read_text().splitlines()
+
+    def split_documents(self, documents):
+        return [SimpleNamespace(text=text, embedding=None) for text in documents]
+
+    def embed_nodes(self, nodes, progress_callback=None):
+        time.sleep(0.05)
+        self.embeds += 1
+        if self.fail_first_embed and self.embeds == 1:
+            raise RuntimeError("embedding failure")
+        progress_callback(len(nodes), len(nodes))
+
+    def build_vector_store_index(self, nodes, document_path, documents=None):
+        from advanced_chatbot.services.document_parser import file_content_hash
+
+        with self._lock:
+            self.builds += 1
+            if self.fail_first_build and self.builds == 1:
+                raise RuntimeError("build failure")
+            index_id = f"index{len(self.indexes)}"
+            self.indexes[index_id] = file_content_hash(document_path)
+        return index_id, None
+
+    def precompute_document_insights(self, index_id):
+        pass
+
+
+def _wait(queue, job_ids, timeout=5.0):
+    deadline = time.time() + timeout
+    while any(queue.get(job_id).is_active for job_id in job_ids):
+        assert time.time() < deadline, [queue.status(j) for j in job_ids]
+        time.sleep(0.01)
+    return [queue.get(job_id) for job_id in job_ids]
+
+
+def _documents(tmp_path, count, text="page one\npage two\n"):
+    paths = []
+    for position in range(count):
+        path = tmp_path / f"upload{position}.pdf"
+        path.write_text(text)
+        paths.append(path)
+    return paths
+
+
+def test_a_retried_job_resumes_from_the_failed_stage(tmp_path):
+    rag_service = _FakeRagService(fail_first_embed=True)
+    queue = _IngestionQueue(rag_service, max_workers=1)
+
+    (job,) = _wait(queue, [queue.submit(_documents(tmp_path, 1)[0])])
+    assert job.status == IngestionJob.FAILED
+    assert job.stage == "embed"
+    assert job.error == "RuntimeError: embedding failure"
+    assert job.completed_stages == ["hash", "parse", "split"]
+    assert 0 < job.fraction_done < 1
+
+    (job,) = _wait(queue, [queue.retry(job.job_id)])
+    assert job.status == IngestionJob.DONE
+    assert job.fraction_done == 1.0
+    assert job.attempts == 2
+    assert job.progress["pages_parsed"] == 2
+    assert job.progress["chunks_embedded"] == job.progress["chunks_total"] == 2
+    # The document was parsed once, the embeddings were computed again
+    assert (rag_service.parses, rag_service.embeds) == (1, 2)
+    with pytest.raises(ValueError):
+        queue.retry(job.job_id)
+
+
+def test_a_document_queued_twice_is_one_job(tmp_path):
+    queue = _IngestionQueue(_FakeRagService(), max_workers=1)
+    path = _documents(tmp_path, 1)[0]
+    job_id = queue.submit(path)
+    assert queue.submit(path) == job_id
+    _wait(queue, [job_id])
+    assert [job["job_id"] for job in queue.list_jobs()] == [job_id]
+
+
+def test_finished_jobs_are_forgotten(tmp_path):
+    queue = _IngestionQueue(
+        _FakeRagService(), max_workers=1, job_ttl=0.5, max_finished_jobs=1
+    )
+    first, second = _documents(tmp_path, 2)
+    second.write_text("another document\n")
+    first_id = queue.submit(first)
+    _wait(queue, [first_id])
+    second_id = queue.submit(second)
+    _wait(queue, [second_id])
+
+    # Over max_finished_jobs, the oldest finished job is forgotten
+    assert [job["job_id"] for job in queue.list_jobs()] == [second_id]
+    with pytest.raises(ValueError):
+        queue.get(first_id)
+    # Then every job older than job_ttl
+    time.sleep(0.6)
+    assert queue.list_jobs() == []
+
+
+def test_concurrent_uploads_of_the_same_content_create_one_index(tmp_path):
+    rag_service = _FakeRagService()
+    queue = _IngestionQueue(rag_service, max_workers=4)
+
+    jobs = _wait(queue, [queue.submit(path) for path in _documents(tmp_path, 4)])
+
+    assert rag_service.builds == 1
+    assert all(job.status == IngestionJob.DONE for job in jobs)
+    assert (
+        sorted(job.action for job in jobs)
+        == [IngestionJob.CREATE] + [IngestionJob.DUPLICATE] * 3
+    )
+    assert {job.index_id for job in jobs} == {"index0"}
+
+
+def test_a_waiting_upload_takes_over_a_failed_one(tmp_path):
+    rag_service = _FakeRagService(fail_first_build=True)
+    queue = _IngestionQueue(rag_service, max_workers=2)
+
+    first, second = _wait(
+        queue, [queue.submit(path) for path in _documents(tmp_path, 2)]
+    )
+
+    assert {first.status, second.status} == {IngestionJob.FAILED, IngestionJob.DONE}
+    failed = first if first.status == IngestionJob.FAILED else second
+    # Retried once the other job indexed the same content
+    (retried,) = _wait(queue, [queue.retry(failed.job_id)])
+    assert retried.status == IngestionJob.DONE
+    assert retried.action == IngestionJob.DUPLICATE
+    assert retried.index_id == "index0"
+    assert rag_service.builds == 2
+
+
+def test_staged_duplicate_is_deleted_and_the_original_moved(tmp_path):
+    queue = _IngestionQueue(_FakeRagService(), max_workers=2)
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    first_staged = _documents(tmp_path / "a", 1)[0]
+    second_staged = _documents(tmp_path / "b", 1)[0]
+    destination = tmp_path / "documents" / "document.pdf"
+    other_destination = tmp_path / "documents" / "copy.pdf"
+
+    first, second = _wait(
+        queue,
+        [
+            queue.submit(first_staged, destination=destination),
+            queue.submit(second_staged, destination=other_destination),
+        ],
+    )
+
+    assert {first.action, second.action} == {
+        IngestionJob.CREATE,
+        IngestionJob.DUPLICATE,
+    }
+    assert not first_staged.exists() and not second_staged.exists()
+    assert destination.exists() != other_destination.exists()
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("llama_index.core", exc_type=ImportError)
+
+from llama_index.core.schema import Document, TextNode
+
+from advanced_chatbot.services.ingestion_checkpoint import (
+    CHECKPOINT_FNAME,
+    EMBEDDINGS_PART_FNAME,
+    NODES_PART_FNAME,
+    PAGE_RECORDS_PART_FNAME,
+    IngestionCheckpoint,
+)
+from advanced_chatbot.services.page_store import PAGES_FNAME, PageStore
+
+DIM = 8
+
+
+def _batch(first_page: int, num_pages: int, nodes_per_page: int = 3):
+    documents, records, nodes = [], [], []
+    for page in range(first_page, first_page + num_pages):
+        document = Document(
+            text=f"text of page {page}", metadata={"page_label": str(page + 1)}
+        )
+        document.id_ = f"doc-{page}"
+        documents.append(document)
+        records.append({"page_label": str(page + 1), "doc_id": document.id_})
+        nodes.extend(
+            TextNode(id_=f"node-{page}-{i}", text=f"sentence {i} of page {page}")
+            for i in range(nodes_per_page)
+        )
+    rng = np.random.default_rng(first_page)
+    embeddings = rng.standard_normal((len(nodes), DIM)).astype(np.float32)
+    return documents, records, nodes, embeddings
+
+
+def _open(staging_dir):
+    return IngestionCheckpoint.open(staging_dir, "index", "document.pdf", "hash")
+
+
+def test_reopen_truncates_a_partial_batch(tmp_path):
+    checkpoint = _open(tmp_path)
+    checkpoint.append_batch(*_batch(0, 2))
+    committed = {
+        fname: (tmp_path / fname).stat().st_size
+        for fname in (
+            EMBEDDINGS_PART_FNAME,
+            NODES_PART_FNAME,
+            PAGES_FNAME,
+            PAGE_RECORDS_PART_FNAME,
+        )
+    }
+    # A batch interrupted after writing part of its files, before its commit
+    for fname in committed:
+        with open(tmp_path / fname, "ab") as f:
+            f.write(b"partial batch")
+
+    resumed = _open(tmp_path)
+    assert resumed.pages_done == 2
+    assert resumed.nodes_done == 6
+    assert len(resumed.page_records) == 2
+    for fname, size in committed.items():
+        assert (tmp_path / fname).stat().st_size == size
+
+
+def test_resume_yields_the_same_nodes_and_embeddings(tmp_path):
+    batch_pages = [(0, 2), (2, 3), (5, 1)]
+    uninterrupted = _open(tmp_path / "uninterrupted")
+    for pages in batch_pages:
+        uninterrupted.append_batch(*_batch(*pages))
+
+    interrupted = _open(tmp_path / "interrupted")
+    interrupted.append_batch(*_batch(*batch_pages[0]))
+    with open(tmp_path / "interrupted" / NODES_PART_FNAME, "ab") as f:
+        f.write(b'{"truncated": ')
+    resumed = _open(tmp_path / "interrupted")
+    assert resumed.pages_done == 2
+    for pages in batch_pages[1:]:
+        resumed.append_batch(*_batch(*pages))
+
+    assert resumed.pages_done == uninterrupted.pages_done == 6
+    assert resumed.page_records == uninterrupted.page_records
+    np.testing.assert_array_equal(resumed.embeddings(), uninterrupted.embeddings())
+    resumed_nodes = [n for batch in resumed.iter_nodes(batch_size=4) for n in batch]
+    expected_nodes = [n for batch in uninterrupted.iter_nodes() for n in batch]
+    assert [n.node_id for n in resumed_nodes] == [n.node_id for n in expected_nodes]
+    assert [n.text for n in resumed_nodes] == [n.text for n in expected_nodes]
+
+
+def test_another_version_of_the_document_starts_over(tmp_path):
+    _open(tmp_path).append_batch(*_batch(0, 2))
+    checkpoint = IngestionCheckpoint.open(tmp_path, "index", "document.pdf", "other")
+    assert checkpoint.pages_done == 0
+    assert checkpoint.nodes_done == 0
+    assert list(checkpoint.iter_nodes()) == []
+
+
+def test_checkpoint_size_does_not_grow_with_pages(tmp_path):
+    checkpoint = _open(tmp_path / "staging")
+    checkpoint.append_batch(*_batch(0, 1))
+    size = (tmp_path / "staging" / CHECKPOINT_FNAME).stat().st_size
+    for first_page in range(1, 50, 7):
+        checkpoint.append_batch(*_batch(first_page, 7))
+    # Only the counters change, and they gain a few digits
+    assert (tmp_path / "staging" / CHECKPOINT_FNAME).stat().st_size <= size + 16
+
+    assert [r["doc_id"] for r in checkpoint.page_records] == [
+        f"doc-{page}" for page in range(50)
+    ]
+    persist_dir = tmp_path / "index"
+    persist_dir.mkdir()
+    checkpoint.move_page_store(persist_dir)
+    page_store = PageStore(persist_dir)
+    assert page_store.page_labels == [str(page + 1) for page in range(50)]
+    assert page_store.get_page(12) == "text of page 12"
@@ -0,0 +1,113 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("llama_index.core", exc_type=ImportError)
+
+from advanced_chatbot.services.instrumentation import (
+    Instrumentation,
+    JsonLinesSink,
+    MetricsAggregator,
+    SpanSink,
+    traced,
+)
+
+
+class _ListSink(SpanSink):
+    def __init__(self):
+        self.spans = []
+
+    def on_span(self, span):
+        self.spans.append(span)
+
+
+@pytest.fixture
+def sink():
+    sink = _ListSink()
+    Instrumentation.enable(sink)
+    yield sink
+    Instrumentation.remove_sink(sink)
+    Instrumentation.disable()
+
+
+def test_sinks_must_implement_on_span():
+    class IncompleteSink(SpanSink):
+        pass
+
+    with pytest.raises(TypeError):
+        SpanSink()
+    with pytest.raises(TypeError):
+        IncompleteSink()
+
+
+def test_child_spans_are_not_in_the_self_time_of_their_parent(sink):
+    with Instrumentation.span("chat", nodes=4) as chat:
+        with Instrumentation.span("retrieve"):
+            time.sleep(0.02)
+        Instrumentation.annotate(cache_hit=True)
+
+    retrieve, chat_span = sink.spans
+    assert retrieve.parent is chat is chat_span
+    assert chat_span.attributes == {"nodes": 4, "cache_hit": True}
+    assert chat_span.self_time < chat_span.duration - 0.015
+    assert retrieve.self_time == retrieve.duration
+
+
+def test_failed_span_records_its_error(sink):
+    with pytest.raises(ValueError):
+        with Instrumentation.span("load"):
+            raise ValueError("missing index")
+    assert sink.spans[-1].error == "ValueError"
+
+
+def test_traced_generator_lasts_until_exhausted(sink):
+    @traced("tokens")
+    def tokens():
+        for token in ["a", "b"]:
+            time.sleep(0.01)
+            yield token
+
+    generator = tokens()
+    assert next(generator) == "a"
+    assert sink.spans == []
+    assert list(generator) == ["b"]
+    assert [span.name for span in sink.spans] == ["tokens"]
+    assert sink.spans[0].duration >= 0.02
+
+
+def test_disabled_instrumentation_records_nothing():
+    sink = _ListSink()
+    Instrumentation.enable(sink)
+    Instrumentation.disable()
+    try:
+        with Instrumentation.span("chat") as span:
+            span.set(nodes=1)
+            Instrumentation.annotate(cache_hit=True)
+        assert sink.spans == []
+    finally:
+        Instrumentation.remove_sink(sink)
+
+
+def test_metrics_aggregate_spans_by_name(sink, tmp_path):
+    metrics = MetricsAggregator()
+    jsonl = JsonLinesSink(tmp_path / "spans.jsonl")
+    Instrumentation.enable(metrics, jsonl)
+    try:
+        for cache_hit in (True, False, True):
+            with Instrumentation.span("load_index", cache_hit=cache_hit, nodes=10):
+                pass
+    finally:
+        Instrumentation.remove_sink(metrics)
+        Instrumentation.remove_sink(jsonl)
+        jsonl.close()
+
+    snapshot = metrics.snapshot()["load_index"]
+    assert snapshot["count"] == 3
+    assert snapshot["attributes"] == {"cache_hit": 2, "nodes": 30}
+    assert snapshot["histogram"][float("inf")] == 3
+    assert 'rag_span_duration_seconds_count{span="load_index"} 3' in (
+        metrics.to_prometheus()
+    )
+    lines = (tmp_path / "spans.jsonl").read_text().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["load_index"] * 3
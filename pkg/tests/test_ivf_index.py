@@ -0,0 +1,58 @@
+import numpy as np
+
+from advanced_chatbot.services.ivf_index import (
+    IVFIndex,
+    _clustered_embeddings,
+    exact_top_k,
+    recall_report,
+)
+
+ROWS, DIM, TOPICS = 5000, 32, 50
+TOP_K = 4
+
+
+def _held_out_queries(count: int, seed: int) -> np.ndarray:
+    """
+    Queries drawn around the same topics as the indexed rows, but not indexed.
+    """
+    rows = _clustered_embeddings(ROWS + count, DIM, TOPICS, seed=0)
+    rng = np.random.default_rng(seed)
+    return rows[ROWS:] + rng.standard_normal((count, DIM)).astype(np.float32) * 0.02
+
+
+def test_calibrated_nprobe_reaches_recall_on_held_out_queries():
+    embeddings = _clustered_embeddings(ROWS, DIM, TOPICS, seed=0)
+    index = IVFIndex.build(embeddings, target_recall=0.95, similarity_top_k=TOP_K)
+    assert 0 < index.nprobe < index.n_lists
+
+    queries = _held_out_queries(200, seed=1)
+    report = recall_report(index, embeddings, queries, TOP_K, [index.nprobe])
+    assert report[-1]["recall"] >= 0.9
+    # The calibrated nprobe scores a fraction of the rows only
+    assert report[-1]["scanned"] < 1.0
+
+
+def test_every_cluster_is_exact():
+    embeddings = _clustered_embeddings(1000, DIM, 10, seed=2)
+    index = IVFIndex.build(embeddings, n_lists=16)
+    for query in _held_out_queries(20, seed=3):
+        assert index.search(embeddings, query, TOP_K, index.n_lists) == exact_top_k(
+            embeddings, query, TOP_K
+        )
+
+
+def test_save_load_keeps_nprobe_and_checks_node_ids(tmp_path):
+    embeddings = _clustered_embeddings(2000, DIM, 20, seed=4)
+    node_ids = [f"node-{row}" for row in range(len(embeddings))]
+    index = IVFIndex.build(
+        embeddings, node_ids=node_ids, target_recall=0.9, similarity_top_k=TOP_K
+    )
+    index.save(tmp_path)
+
+    loaded = IVFIndex.load(tmp_path, node_ids)
+    assert loaded.nprobe == index.nprobe
+    np.testing.assert_array_equal(loaded.list_rows, index.list_rows)
+    assert IVFIndex.load(tmp_path, node_ids[::-1]) is None
+
+    IVFIndex.remove(tmp_path)
+    assert IVFIndex.load(tmp_path) is None
@@ -0,0 +1,48 @@
+import pytest
+
+from advanced_chatbot.config import (
+    DEFAULT_LANGUAGE_MIN_CONFIDENCE,
+    DEFAULT_LANGUAGE_MIN_LETTERS,
+)
+from advanced_chatbot.services.language_id import (
+    HELDOUT_PATH,
+    UNSUPPORTED_FNAME,
+    LanguageIdentifier,
+    calibrate,
+)
+
+
+def _detect(text):
+    return LanguageIdentifier.detect(text, min_letters=DEFAULT_LANGUAGE_MIN_LETTERS)
+
+
+@pytest.mark.parametrize(
+    "text", ["hello", "Hola, ¿qué tal?", "Bonjour tout le monde", "12345 !", ""]
+)
+def test_short_input_falls_back(text):
+    _, confidence = _detect(text)
+    assert confidence < DEFAULT_LANGUAGE_MIN_CONFIDENCE
+
+
+@pytest.mark.parametrize("language", LanguageIdentifier.languages)
+def test_every_shipped_language_is_detected_on_held_out_sentences(language):
+    sentences = (HELDOUT_PATH / f"{language}.txt").read_text("utf-8").splitlines()
+    detections = [_detect(sentence) for sentence in sentences]
+    assert [detected for detected, _ in detections] == [language] * len(sentences)
+    trusted = [c >= DEFAULT_LANGUAGE_MIN_CONFIDENCE for _, c in detections]
+    assert sum(trusted) >= 0.8 * len(sentences)
+
+
+def test_unsupported_languages_get_a_low_confidence():
+    lines = (HELDOUT_PATH / UNSUPPORTED_FNAME).read_text("utf-8").splitlines()
+    for line in lines:
+        code, sentence = line.split("\t", 1)
+        language, confidence = _detect(sentence)
+        assert confidence < DEFAULT_LANGUAGE_MIN_CONFIDENCE, (code, language)
+
+
+def test_threshold_is_above_every_wrong_held_out_detection():
+    report = calibrate(min_letters=DEFAULT_LANGUAGE_MIN_LETTERS)
+    assert report["min_confidence"] < DEFAULT_LANGUAGE_MIN_CONFIDENCE
+    for language in LanguageIdentifier.languages:
+        assert report["languages"][language]["recall"] >= 0.8
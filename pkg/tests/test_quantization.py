@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from advanced_chatbot.services.ivf_index import _clustered_embeddings
+from advanced_chatbot.services.quantization import (
+    accuracy_report,
+    normalize,
+    quantize,
+    quantized_scores,
+    top_k_positions,
+)
+
+
+@pytest.mark.parametrize("dtype, max_error", [("float16", 1e-3), ("int8", 5e-2)])
+def test_quantized_scores_are_close_to_exact(dtype, max_error):
+    vectors = _clustered_embeddings(2000, 64, 20, seed=0)
+    query = normalize(np.random.default_rng(1).standard_normal(64))
+    codes, scales = quantize(vectors, dtype)
+    assert (scales is not None) == (dtype == "int8")
+    np.testing.assert_allclose(
+        quantized_scores(codes, scales, query), vectors @ query, atol=max_error
+    )
+
+
+def test_rescoring_recovers_the_exact_top_k():
+    embeddings = _clustered_embeddings(5000, 64, 50, seed=2)
+    queries = _clustered_embeddings(50, 64, 50, seed=3)
+    for row in accuracy_report(embeddings, queries, 4, rescore_factor=4):
+        assert row["recall_rescored"] >= 0.99, row
+
+
+def test_top_k_positions_are_best_first():
+    scores = np.array([0.1, 0.9, 0.5, 0.7], dtype=np.float32)
+    assert top_k_positions(scores, 3).tolist() == [1, 3, 2]
+    assert top_k_positions(scores, 10).tolist() == [1, 3, 2, 0]
+    assert len(top_k_positions(scores[:0], 3)) == 0
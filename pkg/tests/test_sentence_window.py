@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip("llama_index.core", exc_type=ImportError)
+
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceWindowNodeParser
+from llama_index.core.postprocessor import MetadataReplacementPostProcessor
+from llama_index.core.schema import MetadataMode, NodeWithScore
+from llama_index.core.storage.docstore import SimpleDocumentStore
+
+from advanced_chatbot.services.sentence_window import (
+    WINDOW_METADATA_KEY,
+    WINDOW_RANGE_METADATA_KEY,
+    CompactSentenceWindowNodeParser,
+    SentenceWindowPostProcessor,
+    window_node_id,
+)
+
+PAGES = [
+    Document(
+        text=" ".join(f"Sentence {i} of page {page}." for i in range(6)),
+        metadata={"page_label": str(page)},
+    )
+    for page in (1, 2)
+]
+
+
+def _compact_nodes(window_size=2):
+    parser = CompactSentenceWindowNodeParser.from_defaults(
+        window_size=window_size, id_func=window_node_id, include_prev_next_rel=False
+    )
+    return parser.get_nodes_from_documents(PAGES)
+
+
+def _hits(nodes, positions):
+    # Retrieved nodes are copies, the postprocessor changes their text
+    return [
+        NodeWithScore(node=nodes[position].copy(), score=1.0) for position in positions
+    ]
+
+
+def test_nodes_store_window_ranges_instead_of_texts():
+    nodes = _compact_nodes()
+    assert len(nodes) == 12
+    assert [node.metadata[WINDOW_RANGE_METADATA_KEY] for node in nodes[:6]] == [
+        [0, 3],
+        [0, 4],
+        [0, 5],
+        [1, 6],
+        [2, 6],
+        [3, 6],
+    ]
+    assert nodes[7].node_id == f"{PAGES[1].doc_id}-1"
+    for node in nodes:
+        assert WINDOW_METADATA_KEY not in node.metadata
+        # The range is neither embedded nor sent to the LLM
+        assert "window_range" not in node.get_content(MetadataMode.EMBED)
+        assert "window_range" not in node.get_content(MetadataMode.LLM)
+
+
+def test_windows_are_rebuilt_like_the_stored_windows():
+    nodes = _compact_nodes()
+    docstore = SimpleDocumentStore()
+    docstore.add_documents(nodes)
+    postprocessor = SentenceWindowPostProcessor([SimpleDocumentStore(), docstore])
+
+    # The windows of SentenceWindowNodeParser, stored in the metadata
+    legacy_nodes = SentenceWindowNodeParser.from_defaults(
+        window_size=2
+    ).get_nodes_from_documents(PAGES)
+    expected = MetadataReplacementPostProcessor(
+        target_metadata_key=WINDOW_METADATA_KEY
+    ).postprocess_nodes(_hits(legacy_nodes, range(12)))
+
+    rebuilt = postprocessor.postprocess_nodes(_hits(nodes, range(12)))
+    assert [n.node.get_content() for n in rebuilt] == [
+        n.node.get_content() for n in expected
+    ]
+    # The sentences keep their trailing whitespace, like in the stored windows
+    assert " ".join(rebuilt[0].node.get_content().split()) == (
+        "Sentence 0 of page 1. Sentence 1 of page 1. Sentence 2 of page 1."
+    )
+
+
+def test_nodes_of_older_indexes_keep_their_stored_window():
+    legacy_nodes = SentenceWindowNodeParser.from_defaults(
+        window_size=1
+    ).get_nodes_from_documents(PAGES)
+    postprocessor = SentenceWindowPostProcessor([SimpleDocumentStore()])
+
+    (hit,) = postprocessor.postprocess_nodes(_hits(legacy_nodes, [3]))
+    assert hit.node.get_content() == legacy_nodes[3].metadata[WINDOW_METADATA_KEY]
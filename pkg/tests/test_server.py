@@ -0,0 +1,90 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+# The service layer needs a working llama-index install
+pytest.importorskip("advanced_chatbot.services.rag_service", exc_type=ImportError)
+
+from advanced_chatbot import server as server_module
+from advanced_chatbot.server import RagHTTPServer
+
+
+class _FakeRagService:
+    @staticmethod
+    def list_vector_store_index(**filters):
+        return []
+
+
+class _FakeIngestionQueue:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, document_path, index_id=None, destination=None):
+        self.submitted.append((document_path, destination))
+        return "job0"
+
+    def status(self, job_id):
+        return {"job_id": job_id}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(server_module, "RagService", _FakeRagService)
+    monkeypatch.setattr(server_module, "IngestionQueue", _FakeIngestionQueue())
+    root = tmp_path / "documents"
+    root.mkdir()
+    (root / "report.pdf").write_bytes(b"%PDF")
+    (tmp_path / "secret.pdf").write_bytes(b"%PDF")
+    (root / "link.pdf").symlink_to(tmp_path / "secret.pdf")
+
+    rag_server = RagHTTPServer(
+        ("127.0.0.1", 0), workers=1, max_upload_size=16, documents_root=root
+    )
+    thread = threading.Thread(target=rag_server.serve_forever, daemon=True)
+    thread.start()
+    yield rag_server
+    rag_server.shutdown()
+    rag_server.server_close()
+
+
+def _post(rag_server, path, body, content_type="application/json"):
+    connection = http.client.HTTPConnection("127.0.0.1", rag_server.server_port)
+    try:
+        connection.request("POST", path, body, {"Content-Type": content_type})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def _create(rag_server, document_path):
+    return _post(rag_server, "/indexes", json.dumps({"document_path": document_path}))
+
+
+def test_documents_under_the_root_are_indexed(server):
+    status, payload = _create(server, "report.pdf")
+    assert (status, payload) == (202, {"job_id": "job0"})
+    status, _ = _create(server, str(server.documents_root / "report.pdf"))
+    assert status == 202
+    assert [path for path, _ in server_module.IngestionQueue.submitted] == [
+        server.documents_root / "report.pdf"
+    ] * 2
+
+
+@pytest.mark.parametrize(
+    "document_path", ["../secret.pdf", "link.pdf", "/etc/passwd", "/"]
+)
+def test_paths_outside_the_root_are_refused(server, document_path):
+    status, payload = _create(server, document_path)
+    assert status == 403, payload
+    assert server_module.IngestionQueue.submitted == []
+
+
+def test_missing_documents_and_oversized_uploads_are_refused(server):
+    assert _create(server, "missing.pdf")[0] == 400
+    assert _create(server, "")[0] == 400
+    status, _ = _post(server, "/indexes?filename=big.pdf", b"x" * 17, "application/pdf")
+    assert status == 413
+    assert server_module.IngestionQueue.submitted == []